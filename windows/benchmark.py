@@ -0,0 +1,436 @@
+"""Reproducible benchmarks for the transfer protocol.
+
+    python benchmark.py [--scenarios huge,tiny,...] [--repeat 3]
+                        [--save-baseline base.json] [--baseline base.json --threshold 0.1]
+
+By default one NetworkManager sends to itself over loopback, so sender and
+receiver share the process and its CPU/memory numbers. To measure across a
+real link (another host, or a network namespace), start
+`python -m localdrop serve` on the peer and pass --peer with its IP or host
+name. With --secret every scenario runs over the encrypted transport (the
+peer needs the same secret); compare it with a run without one.
+
+Scenarios:
+  huge    one large file                           MB/s
+  tiny    a folder of many tiny files              files/s
+  mixed   a folder of mixed sizes                  MB/s
+  small   sequential single small files            latency percentiles
+  text    sequential text messages                 latency percentiles
+  resume  a large file cut off half way, then resumed  seconds to finish
+
+Test data is generated once (deterministically) under --workdir. Every run
+sends under a fresh remote prefix, so manifests and resume never see a
+previous run's files. A baseline stores each scenario's metrics. Comparing
+against one fails (exit status 1) when a scenario's primary metric is more
+than --threshold worse.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import network
+from network import BatchSender, Device, NetworkManager
+from secure import CIPHERS, DEFAULT_CIPHER
+from zerocopy import WRITE_BEHIND_DEPTH
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+MB = 1024 * 1024
+RSS_SAMPLE_INTERVAL = 0.05
+
+# Scenario -> (primary metric, True when higher is better)
+PRIMARY = {
+    "huge": ("mb_s", True),
+    "tiny": ("files_s", True),
+    "mixed": ("mb_s", True),
+    "small": ("p50_ms", False),
+    "text": ("p50_ms", False),
+    "resume": ("seconds", False),
+}
+
+
+def _rss():
+    """Resident set size of this process in bytes, or None when it cannot be read."""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class _Usage:
+    """Wall time, CPU time and peak RSS over one run."""
+
+    def __enter__(self):
+        self.peak = _rss()
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+        self.cpu = time.process_time()
+        self.wall = time.perf_counter()
+        return self
+
+    def _sample(self):
+        while not self.stop.wait(RSS_SAMPLE_INTERVAL):
+            rss = _rss()
+            if rss is not None and (self.peak is None or rss > self.peak):
+                self.peak = rss
+
+    def __exit__(self, *exc):
+        self.wall = time.perf_counter() - self.wall
+        self.cpu = time.process_time() - self.cpu
+        self.stop.set()
+        self.thread.join()
+
+
+def _percentiles(latencies):
+    ordered = sorted(latencies)
+
+    def at(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 3)
+    return {"p50_ms": at(0.50), "p90_ms": at(0.90), "p99_ms": at(0.99)}
+
+
+# Test data
+
+def _write_random(path, size, rnd):
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining:
+            count = min(remaining, 4 * MB)
+            f.write(rnd.randbytes(count))
+            remaining -= count
+
+
+def _dataset(workdir, name, build):
+    """Directory of generated data, built once and reused by later runs."""
+    path = os.path.join(workdir, name)
+    marker = path + ".done"
+    if not os.path.exists(marker):
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+        build(path, random.Random(name))
+        open(marker, 'w').close()
+    return path
+
+
+def _folder_entries(folder, prefix):
+    entries = []
+    base = os.path.basename(folder)
+    for root, _, files in os.walk(folder):
+        for file in files:
+            abs_path = os.path.join(root, file)
+            remote = "/".join((prefix, base, os.path.relpath(abs_path, folder).replace("\\", "/")))
+            entries.append((abs_path, remote, os.path.getsize(abs_path)))
+    return entries
+
+
+# Scenarios: each returns (bytes, files, latencies or None, extra metrics)
+
+def scenario_huge(bench):
+    folder = _dataset(bench.workdir, f"huge-{bench.args.huge_mb}",
+                      lambda path, rnd: _write_random(os.path.join(path, "huge.bin"), bench.args.huge_mb * MB, rnd))
+    path = os.path.join(folder, "huge.bin")
+    size = os.path.getsize(path)
+    if not bench.manager.send_file(bench.ip, path, f"{bench.prefix}/huge.bin"):
+        raise RuntimeError("huge file transfer failed")
+    return size, 1, None, {}
+
+
+def _send_folder(bench, folder):
+    entries = _folder_entries(folder, bench.prefix)
+    total = sum(entry[2] for entry in entries)
+    batch = BatchSender(bench.manager, bench.ip, group_id=str(uuid.uuid4()), group_size=total,
+                        stop_on_failure=False)
+    if not batch.send(entries, archive_label=os.path.basename(folder)):
+        raise RuntimeError(f"{len(batch.failures)} file(s) failed")
+    return total, len(entries), None, {}
+
+
+def scenario_tiny(bench):
+    count, size = bench.args.tiny_count, bench.args.tiny_size
+
+    def build(path, rnd):
+        for i in range(count):
+            subdir = os.path.join(path, f"d{i % 50}")
+            os.makedirs(subdir, exist_ok=True)
+            with open(os.path.join(subdir, f"f{i}.txt"), 'wb') as f:
+                f.write(rnd.randbytes(rnd.randint(size // 2, size)))
+    return _send_folder(bench, _dataset(bench.workdir, f"tiny-{count}-{size}", build))
+
+
+def scenario_mixed(bench):
+    total = bench.args.mixed_mb * MB
+    sizes = (100, 4096, 64 * 1024, 512 * 1024, 4 * MB, 32 * MB)
+
+    def build(path, rnd):
+        written = i = 0
+        while written < total:
+            size = min(rnd.choice(sizes), total - written)
+            subdir = os.path.join(path, f"d{i % 20}")
+            os.makedirs(subdir, exist_ok=True)
+            _write_random(os.path.join(subdir, f"f{i}.bin"), size, rnd)
+            written += size
+            i += 1
+    return _send_folder(bench, _dataset(bench.workdir, f"mixed-{bench.args.mixed_mb}", build))
+
+
+def scenario_small(bench):
+    count, size = bench.args.small_count, bench.args.small_size
+    folder = _dataset(bench.workdir, f"small-{size}",
+                      lambda path, rnd: _write_random(os.path.join(path, "small.bin"), size, rnd))
+    path = os.path.join(folder, "small.bin")
+    latencies = []
+    for i in range(count):
+        started = time.perf_counter()
+        if not bench.manager.send_file(bench.ip, path, f"{bench.prefix}/small{i}.bin"):
+            raise RuntimeError(f"small file {i} failed")
+        latencies.append(time.perf_counter() - started)
+    return size * count, count, latencies, {}
+
+
+def scenario_text(bench):
+    count = bench.args.texts
+    padding = "x" * max(0, bench.args.text_size - 8)
+    latencies = []
+    for i in range(count):
+        message = f"{i:08d}{padding}"  # Distinct texts: repeats within the dedup window are dropped
+        bench.text_arrived.clear()
+        started = time.perf_counter()
+        if not bench.manager.send_text(bench.ip, message):
+            raise RuntimeError(f"text {i} failed")
+        if bench.loopback:
+            # In-process receiver: measure until delivery, not just until sent
+            if not bench.text_arrived.wait(10):
+                raise RuntimeError(f"text {i} never arrived")
+        latencies.append(time.perf_counter() - started)
+    return len(message.encode('utf-8')) * count, count, latencies, {}
+
+
+def scenario_resume(bench):
+    folder = _dataset(bench.workdir, f"resume-{bench.args.resume_mb}",
+                      lambda path, rnd: _write_random(os.path.join(path, "resume.bin"), bench.args.resume_mb * MB, rnd))
+    path = os.path.join(folder, "resume.bin")
+    size = os.path.getsize(path)
+    remote = f"{bench.prefix}/resume.bin"
+    manager = bench.manager
+
+    def cut_off(filename, current, total, mode, speed=0, eta=0):
+        if current >= total // 2:
+            manager.cancel_transfer()
+
+    # Untimed first attempt, cut off half way
+    manager.send_file(bench.ip, path, remote, progress=cut_off)
+    time.sleep(0.5)  # Let the receiver notice and close the partial file
+    manager.reset_cancel_flag()
+    extra = {}
+    if bench.loopback:
+        # The partial file may be preallocated to full size: its sidecar says how much of it is data
+        part = os.path.join(bench.receive_dir, remote + network.PART_SUFFIX)
+        extra["resumed_at"] = manager._trusted_size(part, os.path.getsize(part))
+
+    with _Usage() as usage:
+        if not manager.send_file(bench.ip, path, remote):
+            raise RuntimeError("resumed transfer failed")
+    bench.resume_usage = usage
+    return size, 1, None, extra
+
+
+SCENARIOS = {
+    "huge": scenario_huge,
+    "tiny": scenario_tiny,
+    "mixed": scenario_mixed,
+    "small": scenario_small,
+    "text": scenario_text,
+    "resume": scenario_resume,
+}
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.workdir = os.path.abspath(args.workdir)
+        os.makedirs(self.workdir, exist_ok=True)
+        self.loopback = args.peer is None
+        self.text_arrived = threading.Event()
+        self.receive_dir = tempfile.mkdtemp(prefix="receive-", dir=self.workdir)
+        self.manager = NetworkManager(
+            "benchmark",
+            on_text_received=lambda text: self.text_arrived.set(),
+            on_text_file=lambda path: self.text_arrived.set(),
+            stripe_streams=args.streams,
+            delta_sync=args.delta,
+            compression=args.compress,
+            checksums=args.checksum,
+            engine=args.engine,
+            write_behind=args.write_behind,
+            secret=args.secret,
+            cipher=args.cipher,
+            download_dir=self.receive_dir,
+            accept_policy=lambda sender_ip, filename, size: self.loopback,
+        )
+        self.manager.start()
+        if self.loopback:
+            self.ip = "127.0.0.1"
+            # Discovery ignores our own beacons, so register ourselves with every feature
+            self.manager.found_devices.add(
+                Device(self.ip, "benchmark", "windows", time.time(), tuple(self.manager.discovery.base['features'])), 1e9)
+        else:
+            from localdrop import _find_device
+            self.ip = _find_device(self.manager, args.peer, args.wait)
+            if self.ip is None:
+                raise SystemExit(f"Peer {args.peer} not found")
+        self.prefix = None
+
+    def run(self, name):
+        """One run of a scenario. Returns its metrics."""
+        self.prefix = f"bench-{uuid.uuid4().hex[:8]}"
+        self.resume_usage = None
+        self.manager.reset_cancel_flag()
+        try:
+            with _Usage() as usage:
+                size, files, latencies, metrics = SCENARIOS[name](self)
+        finally:
+            if self.loopback:
+                shutil.rmtree(os.path.join(self.receive_dir, self.prefix), ignore_errors=True)
+        usage = self.resume_usage or usage
+        metrics.update(
+            seconds=round(usage.wall, 4),
+            bytes=size,
+            files=files,
+            mb_s=round(size / MB / usage.wall, 2) if usage.wall > 0 else 0,
+            files_s=round(files / usage.wall, 1) if usage.wall > 0 else 0,
+            cpu_s=round(usage.cpu, 3),
+            cpu_pct=round(100 * usage.cpu / usage.wall, 1) if usage.wall > 0 else 0,
+            peak_rss_mb=round(usage.peak / MB, 1) if usage.peak is not None else None,
+        )
+        if latencies:
+            metrics.update(_percentiles(latencies))
+        return metrics
+
+    def close(self):
+        self.manager.stop()
+        shutil.rmtree(self.receive_dir, ignore_errors=True)
+
+
+def _median_run(runs):
+    """Per-metric median over repeated runs."""
+    merged = {}
+    for key in runs[0]:
+        values = [run[key] for run in runs if run.get(key) is not None]
+        merged[key] = statistics.median(values) if values else None
+    return merged
+
+
+def compare(results, baseline, threshold):
+    """Scenarios whose primary metric regressed by more than threshold: [(name, metric, base, now)]."""
+    regressions = []
+    for name, metrics in results.items():
+        if name not in baseline:
+            continue
+        metric, higher_is_better = PRIMARY[name]
+        base, now = baseline[name].get(metric), metrics.get(metric)
+        if not base or now is None:
+            continue
+        change = (now - base) / base
+        if (-change if higher_is_better else change) > threshold:
+            regressions.append((name, metric, base, now))
+    return regressions
+
+
+def _print_table(results):
+    columns = ("seconds", "mb_s", "files_s", "p50_ms", "p90_ms", "p99_ms", "cpu_pct", "peak_rss_mb")
+    print(f"{'scenario':<8} " + " ".join(f"{c:>11}" for c in columns))
+    for name, metrics in results.items():
+        cells = ("" if metrics.get(c) is None else str(metrics[c]) for c in columns)
+        print(f"{name:<8} " + " ".join(f"{cell:>11}" for cell in cells))
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="LocalDrop transfer benchmarks")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma-separated subset")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per scenario; the median is reported")
+    parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "localdrop-bench"))
+    parser.add_argument("--peer", help="benchmark against `localdrop serve` on this IP or host name")
+    parser.add_argument("--wait", type=float, default=3.0, help="seconds to wait for the peer's discovery")
+    parser.add_argument("--port", type=int, help="transfer port, to run beside a live client (discovery uses the port below it)")
+    parser.add_argument("--engine", choices=("asyncio", "threads"), default="asyncio")
+    parser.add_argument("--streams", type=int, default=1)
+    parser.add_argument("--delta", action="store_true")
+    parser.add_argument("--compress", action="store_true")
+    parser.add_argument("--checksum", action="store_true", help="end-to-end checksums (compare against a run without)")
+    parser.add_argument("--write-behind", type=int, default=WRITE_BEHIND_DEPTH,
+                        help="receive buffers the disk may lag behind (0: write inline)")
+    parser.add_argument("--secret", help="encrypt with this pairing secret (compare against a run without it)")
+    parser.add_argument("--cipher", choices=sorted(CIPHERS), default=DEFAULT_CIPHER)
+    parser.add_argument("--huge-mb", type=int, default=1024)
+    parser.add_argument("--tiny-count", type=int, default=10000)
+    parser.add_argument("--tiny-size", type=int, default=2048, help="upper bound of a tiny file's size")
+    parser.add_argument("--mixed-mb", type=int, default=256)
+    parser.add_argument("--small-count", type=int, default=200)
+    parser.add_argument("--small-size", type=int, default=64 * 1024)
+    parser.add_argument("--texts", type=int, default=500)
+    parser.add_argument("--text-size", type=int, default=200)
+    parser.add_argument("--resume-mb", type=int, default=512)
+    parser.add_argument("--json", help="write the results here")
+    parser.add_argument("--save-baseline", help="store the results as a baseline")
+    parser.add_argument("--baseline", help="compare against this baseline")
+    parser.add_argument("--threshold", type=float, default=0.10, help="allowed regression of a primary metric")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    names = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        raise SystemExit(f"Unknown scenario(s): {', '.join(unknown)}")
+    if args.port:
+        network.TRANSFER_PORT = args.port
+        network.BROADCAST_PORT = args.port - 1
+
+    # Keep the protocol's log lines out of the report
+    report = sys.stdout
+    sys.stdout = sys.stderr
+    bench = Bench(args)
+    results = {}
+    try:
+        for name in names:
+            runs = [bench.run(name) for _ in range(max(1, args.repeat))]
+            results[name] = _median_run(runs)
+    finally:
+        bench.close()
+        sys.stdout = report
+
+    _print_table(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for name, metric, base, now in regressions:
+            print(f"REGRESSION {name}: {metric} {base} -> {now}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,157 @@
+"""Content index of received files, so a file that is already here is copied locally instead of sent.
+
+The receiver records every file that arrived verified under its root digest
+(integrity.py), with its path, size and mtime. When an incoming file is not
+here under its own name but an indexed file has the same size, the receiver
+asks the sender for the file's digest during resume negotiation. On a
+match it clones the indexed file into the .ldpart. The usual verified resume
+then compares the clone's chunk hashes with the sender's, so a stale index
+entry costs a local copy, never a wrong file. Nothing crosses the network
+but hashes.
+
+clone_file makes the copy as cheaply as the file system allows: a reflink
+(copy-on-write, Btrfs/XFS via FICLONE) shares the blocks, otherwise a plain
+copy. Hardlinks are never used. Received files are repaired, resumed and
+re-stamped in place, which would change the other name too.
+
+The index is an append-only file of JSON arrays, one per line:
+  [digest, path, size, mtime_ns]
+Loading skips a torn last line and entries whose file changed or vanished,
+and rewrites the file when they add up. Lookups stat the candidate again.
+"""
+import json
+import os
+import shutil
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+FICLONE = 0x40049409  # Linux ioctl: share the source's extents (Btrfs, XFS, bcachefs)
+
+
+def clone_file(src, dst):
+    """Copy src to dst, by reflink where the file system can. Returns "reflink" or "copy"."""
+    if fcntl is not None:
+        try:
+            with open(src, 'rb') as s, open(dst, 'wb') as d:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            return "reflink"
+        except OSError:
+            pass  # Different file systems, or no reflink support: fall back to copying
+    shutil.copyfile(src, dst)
+    return "copy"
+
+
+class ContentIndex:
+    def __init__(self, path):
+        self.path = path
+        self.digests = {}  # digest -> {path: (size, mtime_ns)}
+        self.paths = {}  # path -> digest
+        self.sizes = {}  # size -> number of indexed files of that size
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._load()
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def _load(self):
+        records = 0
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                lines = f.read().split('\n')
+        except OSError:
+            return
+        for line in lines:
+            if not line:
+                continue
+            try:
+                digest, path, size, mtime_ns = json.loads(line)
+            except (ValueError, TypeError):
+                continue  # A torn last line
+            records += 1
+            if self._current(path, size, mtime_ns):
+                self._put(digest, path, size, mtime_ns)
+        if records > len(self.paths) + 64:
+            self._rewrite()
+
+    def _rewrite(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            for digest, files in self.digests.items():
+                for path, (size, mtime_ns) in files.items():
+                    f.write(json.dumps([digest, path, size, mtime_ns]) + "\n")
+        os.replace(tmp, self.path)
+
+    @staticmethod
+    def _current(path, size, mtime_ns):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        return st.st_size == size and st.st_mtime_ns == mtime_ns
+
+    def _put(self, digest, path, size, mtime_ns):
+        self._remove(path)
+        self.digests.setdefault(digest, {})[path] = (size, mtime_ns)
+        self.paths[path] = digest
+        self.sizes[size] = self.sizes.get(size, 0) + 1
+
+    def _remove(self, path):
+        digest = self.paths.pop(path, None)
+        if digest is None:
+            return
+        size, _ = self.digests[digest].pop(path)
+        if not self.digests[digest]:
+            del self.digests[digest]
+        self.sizes[size] -= 1
+        if not self.sizes[size]:
+            del self.sizes[size]
+
+    def has_size(self, size):
+        """Whether any indexed file has this size (worth asking the sender for a digest)."""
+        return size in self.sizes
+
+    def add(self, digest, path):
+        """Index a file that just arrived verified (its final name and mtime already set)."""
+        path = os.path.abspath(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        with self.lock:
+            self._put(digest, path, st.st_size, st.st_mtime_ns)
+            self.file.write(json.dumps([digest, path, st.st_size, st.st_mtime_ns]) + "\n")
+            self.file.flush()
+
+    def find(self, digest, size):
+        """Path of an unchanged indexed file with this digest and size, or None. Stale entries are dropped."""
+        with self.lock:
+            candidates = list(self.digests.get(digest, {}).items())
+        for path, (indexed_size, mtime_ns) in candidates:
+            if indexed_size == size and self._current(path, size, mtime_ns):
+                return path
+            with self.lock:
+                if self.paths.get(path) == digest:
+                    self._remove(path)
+        return None
+
+    def materialize(self, digest, size, target):
+        """Clone an indexed copy of digest to target. Returns how ("reflink"/"copy"), or None without a match."""
+        source = self.find(digest, size) if digest else None
+        if source is None:
+            return None
+        try:
+            return clone_file(source, target)
+        except OSError as e:
+            print(f"Could not copy {source}: {e}")
+            try:
+                os.remove(target)
+            except OSError:
+                pass
+            return None
+
+    def close(self):
+        with self.lock:
+            self.file.close()
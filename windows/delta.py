@@ -0,0 +1,150 @@
+"""rsync-style delta encoding against a receiver's existing copy of a file.
+
+The receiver signs its copy in fixed blocks (adler32 weak sum + BLAKE2b strong
+digest). The sender walks its file and emits "copy block run" or "literal
+bytes" operations. Aligned blocks are matched with C-speed checksums. The
+per-byte rolling search only runs where a match was lost (an insertion or
+deletion shifted the data), retried with exponential backoff while misses
+continue. New content therefore costs about one checksum per block instead
+of one Python iteration per byte.
+"""
+import hashlib
+import zlib
+
+DELTA_MIN_BLOCK = 16 * 1024
+DELTA_MAX_BLOCK = 1024 * 1024
+READ_WINDOW = 8 * 1024 * 1024
+_ADLER_MOD = 65521
+
+
+def block_size_for(filesize):
+    """Roughly sqrt(filesize) like rsync, as a power of two within bounds."""
+    size = DELTA_MIN_BLOCK
+    while size < DELTA_MAX_BLOCK and size * size < filesize:
+        size *= 2
+    return size
+
+
+def strong_digest(block):
+    return hashlib.blake2b(block, digest_size=16).digest()
+
+
+def file_signatures(path, block_size):
+    """Weak and strong sums of every block of `path` (the last block may be short)."""
+    weak_sums = []
+    strong_sums = []
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            weak_sums.append(zlib.adler32(block))
+            strong_sums.append(strong_digest(block))
+    return weak_sums, strong_sums
+
+
+def _roll_search(buf, pos, block_size, index):
+    """Slide one byte at a time through the next two blocks looking for any signed block."""
+    limit = min(2 * block_size, len(buf) - pos - block_size)
+    if limit <= 0:
+        return None
+    weak = zlib.adler32(buf[pos:pos + block_size])
+    a = weak & 0xffff
+    b = weak >> 16
+    for k in range(1, limit + 1):
+        out_byte = buf[pos + k - 1]
+        in_byte = buf[pos + k - 1 + block_size]
+        a = (a - out_byte + in_byte) % _ADLER_MOD
+        b = (b - block_size * out_byte + a - 1) % _ADLER_MOD
+        candidates = index.get((b << 16) | a)
+        if candidates and strong_digest(buf[pos + k:pos + k + block_size]) in candidates:
+            return k
+    return None
+
+
+def encode_delta(path, block_size, weak_sums, strong_sums, on_copy, on_literal):
+    """Describe `path` as copies of signed blocks and literal data.
+
+    on_copy(first_block, count) is called for runs of consecutive blocks,
+    on_literal(data) for bytes the receiver does not have.
+    """
+    index = {}
+    for i, (weak, strong) in enumerate(zip(weak_sums, strong_sums)):
+        index.setdefault(weak, {}).setdefault(strong, i)
+
+    def lookup(block):
+        candidates = index.get(zlib.adler32(block))
+        return candidates.get(strong_digest(block)) if candidates else None
+
+    run = None  # [first_block, count] of the copy run being built
+
+    def flush_run():
+        nonlocal run
+        if run:
+            on_copy(run[0], run[1])
+            run = None
+
+    with open(path, 'rb') as f:
+        buf = f.read(READ_WINDOW)
+        eof = len(buf) < READ_WINDOW
+        pos = 0
+        literal_start = 0
+        misses = 0
+        next_search = 1  # Rolling resync on the 1st, 2nd, 4th, ... consecutive miss
+
+        while True:
+            if not eof and len(buf) - pos < 3 * block_size:
+                # Emit pending literal bytes before dropping them from the window
+                if literal_start < pos:
+                    flush_run()
+                    on_literal(buf[literal_start:pos])
+                more = f.read(READ_WINDOW)
+                eof = len(more) < READ_WINDOW
+                buf = buf[pos:] + more
+                pos = literal_start = 0
+
+            if len(buf) - pos < block_size:
+                break
+
+            block_index = lookup(buf[pos:pos + block_size])
+            if block_index is not None:
+                if literal_start < pos:
+                    flush_run()
+                    on_literal(buf[literal_start:pos])
+                if run and run[0] + run[1] == block_index:
+                    run[1] += 1
+                else:
+                    flush_run()
+                    run = [block_index, 1]
+                pos += block_size
+                literal_start = pos
+                misses = 0
+                next_search = 1
+                continue
+
+            misses += 1
+            if misses == next_search:
+                next_search *= 2
+                shift = _roll_search(buf, pos, block_size, index)
+                if shift is not None:
+                    pos += shift
+                    continue
+            pos += block_size
+
+        # Tail shorter than a block: it may still be the receiver's short last block
+        tail = buf[pos:]
+        block_index = lookup(tail) if tail else None
+        if block_index is not None:
+            if literal_start < pos:
+                flush_run()
+                on_literal(buf[literal_start:pos])
+            if run and run[0] + run[1] == block_index:
+                run[1] += 1
+            else:
+                flush_run()
+                run = [block_index, 1]
+            flush_run()
+        else:
+            flush_run()
+            if literal_start < len(buf):
+                on_literal(buf[literal_start:])
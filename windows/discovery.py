@@ -0,0 +1,192 @@
+"""Discovery beacons with cached interface state, adaptive pacing and startup queries.
+
+Local addresses and broadcast targets are cached and only rescanned when the
+interface list changes (checked every INTERFACE_CHECK seconds) or a send
+fails. The beacon bytes are built once. Beacons start every
+BEACON_MIN_INTERVAL and back off to BEACON_MAX_INTERVAL while nothing
+changes. Every beacon advertises the current interval so peers expire us
+after a few missed beacons. Legacy peers (no "interval" in their beacon) use
+a fixed 3 s timeout, so while any is present we never back off past 1 s.
+
+At startup a short burst of query beacons asks every peer to answer with a
+unicast beacon right away, so peers appear without waiting for their next
+periodic beacon. Repeated beacons from a known peer skip JSON parsing.
+
+Each instance puts a random id in its beacons and recognizes its own by it:
+two devices with the same name, OS and features send otherwise identical
+bytes.
+
+A client-only instance (the command-line send and text) takes no transfers
+and owns no discovery port, so it can run next to a serving instance on the
+same machine. It sends query beacons marked "client" from an ephemeral
+port, every CLIENT_QUERY_INTERVAL, because broadcasts to the discovery port
+never reach it. It learns about peers from their unicast answers. Peers
+answer such a query but do not list the client as a device.
+"""
+import json
+import secrets
+import socket
+import threading
+import time
+
+try:
+    import netifaces
+except ImportError:
+    netifaces = None
+
+BEACON_MIN_INTERVAL = 0.5
+BEACON_MAX_INTERVAL = 8.0
+LEGACY_MAX_INTERVAL = 1.0  # Peers without adaptive expiry drop us after 3 s
+INTERFACE_CHECK = 5.0
+QUERY_BURST = (0.0, 0.05, 0.15)  # Startup query offsets in seconds
+QUERY_REPLY_GAP = 0.04  # Answer one peer's queries at most this often
+EXPIRY_BEACONS = 3  # Missed beacons before a peer is dropped
+LEGACY_TIMEOUT = 3.0
+CLIENT_QUERY_INTERVAL = 1.0  # A client-only instance asks again this often; it hears no periodic beacons
+
+
+def _host_addresses():
+    try:
+        return {socket.gethostbyname(socket.gethostname())}
+    except OSError:
+        return set()
+
+
+class Discovery:
+    def __init__(self, port, device_name, features, os_name="windows", client=False):
+        self.port = port
+        self.id = secrets.token_hex(8)
+        self.base = {"host": device_name, "os": os_name, "features": list(features), "id": self.id}
+        if client:
+            self.base["client"] = True  # Asks, but takes no transfers: not a device to list
+        self.lock = threading.Lock()
+        self.interval = BEACON_MIN_INTERVAL
+        self.legacy_peers = 0
+        self.seen = {}  # ip -> raw bytes of the last beacon parsed from it
+        self.replied = {}  # ip -> time of our last query reply
+        self.local_ips = {'127.0.0.1'}
+        self.targets = []
+        self.iface_names = None
+        self.next_check = 0
+        self.beacons = {}
+        self.on_change = None  # Called when the beacon pace resets (e.g. to wake a sleeping sender)
+
+    # Outgoing
+
+    def beacon(self, query=False):
+        """Beacon bytes for the current interval, cached per (interval, query)."""
+        key = (self.interval, query)
+        message = self.beacons.get(key)
+        if message is None:
+            info = dict(self.base, interval=self.interval)
+            if query:
+                info["query"] = True
+            message = self.beacons[key] = json.dumps(info).encode('utf-8')
+        return message
+
+    def broadcast_targets(self):
+        now = time.time()
+        if now >= self.next_check:
+            self.next_check = now + INTERFACE_CHECK
+            names = netifaces.interfaces() if netifaces else []
+            if names != self.iface_names or not self.targets:
+                self.iface_names = names
+                self._scan_interfaces()
+        return self.targets
+
+    def send_failed(self):
+        """A send error usually means an interface went away; rescan on the next beacon."""
+        self.next_check = 0
+        self.iface_names = None
+
+    def _scan_interfaces(self):
+        # 1. Global broadcast (keeping it for good measure)
+        targets = [('<broadcast>', self.port)]
+        local_ips = {'127.0.0.1'} | _host_addresses()
+
+        # 2. All interface broadcasts
+        if netifaces:
+            for iface in self.iface_names:
+                try:
+                    addrs = netifaces.ifaddresses(iface)
+                    for addr in addrs.get(netifaces.AF_INET, []):
+                        if addr.get('addr'):
+                            local_ips.add(addr['addr'])
+                        broadcast = addr.get('broadcast')
+                        if broadcast and (broadcast, self.port) not in targets:
+                            targets.append((broadcast, self.port))
+                except Exception:
+                    pass
+        changed = self.targets and targets != self.targets
+        self.targets = targets
+        self.local_ips = local_ips
+        if changed:
+            self.reset_pace()
+
+    def next_interval(self):
+        """Seconds until the next beacon; doubles while nothing changes."""
+        with self.lock:
+            current = self.interval
+            ceiling = LEGACY_MAX_INTERVAL if self.legacy_peers else BEACON_MAX_INTERVAL
+            self.interval = min(max(self.interval * 2, BEACON_MIN_INTERVAL), ceiling)
+        return current
+
+    def reset_pace(self):
+        with self.lock:
+            self.interval = BEACON_MIN_INTERVAL
+        if self.on_change:
+            self.on_change()
+
+    # Incoming
+
+    def handle(self, data, addr):
+        """Parse one datagram.
+
+        Returns (ip, info, reply): info is None when the beacon repeats the
+        last one from that peer (only its liveness changes); reply is a
+        unicast beacon to send back for a query, or None. Own beacons and client
+        queries give ip None (the latter still with a reply).
+        """
+        ip = addr[0]
+        if ip in self.local_ips:
+            return None, None, None
+        if self.seen.get(ip) == data:
+            return ip, None, None
+
+        info = json.loads(data.decode('utf-8'))
+        if info.get("id") == self.id:
+            # Our own beacon from an address we did not know was ours
+            self.local_ips.add(ip)
+            return None, None, None
+        reply = None
+        if info.get("query"):
+            now = time.time()
+            if now - self.replied.get(ip, 0) >= QUERY_REPLY_GAP:
+                self.replied[ip] = now
+                reply = self.beacon()
+        else:
+            self.seen[ip] = data
+        if info.get("client"):
+            return None, None, reply
+        return ip, info, reply
+
+    def peer_added(self, info):
+        if "interval" not in info:
+            with self.lock:
+                self.legacy_peers += 1
+        # Someone new: beacon fast for a while so they learn about us quickly too
+        self.reset_pace()
+
+    def peer_removed(self, ip, legacy):
+        self.seen.pop(ip, None)
+        self.replied.pop(ip, None)
+        if legacy:
+            with self.lock:
+                self.legacy_peers = max(0, self.legacy_peers - 1)
+
+    @staticmethod
+    def timeout_for(interval):
+        """How long a peer beaconing every `interval` seconds may stay silent (None: legacy)."""
+        if interval is None:
+            return LEGACY_TIMEOUT
+        return max(LEGACY_TIMEOUT, EXPIRY_BEACONS * interval)
@@ -0,0 +1,204 @@
+"""asyncio engine behind NetworkManager.
+
+Discovery beacons, device pruning and accepting transfers share one event
+loop thread instead of one blocking thread each. Accepted connections are
+served by a fixed pool of session threads (the transfer protocol itself is
+blocking I/O with sendfile). At most max_sessions connections are served at
+once: the loop stops accepting while every slot is busy, so further senders
+wait in the kernel's accept backlog and TCP flow control holds them back.
+
+Every accepted socket gets a timeout (NetworkManager._prepare_accepted), so
+a port scanner or a sender that vanished mid-file frees its slot instead of
+holding it for good. A connection may also release its slot early and go on
+on its thread: the pool starts another thread when none is idle. Stripe
+connections do this once their transfer is known, so the streams of a
+striped transfer never wait behind slots held by its own control connection
+or other transfers. Text channels leave their slot once identified and are
+served on threads of their own (see NetworkManager._receive_file), so idle
+ones never hold transfers back.
+"""
+import asyncio
+import queue
+import threading
+import time
+
+from discovery import QUERY_BURST
+
+MAX_SESSIONS = 32
+
+
+class _BeaconProtocol(asyncio.DatagramProtocol):
+    def __init__(self, manager):
+        self.manager = manager
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            reply = self.manager._handle_beacon(data, addr)
+            if reply:
+                self.transport.sendto(reply, addr)
+        except Exception:
+            pass
+
+    def error_received(self, exc):
+        self.manager.discovery.send_failed()
+
+
+def _once(fn):
+    """fn, callable any number of times but run only on the first call."""
+    lock = threading.Lock()
+    called = []
+
+    def call():
+        with lock:
+            if called:
+                return
+            called.append(True)
+        fn()
+    return call
+
+
+class _SessionPool:
+    """Daemon threads serving accepted connections.
+
+    Daemon threads (unlike ThreadPoolExecutor's) never hold up interpreter
+    exit while a session is blocked on a silent peer. A job starts a thread
+    when no thread is idle, so a connection that released its slot early
+    never delays the next one; beyond `size` idle threads exit.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.jobs = queue.Queue()
+        self.lock = threading.Lock()
+        self.threads = 0
+        self.idle = 0
+
+    def submit(self, fn, args, on_done):
+        with self.lock:
+            if self.idle:
+                self.idle -= 1  # That thread takes this job
+            else:
+                self.threads += 1
+                threading.Thread(target=self._work, name=f"session_{self.threads}", daemon=True).start()
+        self.jobs.put((fn, args, on_done))
+
+    def shutdown(self):
+        with self.lock:
+            threads = self.threads
+        for _ in range(threads):
+            self.jobs.put(None)
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            fn, args, on_done = job
+            try:
+                fn(*args)
+            finally:
+                on_done()
+            with self.lock:
+                if self.idle >= self.size:
+                    self.threads -= 1
+                    break
+                self.idle += 1
+
+
+class AsyncEngine:
+    def __init__(self, manager, max_sessions=MAX_SESSIONS):
+        self.manager = manager
+        self.max_sessions = max(1, max_sessions)
+        self.loop = asyncio.new_event_loop()
+        self.sessions = _SessionPool(self.max_sessions)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.tasks = []
+        self.udp = None
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        if self.loop.is_running():
+            self.loop.call_soon_threadsafe(self._cancel)
+            self.thread.join(timeout=2)
+        self.sessions.shutdown()
+
+    def _cancel(self):
+        for task in self.tasks:
+            task.cancel()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._main())
+        finally:
+            self.loop.close()
+
+    async def _main(self):
+        self.udp, _ = await self.loop.create_datagram_endpoint(
+            lambda: _BeaconProtocol(self.manager), sock=self.manager.udp_sock)
+        self.tasks = [
+            asyncio.ensure_future(self._broadcast()),
+            asyncio.ensure_future(self._prune()),
+            asyncio.ensure_future(self._accept()),
+        ]
+        try:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        finally:
+            self.udp.close()
+
+    async def _broadcast(self):
+        discovery = self.manager.discovery
+        wake = asyncio.Event()
+        discovery.on_change = lambda: self.loop.call_soon_threadsafe(wake.set)
+
+        # Startup burst: ask everyone to answer now instead of at their next beacon
+        started = time.time()
+        for offset in QUERY_BURST:
+            await asyncio.sleep(max(0, started + offset - time.time()))
+            self.manager._send_beacon(discovery.beacon(query=True), self.udp.sendto)
+
+        while self.manager.running:
+            self.manager._send_beacon(discovery.beacon(), self.udp.sendto)
+            try:
+                await asyncio.wait_for(wake.wait(), discovery.next_interval())
+            except asyncio.TimeoutError:
+                pass
+            wake.clear()
+
+    async def _prune(self):
+        while self.manager.running:
+            await asyncio.sleep(self.manager._prune_delay())
+            self.manager._prune_once()
+
+    async def _accept(self):
+        sock = self.manager.tcp_sock
+        sock.setblocking(False)
+        slots = asyncio.Semaphore(self.max_sessions)
+        while self.manager.running:
+            # Backpressure: no accept until a session slot is free
+            await slots.acquire()
+            try:
+                conn, addr = await self.loop.sock_accept(sock)
+            except OSError as e:
+                slots.release()
+                if not self.manager.running:
+                    break
+                print(f"Accept error: {e}")
+                await asyncio.sleep(0.1)
+                continue
+
+            self.manager._prepare_accepted(conn)
+            release = _once(lambda: self._release(slots))
+            self.sessions.submit(self.manager._receive_file, (conn, addr[0], release), release)
+
+    def _release(self, slots):
+        # Called from a session thread; the loop may already be gone after stop()
+        try:
+            self.loop.call_soon_threadsafe(slots.release)
+        except RuntimeError:
+            pass
@@ -0,0 +1,180 @@
+"""Sending the same files to many devices at once, reading each chunk once.
+
+FanOut runs one BatchSender per peer, so every peer keeps its own
+connection, confirmation, resume offset, retries and progress. Files of
+SHARED_MIN_SIZE and up are not sendfile()d per peer. They are read through
+a ChunkCache: the first peer to need a chunk reads it from disk, and
+the others send the same bytes from memory. The cache holds at most
+FANOUT_CACHE_BYTES. A peer that has fallen further behind than that finds
+its chunk evicted and reads it again itself, so a slow device costs one
+extra read but never holds back the fast ones. The cache also keeps each
+file's chunk digests, so the end-to-end check does not read the file again.
+
+Small files still go out as archive frames per peer. They are read once
+per peer, but by then they sit in the page cache.
+"""
+import collections
+import threading
+import uuid
+
+from integrity import HASH_CHUNK_SIZE, chunk_count, leaf_digest, root_digest
+from network import BatchSender
+
+FANOUT_CACHE_BYTES = 64 * 1024 * 1024
+SHARED_MIN_SIZE = 4 * 1024 * 1024  # Smaller files are not worth sharing
+
+
+class SharedSource:
+    """One file as seen through a ChunkCache. Chunks are HASH_CHUNK_SIZE, aligned with the digest leaves."""
+
+    chunk_size = HASH_CHUNK_SIZE
+
+    def __init__(self, cache, path, filesize):
+        self.cache = cache
+        self.path = path
+        self.filesize = filesize
+        self.leaves = {}  # Chunk index -> leaf digest, filled as chunks are first read
+        self.file = open(path, 'rb')
+        self.file_lock = threading.Lock()
+
+    def chunk(self, index):
+        return self.cache._get(self, index)
+
+    def _read(self, index):
+        with self.file_lock:
+            self.file.seek(index * self.chunk_size)
+            data = self.file.read(self.chunk_size)
+        if index not in self.leaves:
+            self.leaves[index] = leaf_digest(data)
+        return data
+
+    def result(self):
+        """Root digest of the whole file (FileDigest's interface). Unread chunks are read here."""
+        for index in range(chunk_count(self.filesize)):
+            if index not in self.leaves:
+                self.chunk(index)
+        return root_digest([self.leaves[i] for i in range(chunk_count(self.filesize))], self.filesize)
+
+    def close(self):
+        self.file.close()
+
+
+class ChunkCache:
+    """Bounded LRU of file chunks shared by the senders of a fan-out."""
+
+    def __init__(self, budget=FANOUT_CACHE_BYTES):
+        self.budget = budget
+        self.size = 0
+        self.chunks = collections.OrderedDict()  # (path, index) -> bytes
+        self.loading = {}  # (path, index) -> Event while one sender reads it
+        self.sources = {}
+        self.lock = threading.Lock()
+        self.read_bytes = 0  # From disk; equals the shared files' size when every peer kept up
+
+    def source(self, path, filesize):
+        with self.lock:
+            source = self.sources.get(path)
+            if source is None or source.filesize != filesize:
+                source = self.sources[path] = SharedSource(self, path, filesize)
+            return source
+
+    def _get(self, source, index):
+        key = (source.path, index)
+        while True:
+            with self.lock:
+                data = self.chunks.get(key)
+                if data is not None:
+                    self.chunks.move_to_end(key)
+                    return data
+                pending = self.loading.get(key)
+                if pending is None:
+                    pending = self.loading[key] = threading.Event()
+                    break
+            # Another sender is reading this chunk right now
+            pending.wait()
+
+        try:
+            data = source._read(index)
+            with self.lock:
+                self.read_bytes += len(data)
+                self.chunks[key] = data
+                self.size += len(data)
+                while self.size > self.budget and len(self.chunks) > 1:
+                    _, old = self.chunks.popitem(last=False)
+                    self.size -= len(old)
+        finally:
+            # Wake the waiters even if the read failed: one of them then tries it again
+            with self.lock:
+                del self.loading[key]
+            pending.set()
+        return data
+
+    def close(self):
+        with self.lock:
+            sources = list(self.sources.values())
+            self.sources.clear()
+            self.chunks.clear()
+            self.size = 0
+        for source in sources:
+            source.close()
+
+
+class FanOut:
+    """Sends one set of (abs_path, remote_filename, size) entries to several peers concurrently.
+
+    on_progress(ip, filename, current, total, mode, speed, eta) reports each
+    peer's batch total separately. After send(), results maps each IP to
+    True/False and senders holds the per-peer BatchSenders (failures etc.).
+    """
+
+    def __init__(self, manager, ips, stop_on_failure=False, on_progress=None, cache_bytes=FANOUT_CACHE_BYTES,
+                 resume_key=None):
+        self.manager = manager
+        self.ips = list(dict.fromkeys(ips))
+        self.stop_on_failure = stop_on_failure
+        self.on_progress = on_progress
+        self.cache = ChunkCache(cache_bytes)
+        self.resume_key = resume_key  # Journals each peer's batch (see BatchSender)
+        self.senders = {}
+        self.results = {}
+
+    def send(self, entries, archive_label=None):
+        """Returns True if every peer received everything."""
+        group_size = sum(entry[2] for entry in entries)
+        for ip in self.ips:
+            self.senders[ip] = BatchSender(self.manager, ip, group_id=str(uuid.uuid4()), group_size=group_size,
+                                           stop_on_failure=self.stop_on_failure,
+                                           on_progress=self._progress_for(ip), shared=self._shared,
+                                           resume_key=self.resume_key)
+        threads = [
+            threading.Thread(target=self._send_to, args=(ip, entries, archive_label), daemon=True)
+            for ip in self.ips
+        ]
+        try:
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            self.cache.close()
+        return bool(self.results) and all(self.results.values())
+
+    def _send_to(self, ip, entries, archive_label):
+        try:
+            self.results[ip] = self.senders[ip].send(entries, archive_label=archive_label)
+        except Exception as e:
+            print(f"Fan-out to {ip} failed: {e}")
+            self.results[ip] = False
+
+    def _shared(self, abs_path, size):
+        if size < SHARED_MIN_SIZE:
+            return None
+        try:
+            return self.cache.source(abs_path, size)
+        except OSError:
+            return None  # The sender reports the unreadable file
+
+    def _progress_for(self, ip):
+        if self.on_progress is None:
+            return None
+        return lambda *args: self.on_progress(ip, *args)
@@ -8,12 +8,20 @@ from tkinter import filedialog, messagebox, PhotoImage
 import shutil
 import tempfile
 import uuid # For Group ID
-from network import NetworkManager
+from network import NetworkManager, BatchSender
+from fanout import FanOut
+from scanner import FolderScan, ScanCache
+from registry import REMOVED
 
 # Configuration
 ctk.set_appearance_mode("Dark")
 ctk.set_default_color_theme("blue")
 
+SCAN_WORKERS = 4  # Parallel directory listing; pays off on SSDs and network shares
+# Journals of unfinished batches, so a folder send interrupted by a restart resumes where it stopped
+JOURNAL_DIR = os.path.join(os.getenv('APPDATA') or os.path.expanduser("~"), "LocalDrop", "journal")
+CONTENT_INDEX = os.path.join(os.getenv('APPDATA') or os.path.expanduser("~"), "LocalDrop", "content-index.jsonl")
+
 # OLED Colors
 COLOR_BG = "#000000"
 COLOR_CARD = "#111111" 
@@ -55,13 +63,20 @@ class App(ctk.CTk):
         self.device_name = os.getenv('COMPUTERNAME', 'Windows PC')
         self.network = NetworkManager(
             self.device_name, 
-            on_device_found=self.update_device_list,
             on_transfer_progress=self.update_progress,
             on_confirmation=self.confirm_transfer,
-            on_text_received=self.show_text_received
+            on_text_received=self.show_text_received,
+            journal_dir=JOURNAL_DIR,
+            content_index=CONTENT_INDEX,
+            secret=os.getenv('LOCALDROP_SECRET')  # Pairing secret: encrypt transfers, refuse cleartext
         )
         
+        # Directory listings of folders sent this session, so sending one again starts at once
+        self.scan_cache = ScanCache()
+
         self.setup_ui()
+        # Registry events arrive on network threads; Tk is only touched from the main loop
+        self.network.found_devices.subscribe(lambda event, device: self.after(0, self.on_device_event, event, device))
         self.network.start()
         
         self.protocol("WM_DELETE_WINDOW", self.on_closing)
@@ -92,8 +107,20 @@ class App(ctk.CTk):
         self.main_frame.pack(fill="both", expand=True, padx=20)
         
         # Available Devices
-        self.label_avail = ctk.CTkLabel(self.main_frame, text="Available Devices", font=ctk.CTkFont(size=14, weight="bold"), text_color="gray")
-        self.label_avail.pack(anchor="w", pady=(0, 10))
+        avail_row = ctk.CTkFrame(self.main_frame, fg_color="transparent")
+        avail_row.pack(fill="x", pady=(0, 10))
+        self.label_avail = ctk.CTkLabel(avail_row, text="Available Devices", font=ctk.CTkFont(size=14, weight="bold"), text_color="gray")
+        self.label_avail.pack(side="left")
+
+        # Fan-out: the same files to every device, each chunk read from disk once
+        btn_all_folder = ctk.CTkButton(avail_row, text="Folder to All", width=80, fg_color="#333333", hover_color="#444444",
+                                       command=lambda: self.select_and_send_to_all(folder=True))
+        btn_all_folder.pack(side="right", padx=5)
+        btn_all_files = ctk.CTkButton(avail_row, text="Files to All", width=80, fg_color="#333333", hover_color="#444444",
+                                      command=lambda: self.select_and_send_to_all(folder=False))
+        btn_all_files.pack(side="right", padx=5)
+        self.fanout_progress = {}
+        self.receiving = False  # The progress shown is an incoming transfer: Cancel stops only that
         
         self.devices_frame = ctk.CTkScrollableFrame(self.main_frame, fg_color=COLOR_BG)
         self.devices_frame.pack(fill="both", expand=True)
@@ -115,24 +142,14 @@ class App(ctk.CTk):
         self.action_frame.pack(fill="x", padx=20, pady=(0, 10))
         # Buttons like Cancel/Copy will appear here
 
-        self.after(2000, self.refresh_devices_loop)
-
-    def refresh_devices_loop(self):
-        # Sync UI with network state
-        current_ips = set(self.network.found_devices.keys())
-        ui_ips = set(self.device_cards.keys())
-        
-        # Remove offline
-        for ip in ui_ips - current_ips:
-            if ip in self.device_cards:
-                self.device_cards[ip].destroy()
-                del self.device_cards[ip]
-                
-        # Add new (update_device_list handles this usually, but strictly solely relying on callback might miss pruning)
-        for ip in current_ips - ui_ips:
-             self.update_device_list(self.network.found_devices[ip])
-             
-        self.after(2000, self.refresh_devices_loop)
+    def on_device_event(self, event, device):
+        if event == REMOVED:
+            card = self.device_cards.pop(device.ip, None)
+            if card:
+                card.destroy()
+        elif device.ip in self.network.found_devices:
+            # Skip stale "added" events for devices that expired before this ran
+            self.update_device_list(device)
 
     def update_device_list(self, device):
         if device.ip in self.device_cards:
@@ -201,55 +218,41 @@ class App(ctk.CTk):
             threading.Thread(target=self.send_multiple_files, args=(ip, filepaths)).start()
 
     def send_multiple_files(self, ip, filepaths):
-        """Send multiple files sequentially"""
+        """Send multiple files as one batch, several in flight at once"""
         self.network.reset_cancel_flag()
         total_files = len(filepaths)
         
         # Calculate Group Size
+        entries = []
         total_size = 0
         for fp in filepaths:
             try:
-                total_size += os.path.getsize(fp)
-            except: pass
+                file_size = os.path.getsize(fp)
+            except OSError:
+                continue
+            entries.append((fp, os.path.basename(fp), file_size))
+            total_size += file_size
             
         group_id = str(uuid.uuid4())
-        
-        self.current_batch_total_size = total_size
-        self.current_batch_sent_base = 0
-        self.current_batch_start_time = time.time()
-        
-        original_callback = self.network.on_transfer_progress
-        self.network.on_transfer_progress = self.update_batch_progress
 
-        for i, filepath in enumerate(filepaths, 1):
+        # If one fails in a group we stop: users treat a multi-select as a "package".
+        batch = BatchSender(self.network, ip, group_id=group_id, group_size=total_size,
+                            stop_on_failure=True, on_progress=self.update_batch_progress)
+        batch.send(entries)
+
+        def finish():
             if self.network.cancel_requested:
-                 break
-            
-            self.status_label.configure(text=f"Sending {i}/{total_files}: {os.path.basename(filepath)}...")
-            
-            file_size = os.path.getsize(filepath)
-            success = self.network.send_file(ip, filepath, group_id=group_id, group_size=total_size)
-            
-            if success:
-                 self.current_batch_sent_base += file_size
+                 self.status_label.configure(text="Transfer Cancelled")
+                 self.hide_controls()
+            elif batch.failures:
+                 self.status_label.configure(text=f"Failed to send {os.path.basename(batch.failures[0][0])}")
+                 self.hide_controls()
             else:
-                if self.network.cancel_requested:
-                     self.status_label.configure(text="Transfer Cancelled")
-                     break
-                self.status_label.configure(text=f"Failed to send {os.path.basename(filepath)}")
-                # Continue?? Protocol says separate files are separate unless grouped. 
-                # If one fails in a group, maybe we should stop?
-                # User preference usually is reliability. Let's stop on failure if it's a "package".
-                break
-                
-        if not self.network.cancel_requested:
-             self.status_label.configure(text=f"Sent {total_files} file(s)!")
-             self.progress_bar.set(1)
-             self.action_frame.after(1000, self.hide_controls) # Auto hide after success
-        else:
-             self.hide_controls()
-        
-        self.network.on_transfer_progress = original_callback
+                 self.status_label.configure(text=f"Sent {total_files} file(s)!")
+                 self.progress_bar.set(1)
+                 self.action_frame.after(1000, self.hide_controls) # Auto hide after success
+
+        self.after(0, finish)
 
 
     def select_folder_and_send(self, ip):
@@ -262,98 +265,113 @@ class App(ctk.CTk):
         try:
             self.network.reset_cancel_flag()
             
-            # 1. Calculate Total Size and File Count
-            total_size = 0
-            total_files = 0
-            files_to_send = []
-            folder_basename = os.path.basename(folderpath)
-
-            for root, dirs, files in os.walk(folderpath):
-                if self.network.cancel_requested: break
-                for file in files:
-                    total_files += 1
-                    abs_path = os.path.join(root, file)
-                    file_size = os.path.getsize(abs_path)
-                    total_size += file_size
-
-                    rel_path = os.path.relpath(abs_path, folderpath)
-                    remote_filename = os.path.join(folder_basename, rel_path).replace("\\", "/")
-                    files_to_send.append((abs_path, remote_filename, file_size))
-            
-            if self.network.cancel_requested:
-                 self.status_label.configure(text="Transfer Cancelled")
-                 self.hide_controls()
-                 return
-
+            # 1. Scan in the background; the batch total grows as files are found
+            scan = FolderScan(folderpath, cache=self.scan_cache, workers=SCAN_WORKERS)
+            folder_basename = scan.label
             group_id = str(uuid.uuid4())
+
+            # 2. Send while scanning, with a pool of sessions; small files are packed into archive frames
+            batch = BatchSender(self.network, ip, group_id=group_id,
+                                stop_on_failure=False, on_progress=self.update_batch_progress,
+                                resume_key=scan.root)
+            batch.send(scan, archive_label=folder_basename)
+            total_files = scan.count
+
+            def finish():
+                if self.network.cancel_requested:
+                    self.status_label.configure(text="Transfer Cancelled")
+                    self.hide_controls()
+                elif batch.failures:
+                    self.status_label.configure(text=f"Folder Sent with {len(batch.failures)} failed file(s)")
+                    self.hide_controls()
+                else:
+                    self.status_label.configure(text=f"Folder Sent! ({total_files} files)")
+                    self.progress_bar.set(1)
+                    self.action_frame.after(1000, self.hide_controls)
+
+            self.after(0, finish)
             
-            self.current_batch_total_size = total_size
-            self.current_batch_sent_base = 0
-            self.current_batch_start_time = time.time()
-            
-            # 2. Swap Progress Callback
-            original_callback = self.network.on_transfer_progress
-            self.network.on_transfer_progress = self.update_batch_progress
-            
-            files_sent = 0
-            
-            for abs_path, remote_filename, file_size in files_to_send:
-                if self.network.cancel_requested: break
+        except Exception as e:
+            print(f"Folder send error: {e}")
+            message = f"Error: {e}"
+            self.after(0, lambda: (self.status_label.configure(text=message), self.hide_controls()))
 
-                files_sent += 1
+    def select_and_send_to_all(self, folder):
+        ips = [device.ip for device in self.network.found_devices.snapshot()]
+        if not ips:
+            self.status_label.configure(text="No devices found")
+            return
+        if folder:
+            folderpath = filedialog.askdirectory()
+            paths = [folderpath] if folderpath else []
+        else:
+            paths = list(filedialog.askopenfilenames(title="Select Files to Send"))
+        if paths:
+            self.status_label.configure(text=f"Sending to {len(ips)} devices...")
+            threading.Thread(target=self.send_to_all, args=(ips, paths, folder)).start()
 
-                # status_label updated by update_batch_progress usually,
-                # but we can set context here too if needed.
+    def send_to_all(self, ips, paths, folder):
+        try:
+            self.network.reset_cancel_flag()
+            entries = []
+            for path in paths:
+                if folder:
+                    # Every peer is offered the same list, so the scan is completed first
+                    entries.extend(FolderScan(path, cache=self.scan_cache, workers=SCAN_WORKERS))
+                else:
+                    entries.append((path, os.path.basename(path), os.path.getsize(path)))
 
-                success = self.network.send_file(ip, abs_path, remote_filename=remote_filename, group_id=group_id, group_size=total_size)
+            self.fanout_progress = {ip: 0 for ip in ips}
+            fan = FanOut(self.network, ips, on_progress=self.update_fanout_progress,
+                         resume_key="\n".join(os.path.abspath(path) for path in paths))
+            fan.send(entries, archive_label=os.path.basename(paths[0]) if folder else None)
+            failed = [ip for ip in ips if not fan.results.get(ip)]
 
-                if success:
-                    self.current_batch_sent_base += file_size
+            def finish():
+                if self.network.cancel_requested:
+                    self.status_label.configure(text="Transfer Cancelled")
+                elif failed:
+                    self.status_label.configure(text=f"Sent to {len(ips) - len(failed)} of {len(ips)} devices (failed: {', '.join(failed)})")
                 else:
-                    if self.network.cancel_requested:
-                            self.status_label.configure(text="Transfer Cancelled")
-                            self.hide_controls()
-                            self.network.on_transfer_progress = original_callback
-                            return
-                    print(f"Failed to send {remote_filename}")
-            
-            if not self.network.cancel_requested:
-                self.status_label.configure(text=f"Folder Sent! ({total_files} files)")
-                self.progress_bar.set(1)
-                self.action_frame.after(1000, self.hide_controls)
-            else:
+                    self.status_label.configure(text=f"Sent to all {len(ips)} devices!")
+                    self.progress_bar.set(1)
                 self.hide_controls()
-            
-            self.network.on_transfer_progress = original_callback
-            
+
+            self.after(0, finish)
         except Exception as e:
-            print(f"Folder send error: {e}")
-            self.status_label.configure(text=f"Error: {e}")
-            if hasattr(self, 'network'):
-                self.network.on_transfer_progress = getattr(self, 'original_callback', self.network.on_transfer_progress)
-            self.hide_controls()
+            print(f"Fan-out error: {e}")
+            message = f"Error: {e}"
+            self.after(0, lambda: (self.status_label.configure(text=message), self.hide_controls()))
+
+    def update_fanout_progress(self, ip, filename, current, total, mode, speed, eta):
+        # Each device progresses on its own; the bar follows the slowest one
+        self.fanout_progress[ip] = current / total if total > 0 else 1
+        slowest = min(self.fanout_progress.values())
+        done = sum(1 for value in self.fanout_progress.values() if value >= 1)
+        status_text = f"Sending to {len(self.fanout_progress)} devices: {done} done • slowest {int(slowest*100)}%"
+        self.after(0, self._apply_fanout_progress, slowest, status_text)
+
+    def _apply_fanout_progress(self, progress, status_text):
+        self.receiving = False
+        self.progress_bar.set(progress)
+        self.status_label.configure(text=status_text)
+        if not self.action_frame.winfo_children():
+            self.show_pause_cancel()
 
     def update_batch_progress(self, filename, current, total, mode, speed, eta):
-        # Calculate Total Progress
-        total_current = self.current_batch_sent_base + current
-        total_percentage = total_current / self.current_batch_total_size if self.current_batch_total_size > 0 else 0
-        
-        # Calculate Total Speed / ETA
-        elapsed = time.time() - self.current_batch_start_time
-        if elapsed > 0:
-            total_speed = total_current / elapsed
-            total_eta = (self.current_batch_total_size - total_current) / total_speed if total_speed > 0 else 0
-        else:
-            total_speed = 0
-            total_eta = 0
-            
-        # Update UI
-        self.progress_bar.set(total_percentage)
+        # BatchSender reports merged totals for the whole batch, from its sampler thread
+        total_percentage = current / total if total > 0 else 0
         
-        speed_mbps = (total_speed * 8) / (1024 * 1024)
-        eta_str = f"{int(total_eta)}s" if total_eta < 60 else f"{int(total_eta//60)}m {int(total_eta%60)}s"
+        speed_mbps = (speed * 8) / (1024 * 1024)
+        eta_str = f"{int(eta)}s" if eta < 60 else f"{int(eta//60)}m {int(eta%60)}s"
         
         status_text = f"Sending Batch: {int(total_percentage*100)}% • {speed_mbps:.1f} Mbps • {eta_str}"
+        # Tk only from its own thread: one event per sample, as in update_progress
+        self.after(0, self._apply_batch_progress, total_percentage, status_text)
+
+    def _apply_batch_progress(self, progress, status_text):
+        self.receiving = False
+        self.progress_bar.set(progress)
         self.status_label.configure(text=status_text)
         
         # Ensure Cancel button is visible
@@ -378,20 +396,25 @@ class App(ctk.CTk):
         self.after(0, finish)
 
     def update_progress(self, filename, current, total, mode, speed=0, eta=0):
-        # Throttle UI updates handled in network layer usually, but good to check
-        progress = current / total
+        # Called by the network layer's progress sampler (~10 Hz, only when the count moved)
+        progress = current / total if total else 1
         
         speed_mbps = (speed * 8) / (1024 * 1024)
         eta_str = f"{int(eta)}s" if eta < 60 else f"{int(eta//60)}m {int(eta%60)}s"
         status_text = f"{mode.title()}: {int(progress*100)}% • {speed_mbps:.1f} Mbps • {eta_str}"
         
-        self.after(0, lambda: self.progress_bar.set(progress))
-        self.after(0, lambda: self.status_label.configure(text=status_text))
-        
-        if current < total:
-             self.after(0, self.show_pause_cancel)
+        # One Tk event per sample instead of one per widget
+        self.after(0, self._apply_progress, filename, mode, progress, status_text, current < total)
+
+    def _apply_progress(self, filename, mode, progress, status_text, running):
+        self.receiving = mode.lower().startswith("receiving")
+        self.progress_bar.set(progress)
+        self.status_label.configure(text=status_text)
+        if running:
+             if not self.action_frame.winfo_children():
+                  self.show_pause_cancel()
         else:
-             self.after(0, lambda: self.transfer_complete(filename, mode))
+             self.transfer_complete(filename, mode)
 
     def show_pause_cancel(self):
         for widget in self.action_frame.winfo_children(): widget.destroy()
@@ -400,9 +423,36 @@ class App(ctk.CTk):
         btn.pack()
         
     def on_cancel(self):
-        self.network.cancel_transfer()
+        if not self.receiving:
+            self.network.cancel_sending()
+            self.status_label.configure(text="Cancelling...")
+            # Controls hidden when loop detects cancellation
+            return
+        # Incoming: stop one sender's transfer, never our own sends or other senders
+        sessions = [session for session in self.network.inbound.snapshot() if session.refs and not session.cancelled]
+        if len(sessions) > 1:
+            self.show_incoming_cancel(sessions)
+            return
+        for session in sessions:
+            self.network.cancel_incoming(session.sender_ip, session.group_id)
         self.status_label.configure(text="Cancelling...")
-        # Controls hidden when loop detects cancellation
+
+    def show_incoming_cancel(self, sessions):
+        """Several devices are sending to us: one Cancel button per transfer."""
+        for widget in self.action_frame.winfo_children(): widget.destroy()
+
+        for session in sessions:
+            device = self.network.found_devices.get(session.sender_ip)
+            name = device.hostname if device else session.sender_ip
+
+            def cancel(session=session):
+                self.network.cancel_incoming(session.sender_ip, session.group_id)
+                self.hide_controls()
+                self.status_label.configure(text="Cancelling...")
+
+            btn = ctk.CTkButton(self.action_frame, text=f"Cancel from {name}", fg_color=COLOR_ERROR, height=24,
+                                command=cancel)
+            btn.pack(side="left", padx=2)
 
     def transfer_complete(self, filename, mode):
         self.hide_controls()
@@ -0,0 +1,166 @@
+"""Receive-side state of each incoming transfer: acceptance, progress, cancellation.
+
+Frames of one batch (same sender, same group_id) share an InboundSession,
+however many connections they arrive on. An ungrouped file gets a session
+of its own. Two devices sending at once therefore never share a batch
+counter or an auto-accept decision, and cancelling one of them leaves the
+other running.
+
+A session is dropped when its last connection ends and there is nothing
+left to remember: the file was ungrouped, or its batch completed. Refused
+and cancelled batches are remembered for INBOUND_IDLE, so a sender's
+remaining frames are turned away without asking again. A sender that starts
+the batch over (its first manifest says so) is asked again instead.
+
+A batch streamed from a running folder scan announces its size wave by
+wave: each manifest carries the running group_size and growing=True, and
+the last one growing=False. The session's total grows with it and the
+batch is not complete while more is announced.
+"""
+import contextlib
+import threading
+import time
+
+from progress import end_counter, finish, track
+
+INBOUND_IDLE = 600.0  # Seconds an idle, unfinished batch keeps its state
+
+
+class InboundSession:
+    def __init__(self, sender_ip, group_id, group_size, on_progress):
+        self.sender_ip = sender_ip
+        self.group_id = group_id
+        self.group_size = group_size
+        self.on_progress = on_progress
+        self.growing = False  # A streamed batch whose final size is not known yet
+        self.accepted = None  # None until decided, then True/False for every frame of the batch
+        self.judged_size = None  # group_size the accept policy last approved
+        self.journal = None  # journal.BatchJournal of an accepted batch, when journals are enabled
+        self.cancelled = False
+        self.restarted = False  # Started over after a cancel or refusal: ask even when a journal exists
+        self.decision_lock = threading.Lock()  # Concurrent frames of one batch share a single prompt
+        self.refs = 0
+        self.last_active = time.monotonic()
+        # A batch reports one merged total
+        self.stats = track(group_id, group_size, "Receiving Batch", on_progress) if group_id and group_size else None
+
+    @property
+    def complete(self):
+        return self.stats is not None and not self.growing and self.stats.current() >= self.stats.total
+
+    def grow(self, group_size, growing):
+        """A streamed batch announced its running total (and whether more is coming)."""
+        self.growing = bool(growing)
+        if not self.group_id or not group_size or group_size < (self.group_size or 0):
+            return
+        self.group_size = group_size
+        if self.stats is None:
+            self.stats = track(self.group_id, group_size, "Receiving Batch", self.on_progress)
+        else:
+            self.stats.total = group_size
+
+    def counter(self, filename, filesize, done=0):
+        """Progress counter for one incoming file: a part of the batch, or its own stats."""
+        if self.stats is None:
+            return track(filename, filesize, "Receiving", self.on_progress, done)
+        self.stats.name = filename
+        return self.stats.part(done)
+
+    def end_counter(self, counter, keep):
+        end_counter(counter, keep)
+        if self.complete:
+            finish(self.stats)  # Batch complete: deliver the final 100% now
+
+    def record_done(self, name, size, mtime):
+        if self.journal is not None:
+            self.journal.record_done(name, size, mtime)
+
+    def record_partial(self, name, offset):
+        if self.journal is not None:
+            self.journal.record_partial(name, offset)
+
+    def close_journal(self):
+        """A completed batch forgets its journal; an unfinished one keeps it for a restart."""
+        if self.journal is not None:
+            if self.complete:
+                self.journal.discard()
+            else:
+                self.journal.close()
+            self.journal = None
+
+    def add_skipped(self, count):
+        """Bytes the receiver already had (manifest skips) count as done."""
+        if self.stats is not None:
+            self.stats.add(count)
+
+    def cancel(self):
+        self.cancelled = True
+
+    def restart(self):
+        """The sender started this batch over: a cancel or refusal of the earlier attempt no longer applies."""
+        with self.decision_lock:
+            if self.cancelled or self.accepted is False:
+                self.cancelled = False
+                self.accepted = None
+                self.restarted = True
+
+
+class InboundRegistry:
+    def __init__(self):
+        self.sessions = {}  # (sender_ip, group_id) -> InboundSession; ungrouped ones by id()
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def session(self, sender_ip, group_id=None, group_size=None, on_progress=None, growing=None):
+        """Hold the sender's session for one frame or connection. on_progress is used if it has to be created.
+
+        growing is set by the manifests of a streamed batch (see InboundSession.grow).
+        """
+        now = time.monotonic()
+        with self.lock:
+            self._prune(now)
+            key = (sender_ip, group_id) if group_id else None
+            session = self.sessions.get(key) if key else None
+            if session is None:
+                session = InboundSession(sender_ip, group_id, group_size, on_progress)
+                self.sessions[key or id(session)] = session
+            if growing is not None:
+                session.grow(group_size, growing)
+            session.refs += 1
+        try:
+            yield session
+        finally:
+            with self.lock:
+                session.refs -= 1
+                session.last_active = time.monotonic()
+                if session.refs == 0 and (session.group_id is None or session.complete):
+                    self._drop(session)
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.sessions.values())
+
+    def cancel(self, sender_ip=None, group_id=None):
+        """Cancel the matching sessions (all by default). Returns how many were cancelled."""
+        cancelled = 0
+        with self.lock:
+            for session in self.sessions.values():
+                if sender_ip not in (None, session.sender_ip) or group_id not in (None, session.group_id):
+                    continue
+                if not session.cancelled:
+                    session.cancel()
+                    cancelled += 1
+        return cancelled
+
+    def _drop(self, session):
+        key = (session.sender_ip, session.group_id) if session.group_id else id(session)
+        if self.sessions.get(key) is session:
+            del self.sessions[key]
+        session.close_journal()
+        if session.stats is not None:
+            finish(session.stats)
+
+    def _prune(self, now):
+        for session in list(self.sessions.values()):
+            if session.refs == 0 and now - session.last_active > INBOUND_IDLE:
+                self._drop(session)
@@ -0,0 +1,121 @@
+"""Chunk-level BLAKE2 manifests used for verified resume and end-to-end checks.
+
+A file is split into HASH_CHUNK_SIZE chunks, each hashed to a short leaf
+digest. The root digest covers every leaf plus the file size, so both sides
+can agree on a whole file while only re-sending the chunks whose leaves differ.
+"""
+import hashlib
+import queue
+import threading
+
+HASH_CHUNK_SIZE = 1024 * 1024
+LEAF_DIGEST_SIZE = 16
+HASH_QUEUE_DEPTH = 64  # Chunks buffered between the recv loop and the hasher
+
+
+def chunk_count(filesize, chunk_size=HASH_CHUNK_SIZE):
+    return -(-filesize // chunk_size)
+
+
+def leaf_digest(data):
+    return hashlib.blake2b(data, digest_size=LEAF_DIGEST_SIZE).digest()
+
+
+def root_digest(leaves, filesize):
+    h = hashlib.blake2b(digest_size=32)
+    h.update(filesize.to_bytes(8, 'big'))
+    for leaf in leaves:
+        h.update(leaf)
+    return h.hexdigest()
+
+
+def hash_file_chunks(path, start_index=0, count=None, chunk_size=HASH_CHUNK_SIZE):
+    """Leaf digests of `count` chunks (or up to EOF) starting at chunk `start_index`."""
+    leaves = []
+    with open(path, 'rb') as f:
+        f.seek(start_index * chunk_size)
+        while count is None or len(leaves) < count:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            leaves.append(leaf_digest(data))
+    return leaves
+
+
+class FileDigest:
+    """Computes a file's root digest on a background thread.
+
+    Leaves already hashed for resume verification are reused, so the sender
+    only reads the rest of the file once, alongside sendfile.
+    """
+
+    def __init__(self, path, filesize, known_leaves=(), chunk_size=HASH_CHUNK_SIZE):
+        self.path = path
+        self.filesize = filesize
+        self.leaves = list(known_leaves)
+        self.chunk_size = chunk_size
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            self.leaves += hash_file_chunks(self.path, start_index=len(self.leaves), chunk_size=self.chunk_size)
+        except OSError as e:
+            self.error = e
+
+    def result(self):
+        self.thread.join()
+        if self.error:
+            raise self.error
+        return root_digest(self.leaves, self.filesize)
+
+
+class ChunkHasher:
+    """Hashes a received byte stream in fixed chunks, off the recv loop.
+
+    The recv loop only enqueues the chunks it already holds; hashing happens
+    on a worker thread (hashlib releases the GIL on large buffers).
+    """
+
+    def __init__(self, first_index=0, chunk_size=HASH_CHUNK_SIZE, depth=HASH_QUEUE_DEPTH):
+        self.first_index = first_index
+        self.chunk_size = chunk_size
+        self.leaves = {}
+        self.queue = queue.Queue(maxsize=depth)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def feed(self, data, on_done=None):
+        """Queue data for hashing; on_done() runs once it is hashed and the buffer may be reused."""
+        self.queue.put((data, on_done))
+
+    def finish(self):
+        """Flush the final partial chunk and return {chunk index: leaf digest}."""
+        self.queue.put((None, None))
+        self.thread.join()
+        return self.leaves
+
+    def _run(self):
+        index = self.first_index
+        h = hashlib.blake2b(digest_size=LEAF_DIGEST_SIZE)
+        filled = 0
+        while True:
+            data, on_done = self.queue.get()
+            if data is None:
+                break
+            view = memoryview(data)
+            while view:
+                take = min(len(view), self.chunk_size - filled)
+                h.update(view[:take])
+                filled += take
+                view = view[take:]
+                if filled == self.chunk_size:
+                    self.leaves[index] = h.digest()
+                    index += 1
+                    h = hashlib.blake2b(digest_size=LEAF_DIGEST_SIZE)
+                    filled = 0
+            if on_done:
+                on_done()
+        if filled:
+            self.leaves[index] = h.digest()
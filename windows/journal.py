@@ -0,0 +1,153 @@
+"""Crash-safe journals of unfinished batches, so a restarted batch resumes file by file.
+
+Both ends keep one BatchJournal per batch. The sender records each file the
+receiver confirmed. Sending the same folder to the same device again then
+reuses the batch's group_id and skips those files without asking, as long as
+their size and mtime are unchanged. The receiver records that it accepted the
+batch, which files are complete, and where interrupted files stopped.
+A restarted batch is therefore accepted again without a dialog, and its
+manifest is answered from the journal instead of a stat per file.
+
+A journal is an append-only file of JSON arrays, one per line:
+  ["g", group_id]              first line: the batch the journal belongs to
+  ["d", name, size, mtime]     name is complete
+  ["p", name, offset]          name stopped at offset (the receiver's .ldpart file)
+Every record is flushed as it is written. A killed process therefore loses at
+most the line it was writing, and loading ignores a torn last line.
+Journals are deleted when their batch completes, and pruned after
+JOURNAL_MAX_AGE otherwise.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+JOURNAL_SUFFIX = ".ldjournal"
+JOURNAL_MAX_AGE = 7 * 24 * 3600  # Seconds an unfinished batch stays resumable
+
+
+class BatchJournal:
+    def __init__(self, path, group_id=None):
+        self.path = path
+        self.group_id = group_id
+        self.done = {}  # name -> (size, mtime)
+        self.partial = {}  # name -> offset
+        self.lock = threading.Lock()
+        self.resumed = self._load()
+        if not self.resumed:
+            self._rewrite()
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def _load(self):
+        """Read an existing journal. Returns True if it belongs to a batch that can be resumed."""
+        records = 0
+        clean = True
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                lines = f.read().split('\n')
+        except OSError:
+            return False
+        for line in lines:
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+                kind = record[0]
+                if kind == 'g':
+                    self.group_id = record[1]
+                elif kind == 'd':
+                    self.done[record[1]] = (record[2], record[3])
+                    self.partial.pop(record[1], None)
+                elif kind == 'p':
+                    self.partial[record[1]] = record[2]
+                records += 1
+            except (ValueError, IndexError, TypeError):
+                clean = False  # A torn last line
+        if self.group_id is None:
+            return False
+        if not clean or lines[-1] != '' or records > 2 * (len(self.done) + len(self.partial)) + 16:
+            self._rewrite()  # Drop the torn line and superseded records
+        return True
+
+    def _rewrite(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(["g", self.group_id]) + "\n")
+            for name, (size, mtime) in self.done.items():
+                f.write(json.dumps(["d", name, size, mtime]) + "\n")
+            for name, offset in self.partial.items():
+                f.write(json.dumps(["p", name, offset]) + "\n")
+        os.replace(tmp, self.path)
+
+    def _append(self, record):
+        if self.file is not None:
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+
+    def record_done(self, name, size, mtime):
+        with self.lock:
+            self.done[name] = (size, mtime)
+            self.partial.pop(name, None)
+            self._append(["d", name, size, mtime])
+
+    def record_partial(self, name, offset):
+        with self.lock:
+            if self.partial.get(name) != offset:
+                self.partial[name] = offset
+                self._append(["p", name, offset])
+
+    def is_done(self, name, size, mtime):
+        return self.done.get(name) == (size, mtime)
+
+    def close(self):
+        """Keep the journal on disk: the batch did not finish."""
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def discard(self):
+        """The batch finished (or cannot be resumed); forget it."""
+        self.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class JournalStore:
+    """Directory of BatchJournals, one per (direction, peer, batch) key."""
+
+    def __init__(self, directory, max_age=JOURNAL_MAX_AGE):
+        self.directory = directory
+        self.max_age = max_age
+        os.makedirs(directory, exist_ok=True)
+        self.prune()
+
+    def path_for(self, *key):
+        name = hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()[:24]
+        return os.path.join(self.directory, name + JOURNAL_SUFFIX)
+
+    def exists(self, *key):
+        return os.path.exists(self.path_for(*key))
+
+    def open(self, *key, group_id=None):
+        """The journal for key. An existing one keeps its own group_id; check .resumed."""
+        return BatchJournal(self.path_for(*key), group_id)
+
+    def prune(self):
+        cutoff = time.time() - self.max_age
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            if not name.endswith(JOURNAL_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                continue
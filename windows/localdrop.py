@@ -0,0 +1,378 @@
+"""Headless LocalDrop for servers and scripts (no GUI toolkit needed).
+
+    python -m localdrop serve [--dir DIR] [--allow HOST[=SIZE]]... [--max-size SIZE]
+    python -m localdrop send TARGET[,TARGET...] PATH...
+    python -m localdrop text TARGET [MESSAGE]
+
+Run it from the windows/ directory, where the modules live. TARGET is a
+device's IP or the host name it advertises; send takes a comma-separated
+list and streams to all of them at once, reading the files once (fanout.py). Instead of the confirmation
+dialog, serve applies an accept policy: an optional list of allowed senders,
+each with an optional size cap, plus a global cap. A batch is judged once,
+by its total size.
+
+Events go to stdout as one JSON object per line ("device", "progress",
+"transfer", "text", "text_file", "result"). The network layer's log lines
+go to stderr, so stdout can be piped straight into another program.
+"transfer" carries a finished transfer's metrics (see telemetry.py).
+--metrics-log also appends them to a rotating file, --metrics-port serves
+running totals in Prometheus text format on localhost, and --profile writes
+a sampling profile of every thread in collapsed-stack format on exit.
+--rate and --peer-rate cap outgoing bandwidth (see shaping.py).
+Sending one folder starts while it is still being scanned (scanner.py);
+--scan-cache keeps its directory listings in a file, so sending the same
+folder again skips the scan of unchanged directories. With --journal on
+both ends, a batch interrupted by a restart of either side continues with
+its first unfinished file when it is sent again (journal.py).
+With a pairing secret (--secret, or LOCALDROP_SECRET so it stays out of
+the process list) every transfer connection is authenticated and
+encrypted, and cleartext peers are refused (secure.py).
+serve --content-index keeps an index of received files by digest; a file
+that arrives again under another name is copied from the earlier one
+instead of over the network (dedup.py).
+"""
+import argparse
+import json
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import uuid
+
+from engine import MAX_SESSIONS
+from fanout import FanOut
+from network import BatchSender, NetworkManager
+from registry import ADDED
+from scanner import FolderScan, ScanCache
+from secure import CIPHERS, DEFAULT_CIPHER, SECURE_AVAILABLE
+from telemetry import JsonLinesLog, MetricsServer, Telemetry
+from zerocopy import WRITE_BEHIND_DEPTH
+
+SIZE_UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+DISCOVERY_WAIT = 3.0
+
+
+def parse_size(text):
+    """'500M' -> bytes. Plain numbers are bytes; units are binary (K, M, G, T)."""
+    text = text.strip().upper().rstrip("B")
+    if text and text[-1] in SIZE_UNITS:
+        return int(float(text[:-1]) * SIZE_UNITS[text[-1]])
+    return int(text)
+
+
+class EventWriter:
+    """Writes one JSON event per line; safe to call from any network thread."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+
+    def __call__(self, event, **fields):
+        line = json.dumps(dict(event=event, time=round(time.time(), 3), **fields))
+        with self.lock:
+            self.stream.write(line + "\n")
+            self.stream.flush()
+
+    def progress(self, filename, current, total, mode, speed=0, eta=0, peer=None):
+        fields = {"peer": peer} if peer else {}
+        self("progress", name=filename, mode=mode, done=current, total=total,
+             speed=round(speed), eta=round(eta, 1), **fields)
+
+    def device(self, change, device):
+        self("device", change=change, ip=device.ip, host=device.hostname, os=device.os)
+
+
+class AcceptPolicy:
+    """Auto-accept rule used in place of on_confirmation.
+
+    allow maps a sender (IP or advertised host name) to its size cap, or None
+    for no cap; an empty allow accepts every sender. max_size caps everyone.
+    """
+
+    def __init__(self, allow=None, max_size=None):
+        self.allow = allow or {}
+        self.max_size = max_size
+        self.devices = None  # The manager's DeviceRegistry, to match host names
+
+    def __call__(self, sender_ip, filename, size):
+        if self.max_size is not None and size > self.max_size:
+            return False
+        if not self.allow:
+            return True
+        if sender_ip in self.allow:
+            key = sender_ip
+        else:
+            device = self.devices.get(sender_ip) if self.devices is not None else None
+            if device is None or device.hostname not in self.allow:
+                return False
+            key = device.hostname
+        limit = self.allow[key]
+        return limit is None or size <= limit
+
+
+def parse_allow(values):
+    allow = {}
+    for value in values or ():
+        name, _, limit = value.partition("=")
+        allow[name] = parse_size(limit) if limit else None
+    return allow
+
+
+def collect_entries(paths, cache=None, workers=1):
+    """(abs_path, remote_filename, size) for files and the contents of folders, as the GUI sends them."""
+    entries = []
+    for path in paths:
+        path = os.path.abspath(path)
+        if os.path.isdir(path):
+            entries.extend(FolderScan(path, cache=cache, workers=workers))
+        else:
+            entries.append((path, os.path.basename(path), os.path.getsize(path)))
+    return entries
+
+
+def _make_manager(args, emit, **kwargs):
+    return NetworkManager(
+        args.name,
+        on_transfer_progress=emit.progress,
+        stripe_streams=args.streams,
+        delta_sync=args.delta,
+        compression=args.compress,
+        checksums=args.checksum,
+        engine=args.engine,
+        telemetry=args.telemetry,
+        rate_limit=parse_size(args.rate) if args.rate else None,
+        peer_rate_limit=parse_size(args.peer_rate) if args.peer_rate else None,
+        journal_dir=os.path.expanduser(args.journal) if args.journal else None,
+        secret=args.secret or None,
+        cipher=args.cipher,
+        on_transfer_metrics=lambda event: emit("transfer", **event),
+        **kwargs
+    )
+
+
+def _find_device(manager, target, wait):
+    """Wait up to `wait` seconds for TARGET to be discovered. Returns its IP, or None."""
+    found = threading.Event()
+
+    def matches(device):
+        return target in (device.ip, device.hostname)
+
+    def on_event(event, device):
+        if event == ADDED and matches(device):
+            found.set()
+
+    manager.found_devices.subscribe(on_event)
+    try:
+        for device in manager.found_devices.snapshot():
+            if matches(device):
+                return device.ip
+        found.wait(wait)
+        for device in manager.found_devices.snapshot():
+            if matches(device):
+                return device.ip
+    finally:
+        manager.found_devices.unsubscribe(on_event)
+    try:
+        # Not (yet) discovered: an address still works, with the legacy protocol
+        socket.inet_aton(target)
+        return target
+    except OSError:
+        return None
+
+
+def serve(args, emit):
+    policy = AcceptPolicy(parse_allow(args.allow), parse_size(args.max_size) if args.max_size else None)
+    manager = _make_manager(
+        args, emit,
+        on_text_received=lambda text: emit("text", text=text),
+        on_text_file=lambda path: emit("text_file", path=path),
+        download_dir=os.path.abspath(os.path.expanduser(args.dir)),
+        accept_policy=policy,
+        max_sessions=args.max_sessions,
+        write_behind=args.write_behind,
+        fsync_bytes=parse_size(args.fsync_every) if args.fsync_every else 0,
+        content_index=os.path.expanduser(args.content_index) if args.content_index else None,
+    )
+    policy.devices = manager.found_devices
+    manager.found_devices.subscribe(emit.device)
+    manager.start()
+    # Service managers stop us with SIGTERM; leave through the same cleanup as Ctrl+C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f"Serving as {args.name}, saving to {manager.download_dir}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        manager.stop()
+    return 0
+
+
+def _start_client(args, emit, targets):
+    """Returns the manager and the targets' IPs, or None if one of them is not found."""
+    # A sending client never takes incoming files, nor the ports: it may run next to `serve` or the GUI
+    manager = _make_manager(args, emit, accept_policy=lambda sender_ip, filename, size: False, listen=False)
+    manager.start()
+    ips = []
+    for target in targets:
+        ip = _find_device(manager, target, args.wait)
+        if ip is None:
+            emit("result", ok=False, error=f"device {target} not found")
+            manager.stop()
+            return manager, None
+        ips.append(ip)
+    return manager, ips
+
+
+def send(args, emit):
+    targets = args.target.split(",")
+    cache = ScanCache(args.scan_cache) if args.scan_cache else None
+    folders = [path for path in args.paths if os.path.isdir(path)]
+    scan = None
+    if len(targets) == 1 and len(args.paths) == 1 and folders:
+        # One folder to one device: send while scanning
+        scan = FolderScan(folders[0], cache=cache, workers=args.scan_workers)
+        entries = []
+    else:
+        entries = collect_entries(args.paths, cache, args.scan_workers)
+    manager, ips = _start_client(args, emit, targets)
+    if ips is None:
+        return 2
+    try:
+        started = time.time()
+        label = os.path.basename(os.path.abspath(folders[0])) if len(folders) == 1 else None
+        resume_key = "\n".join(os.path.abspath(path) for path in args.paths)  # Names the batch in journals
+        if scan is not None:
+            batch = BatchSender(manager, ips[0], group_id=str(uuid.uuid4()),
+                                stop_on_failure=False, on_progress=emit.progress, resume_key=resume_key)
+            ok = batch.send(scan, archive_label=label)
+            emit("result", ok=ok, files=scan.count, bytes=scan.total_size,
+                 seconds=round(time.time() - started, 3), failed=[entry[1] for entry in batch.failures])
+            return 0 if ok else 1
+        if len(ips) > 1:
+            fan = FanOut(manager, ips, on_progress=lambda ip, *fields: emit.progress(*fields, peer=ip),
+                         resume_key=resume_key)
+            ok = fan.send(entries, archive_label=label)
+            emit("result", ok=ok, files=len(entries), bytes=sum(entry[2] for entry in entries),
+                 seconds=round(time.time() - started, 3), read=fan.cache.read_bytes,
+                 peers={ip: {"ok": fan.results.get(ip, False),
+                             "failed": [entry[1] for entry in fan.senders[ip].failures]} for ip in ips})
+            return 0 if ok else 1
+        ip = ips[0]
+        if len(entries) == 1 and not folders:
+            abs_path, remote_filename, _ = entries[0]
+            ok = manager.send_file(ip, abs_path, remote_filename)
+            failed = [] if ok else [remote_filename]
+        else:
+            batch = BatchSender(manager, ip, group_id=str(uuid.uuid4()),
+                                group_size=sum(entry[2] for entry in entries),
+                                stop_on_failure=False, on_progress=emit.progress, resume_key=resume_key)
+            ok = batch.send(entries, archive_label=label)
+            failed = [entry[1] for entry in batch.failures]
+        emit("result", ok=ok, files=len(entries), bytes=sum(entry[2] for entry in entries),
+             seconds=round(time.time() - started, 3), failed=failed)
+        return 0 if ok else 1
+    finally:
+        manager.stop()
+        if cache is not None:
+            cache.save()
+
+
+def text(args, emit):
+    message = args.message if args.message is not None else sys.stdin.read()
+    manager, ips = _start_client(args, emit, [args.target])
+    if ips is None:
+        return 2
+    try:
+        ok = manager.send_text(ips[0], message)
+        emit("result", ok=ok, bytes=len(message.encode('utf-8')))
+        return 0 if ok else 1
+    finally:
+        manager.stop()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="localdrop", description="Headless LocalDrop")
+    parser.add_argument("--name", default=os.getenv('COMPUTERNAME') or socket.gethostname(),
+                        help="device name to advertise")
+    parser.add_argument("--engine", choices=("asyncio", "threads"), default="asyncio")
+    parser.add_argument("--streams", type=int, default=1, help="parallel streams per large file")
+    parser.add_argument("--delta", action="store_true", help="update older copies with delta sync")
+    parser.add_argument("--compress", action="store_true", help="compress frames (opt-in)")
+    parser.add_argument("--checksum", action="store_true", help="verify every file end to end (slower on fast links)")
+    parser.add_argument("--rate", metavar="SIZE", help="cap outgoing bandwidth, bytes per second (e.g. 20M)")
+    parser.add_argument("--peer-rate", metavar="SIZE", help="cap outgoing bandwidth to each peer, bytes per second")
+    parser.add_argument("--metrics-log", metavar="PATH", help="append per-transfer metrics here (rotated)")
+    parser.add_argument("--metrics-port", type=int, metavar="PORT",
+                        help="serve Prometheus metrics on http://127.0.0.1:PORT/metrics")
+    parser.add_argument("--profile", metavar="PATH", help="sample all threads; write collapsed stacks here on exit")
+    parser.add_argument("--journal", metavar="DIR",
+                        help="keep journals of unfinished batches here, so they resume after a restart")
+    parser.add_argument("--secret", default=os.getenv('LOCALDROP_SECRET'),
+                        help="pairing secret: encrypt transfers, refuse cleartext (default: $LOCALDROP_SECRET)")
+    parser.add_argument("--cipher", choices=sorted(CIPHERS), default=DEFAULT_CIPHER,
+                        help="aesgcm is fastest with AES instructions, chacha20 without")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("serve", help="receive unattended")
+    p.add_argument("--dir", default="~/Downloads", help="target directory")
+    p.add_argument("--allow", action="append", metavar="HOST[=SIZE]",
+                   help="accept only these senders (IP or host name), optionally up to SIZE; repeatable")
+    p.add_argument("--max-size", help="refuse transfers (or batches) larger than this, e.g. 20G")
+    p.add_argument("--max-sessions", type=int, default=MAX_SESSIONS, help="connections served at once")
+    p.add_argument("--write-behind", type=int, default=WRITE_BEHIND_DEPTH, metavar="N",
+                   help="1 MB buffers the disk may lag behind the network (0: write inline)")
+    p.add_argument("--fsync-every", metavar="SIZE", help="fsync received files every SIZE bytes (e.g. 256M)")
+    p.add_argument("--content-index", metavar="PATH",
+                   help="index received files here; a file received again is copied locally instead")
+    p.set_defaults(run=serve)
+
+    for name, run, help_text in (("send", send, "send files or folders"), ("text", text, "send a text")):
+        p = commands.add_parser(name, help=help_text)
+        p.add_argument("target", help="device IP or host name" + (", or several separated by commas" if name == "send" else ""))
+        p.add_argument("--wait", type=float, default=DISCOVERY_WAIT, help="seconds to wait for discovery")
+        if name == "send":
+            p.add_argument("paths", nargs="+")
+            p.add_argument("--scan-cache", metavar="PATH", help="keep folder listings here to speed up repeat sends")
+            p.add_argument("--scan-workers", type=int, default=1,
+                           help="directories listed in parallel (helps on SSDs and network shares)")
+        else:
+            p.add_argument("message", nargs="?", help="text to send (default: stdin)")
+        p.set_defaults(run=run)
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.secret and not SECURE_AVAILABLE:
+        parser.error("--secret needs the 'cryptography' package (pip install cryptography)")
+    # stdout carries the JSON events; everything the network layer prints goes to stderr
+    emit = EventWriter(sys.stdout)
+    sys.stdout = sys.stderr
+    telemetry = args.telemetry = Telemetry()
+    log = server = None
+    try:
+        if args.metrics_log:
+            log = JsonLinesLog(args.metrics_log)
+            telemetry.subscribe(log)
+        if args.metrics_port:
+            server = MetricsServer(telemetry, args.metrics_port).start()
+        if args.profile:
+            telemetry.start_profiler()
+        return args.run(args, emit)
+    finally:
+        if args.profile:
+            telemetry.stop_profiler(args.profile)
+        if server:
+            server.stop()
+        if log:
+            log.close()
+        sys.stdout = emit.stream
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -17,6 +17,10 @@ def install_dependencies():
         print("Dependencies installed.")
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        # serve / send / text: headless, no GUI dependencies
+        from localdrop import main
+        sys.exit(main())
     install_dependencies()
     from gui import App  # Import after installation
     app = App()
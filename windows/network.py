@@ -4,302 +4,2015 @@ import json
 import os
 import time
 import struct
+import tarfile
+import shutil
+import uuid
+import hashlib
+import itertools
+import zlib
 from dataclasses import dataclass
 
-try:
-    import netifaces
-except ImportError:
-    netifaces = None
+from compression import RECORD, compressed_records, is_precompressed, make_pool
+from dedup import ContentIndex
+from delta import block_size_for, encode_delta, file_signatures
+from discovery import CLIENT_QUERY_INTERVAL, Discovery, QUERY_BURST
+from engine import AsyncEngine, MAX_SESSIONS
+from inbound import InboundRegistry
+from journal import JournalStore
+from progress import end_counter, finish, start_counter, track
+from registry import ADDED, REMOVED, DeviceRegistry
+from secure import DEFAULT_CIPHER, SecureTransport
+from shaping import BULK, SMALL, SMALL_PRIORITY_SIZE, TEXT, Scheduler
+from telemetry import Telemetry
+from zerocopy import BufferPool, RECV_BUFFERS, SPLICE_AVAILABLE, Splicer, WRITE_BEHIND_DEPTH, WriteBehind
+from integrity import ChunkHasher, FileDigest, HASH_CHUNK_SIZE, chunk_count, hash_file_chunks, leaf_digest, root_digest
 
 # Configuration
 BROADCAST_PORT = 45454
 TRANSFER_PORT = 45455
 BUFFER_SIZE = 1024 * 1024  # 1MB Buffer for high speed
 
+# Protocol extensions advertised in the discovery beacon. Peers that do not
+# list a feature (e.g. older Android builds) get the classic one-file-per-
+# connection protocol.
+FEATURES = ["session", "archive", "stripe", "verify", "delta", "manifest", "compress", "textchan", "textack"]
+
+# Folder sends pack files below this size into streamed tar frames
+SMALL_FILE_THRESHOLD = 64 * 1024
+ARCHIVE_BATCH_SIZE = 32 * 1024 * 1024  # Payload bytes per archive frame
+
+# Striped mode: one large file split into byte ranges over parallel connections
+STRIPE_MIN_SIZE = 256 * 1024 * 1024
+STRIPE_CHECKPOINT = 64 * 1024 * 1024  # Persist per-range progress this often
+RANGES_SUFFIX = ".ldranges"
+PREALLOCATE_MIN = 16 * 1024 * 1024  # Larger single-stream receives preallocate and checkpoint like stripes
+DELTA_SUFFIX = ".lddelta"  # Rebuilt copy while applying a delta
+PART_SUFFIX = ".ldpart"  # Files are received under this suffix and renamed once complete
+
+BATCH_WIDTH = 4  # Files a BatchSender keeps in flight
+MANIFEST_WAVE = 2000  # Entries per manifest when a batch is streamed from a running scan
+WAVE_WAIT = 0.5  # Seconds a partial wave waits for more entries before it goes out
+
+# Text channel: one persistent connection per peer carrying length-prefixed messages
+TEXT_MEMORY_LIMIT = 4 * 1024 * 1024  # Larger pastes are streamed to the download directory
+TEXT_DEDUP_WINDOW = 2.0  # Seconds in which an identical clipboard repeat (our own text coming back) is dropped
+TEXT_ACK_TIMEOUT = 10.0  # Seconds a text message may wait for the receiver's ack
+TEXT_ACK_SENDERS = 1024  # Channels whose last delivered message a receiver remembers, to drop resends
+TEXT_CHANNEL_IDLE = 60.0  # Seconds after which a sender reconnects instead of reusing its channel
+TEXT_CHANNEL_TIMEOUT = 2 * TEXT_CHANNEL_IDLE  # Seconds of silence after which the receiver closes a channel
+MAX_TEXT_CHANNELS = 64  # Channels served on their own threads; more share the session slots
+ACCEPT_BACKLOG = 64  # Pending connections the kernel queues while every session slot is busy
+HEADER_TIMEOUT = 10.0  # Seconds an accepted connection gets to say what it is
+RECEIVE_TIMEOUT = 300.0  # Seconds an identified connection may stay silent before it is dropped
+SESSION_IDLE = 120.0  # Seconds after which a sender reconnects a quiet session instead of reusing it
+
 @dataclass
 class Device:
     ip: str
     hostname: str
     os: str
     last_seen: float
+    features: tuple = ()
+    interval: float = None  # Advertised beacon interval; None for peers with the fixed 3 s expiry
+
+
+def _recv_exact(conn, size):
+    """Read exactly `size` bytes or raise ConnectionError."""
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = conn.recv(size - len(buf))
+        if not chunk:
+            raise ConnectionError("Connection closed by peer")
+        buf += chunk
+    return bytes(buf)
+
+
+def _send_header(sock, header_dict):
+    # Length prefix and header go out in one write so Nagle does not hold
+    # the header back while we wait for the offset reply.
+    header = json.dumps(header_dict).encode('utf-8')
+    sock.sendall(struct.pack('!I', len(header)) + header)
+
+
+def _recv_header(conn):
+    """Read a length-prefixed JSON header. Returns None on a clean close or an end-of-session marker."""
+    header_len_data = conn.recv(4)
+    if not header_len_data:
+        return None
+    if len(header_len_data) < 4:
+        header_len_data += _recv_exact(conn, 4 - len(header_len_data))
+    header_len = struct.unpack('!I', header_len_data)[0]
+    if header_len == 0:
+        return None
+    return json.loads(_recv_exact(conn, header_len).decode('utf-8'))
+
+
+def iter_archive_batches(entries, max_bytes=ARCHIVE_BATCH_SIZE):
+    """Group (abs_path, remote_filename, size) entries into archive-sized batches."""
+    batch = []
+    batch_size = 0
+    for entry in entries:
+        batch.append(entry)
+        batch_size += entry[2]
+        if batch_size >= max_bytes:
+            yield batch
+            batch = []
+            batch_size = 0
+    if batch:
+        yield batch
+
+
+def _split_ranges(filesize, streams):
+    """Split [0, filesize) into at most `streams` contiguous BUFFER_SIZE-aligned ranges."""
+    span = -(-filesize // max(1, streams))
+    span = max(BUFFER_SIZE, -(-span // BUFFER_SIZE) * BUFFER_SIZE)
+    return [(start, min(start + span, filesize)) for start in range(0, filesize, span)]
+
+
+def _resume_position(done, start, end):
+    """Walk the recorded {range_start: reached} intervals to find where [start, end) resumes."""
+    pos = start
+    moved = True
+    while moved and pos < end:
+        moved = False
+        for a, b in done.items():
+            if a <= pos < b:
+                pos = min(b, end)
+                moved = True
+    return pos
+
+
+def _covers(done, filesize):
+    pos = 0
+    for a, b in sorted(done.items()):
+        if a > pos:
+            return False
+        pos = max(pos, b)
+    return pos >= filesize
+
+
+class _FramedWriter:
+    """File-like sink that sends writes as length-prefixed chunks, ended by an empty chunk."""
+
+    def __init__(self, sock, lane=None):
+        self.sock = sock
+        self.lane = lane  # Scheduler lane paced before every chunk
+        self.waited = 0.0
+        self.buf = bytearray(4)  # Room for the length prefix
+
+    def write(self, data):
+        self.buf += data
+        if len(self.buf) >= BUFFER_SIZE:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if len(self.buf) > 4:
+            struct.pack_into('!I', self.buf, 0, len(self.buf) - 4)
+            if self.lane is not None:
+                self.waited += self.lane.throttle(len(self.buf))
+            self.sock.sendall(self.buf)
+            self.buf = bytearray(4)
+
+    def close(self):
+        self.flush()
+        self.sock.sendall(struct.pack('!I', 0))
+
+
+class _FramedReader:
+    """File-like source reading the chunks written by _FramedWriter."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.remaining = 0
+        self.eof = False
+
+    def read(self, size=-1):
+        if self.eof:
+            return b""
+        if self.remaining == 0:
+            self.remaining = struct.unpack('!I', _recv_exact(self.conn, 4))[0]
+            if self.remaining == 0:
+                self.eof = True
+                return b""
+        want = self.remaining if size is None or size < 0 else min(size, self.remaining)
+        chunk = self.conn.recv(want)
+        if not chunk:
+            raise ConnectionError("Connection closed inside archive frame")
+        self.remaining -= len(chunk)
+        return chunk
+
+    def drain(self):
+        # tarfile stops at the end-of-archive blocks; skip any trailing padding
+        while self.read(BUFFER_SIZE):
+            pass
+
+
+class _CompressedReader:
+    """Socket-like source that undoes the records written by compressed_records."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.raw_remaining = 0  # Bytes left in the current raw record
+        self.pending = b""  # Decompressed bytes not handed out yet
+
+    def recv(self, size):
+        if not self.pending and not self.raw_remaining:
+            kind, raw_len, wire_len = RECORD.unpack(_recv_exact(self.conn, RECORD.size))
+            if kind == b'Z':
+                self.pending = zlib.decompress(_recv_exact(self.conn, wire_len))
+                if len(self.pending) != raw_len:
+                    raise ValueError("Compressed record has the wrong length")
+            elif kind == b'R':
+                self.raw_remaining = raw_len
+            else:
+                raise ValueError(f"Unknown compressed record {kind!r}")
+
+        if self.pending:
+            chunk = self.pending[:size]
+            self.pending = self.pending[size:]
+            return chunk
+        chunk = self.conn.recv(min(size, self.raw_remaining))
+        self.raw_remaining -= len(chunk)
+        return chunk
+
+    def recv_into(self, view):
+        if self.raw_remaining:
+            count = self.conn.recv_into(view, min(len(view), self.raw_remaining))
+            self.raw_remaining -= count
+            return count
+        chunk = self.recv(len(view))
+        view[:len(chunk)] = chunk
+        return len(chunk)
+
+
+class TransferSession:
+    """Carries many files of one batch over a single TCP connection.
+
+    Each file is sent as a framed header + offset reply + data, exactly like a
+    standalone transfer, but without a new connect per file. Falls back to
+    one connection per file when the peer does not advertise "session".
+    """
+
+    def __init__(self, manager, ip, group_id=None, group_size=None, progress=None):
+        self.manager = manager
+        self.ip = ip
+        self.group_id = group_id
+        self.group_size = group_size
+        self.progress = progress  # Callback or a batch's TransferStats; defaults to manager.on_transfer_progress
+        self.sock = None
+        self.used = 0.0  # When the connection last finished a frame
+        self.enabled = manager.peer_supports(ip, "session")
+
+    def _ensure_connected(self):
+        """Connect, replacing a connection left quiet so long that the receiver may be about to drop it."""
+        if self.sock is not None and time.monotonic() - self.used > SESSION_IDLE:
+            self.close()
+        if self.sock is None:
+            self._connect()
+
+    def _connect(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        s.connect((self.ip, TRANSFER_PORT))
+        s = self.manager._secure_client(s, self.ip)
+        header_dict = {"filename": "Session", "size": 0, "type": "session"}
+        if self.group_id:
+            header_dict["group_id"] = self.group_id
+        if self.group_size:
+            header_dict["group_size"] = self.group_size
+        _send_header(s, header_dict)
+        _recv_exact(s, 8)  # Session ack
+        self.sock = s
+
+    def send_file(self, file_path, remote_filename=None, planned=False, source=None):
+        """Send one file frame. planned marks a file the receiver's manifest reply listed as missing.
+
+        source is a fanout.SharedSource when the same file goes to several peers.
+        """
+        if source is None and self.manager._wants_stripes(self.ip, file_path):
+            return self.manager.send_file_striped(self.ip, file_path, remote_filename=remote_filename,
+                                                  group_id=self.group_id, group_size=self.group_size,
+                                                  progress=self.progress)
+        if not self.enabled:
+            return self.manager.send_file(self.ip, file_path, remote_filename=remote_filename,
+                                          group_id=self.group_id, group_size=self.group_size,
+                                          progress=self.progress, source=source)
+        if self.manager.cancel_requested:
+            return False
+
+        telemetry = self.manager.telemetry
+        metrics = telemetry.start("send", "file", remote_filename or os.path.basename(file_path), self.ip, 0)
+        try:
+            started = time.perf_counter()
+            self._ensure_connected()
+            metrics.times['connect'] += time.perf_counter() - started
+            success = self.manager._send_file_frame(self.sock, file_path, remote_filename, progress=self.progress,
+                                                    planned=planned, metrics=metrics, source=source)
+        except Exception as e:
+            print(f"Session send error: {e}")
+            success = False
+        telemetry.finish(metrics, success)
+        self.used = time.monotonic()
+
+        if not success:
+            # The stream is out of sync after a partial file; reconnect on the next send.
+            self._drop()
+        return success
+
+    def send_manifest(self, entries, growing=None, first=False):
+        """Offer the whole batch up front; the receiver answers once for every entry.
+
+        entries are (abs_path, remote_filename, size, mtime) tuples. Returns the
+        reply {"skip": [index, ...], "partial": [[index, offset], ...], "changed": [index, ...]}
+        (unlisted entries are missing), or None if the receiver refused the batch.
+        A streamed batch sends one manifest per wave with growing=True and the
+        running group_size; the last one (growing=False) carries the final total.
+        first marks the opening manifest of a send: a retry of a batch the receiver
+        cancelled (same group_id, from the journal) is then asked about again.
+        """
+        self._ensure_connected()
+        header = {
+            "filename": f"{len(entries)} files",
+            "size": sum(entry[2] for entry in entries),
+            "type": "manifest",
+            "entries": [[remote_filename, size, mtime] for _, remote_filename, size, mtime in entries]
+        }
+        if growing is not None:
+            header["group_size"] = self.group_size
+            header["growing"] = growing
+        if first:
+            header["first"] = True
+        _send_header(self.sock, header)
+        reply = _recv_header(self.sock)
+        if reply is None or not reply.get('accepted'):
+            self._drop()
+            return None
+        self.used = time.monotonic()
+        return reply
+
+    @property
+    def packs_small_files(self):
+        return self.enabled and self.manager.peer_supports(self.ip, "archive")
+
+    def send_archive(self, entries, label=None):
+        """Stream small files as one tar frame built on the fly (nothing staged on disk).
+
+        entries are (abs_path, remote_filename, size) tuples. Requires packs_small_files.
+        """
+        if self.manager.cancel_requested:
+            return False
+
+        total = sum(entry[2] for entry in entries)
+        label = label or f"{len(entries)} files"
+        progress = self.progress or self.manager.on_transfer_progress
+        telemetry = self.manager.telemetry
+        metrics = telemetry.start("send", "archive", label, self.ip, total)
+        ok = False
+        try:
+            started = time.perf_counter()
+            self._ensure_connected()
+            metrics.times['connect'] += time.perf_counter() - started
+            started = time.perf_counter()
+            _send_header(self.sock, {
+                "filename": label,
+                "size": total,
+                "type": "archive",
+                "count": len(entries)
+            })
+            _recv_exact(self.sock, 8)  # Accepted
+            metrics.times['confirm'] += time.perf_counter() - started
+
+            lane = self.manager._lane(self.ip, BULK)
+            writer = _FramedWriter(self.sock, lane)
+            counter = start_counter(progress, label, total, "sending")
+            self.manager.transfer_running = True
+            started = time.perf_counter()
+            try:
+                with lane, tarfile.open(fileobj=writer, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+                    for abs_path, remote_filename, _ in entries:
+                        if self.manager.cancel_requested or not self.manager.transfer_running:
+                            raise ConnectionAbortedError("Transfer cancelled")
+                        with open(abs_path, 'rb') as f:
+                            st = os.fstat(f.fileno())
+                            info = tarfile.TarInfo(remote_filename)
+                            info.size = st.st_size
+                            info.mtime = int(st.st_mtime)
+                            tar.addfile(info, f)
+                        counter.add(info.size)
+                        metrics.bytes += info.size
+                        metrics.chunks += 1
+                writer.close()
+                _recv_exact(self.sock, 8)  # Number of files unpacked
+                ok = True
+            finally:
+                metrics.times['wait'] += writer.waited
+                metrics.times['send'] += time.perf_counter() - started - writer.waited  # Reading the files included
+                end_counter(counter, keep=ok)
+            return True
+        except Exception as e:
+            print(f"Archive send error: {e}")
+            self._drop()
+            return False
+        finally:
+            telemetry.finish(metrics, ok)
+            self.used = time.monotonic()
+
+    def _drop(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.sendall(struct.pack('!I', 0))  # End of session
+            except OSError:
+                pass
+        self._drop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+class TextChannel:
+    """Persistent connection for text/clipboard messages to one peer.
+
+    Messages are pipelined: each is a length prefix plus UTF-8 payload in one
+    write. A write that fails on a stale connection is retried once on a
+    fresh one. The connection opens on the first message, and one idle for
+    TEXT_CHANNEL_IDLE is replaced rather than reused, well before the
+    receiver gives up on it (TEXT_CHANNEL_TIMEOUT).
+
+    With peers that advertise "textack" each message also carries a sequence
+    number, which the receiver echoes once the text is delivered. send()
+    returns when its own ack arrives, while other messages may already be
+    on the wire behind it. A connection that breaks first is replaced, and
+    every message still unacked is sent again on the new one. That covers a
+    peer that restarted and so lost whatever was written into its old
+    connection. The receiver drops sequence numbers it has already delivered
+    on this channel (identified by a random id), so a resend never shows up
+    twice.
+    """
+
+    def __init__(self, manager, ip):
+        self.manager = manager
+        self.ip = ip
+        self.sock = None
+        self.lock = threading.Lock()
+        self.acked = threading.Condition(self.lock)  # Notified on every ack and when the connection breaks
+        self.acks = manager.peer_supports(ip, "textack")
+        self.channel_id = uuid.uuid4().hex
+        self.seq = 0
+        self.unacked = {}  # seq -> frame, in sending order
+        self.last_digest = None
+        self.last_sent = 0
+
+    def _connect(self):
+        s = socket.create_connection((self.ip, TRANSFER_PORT), timeout=5)
+        s.settimeout(None)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        s = self.manager._secure_client(s, self.ip)
+        header = {"filename": "Text Channel", "size": 0, "type": "text_channel"}
+        if self.acks:
+            header["acks"] = True
+            header["channel"] = self.channel_id
+        _send_header(s, header)
+        self.sock = s
+        if self.acks:
+            threading.Thread(target=self._read_acks, args=(s,), daemon=True).start()
+            for frame in self.unacked.values():
+                s.sendall(frame)
+
+    def _read_acks(self, sock):
+        try:
+            while True:
+                seq = struct.unpack('!Q', _recv_exact(sock, 8))[0]
+                with self.lock:
+                    for done in [n for n in self.unacked if n <= seq]:
+                        del self.unacked[done]
+                    self.acked.notify_all()
+        except OSError:
+            with self.lock:
+                if self.sock is sock:
+                    self._drop()  # The next send (or a waiting one) reconnects and resends
+
+    def _write(self, frame):
+        for attempt in range(2):
+            try:
+                if self.sock is None:
+                    self._connect()  # Resends what is unacked, this frame included
+                else:
+                    self.sock.sendall(frame)
+                return
+            except OSError:
+                self._drop()
+                if attempt:
+                    raise
+
+    def send(self, text, echo=False):
+        """Send one message. echo marks text taken from the clipboard, which an identical repeat may be."""
+        data = text.encode('utf-8')
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        with self.lock:
+            now = time.time()
+            if echo and digest == self.last_digest and now - self.last_sent < TEXT_DEDUP_WINDOW:
+                return True
+            if now - self.last_sent > TEXT_CHANNEL_IDLE:
+                self._drop()
+            frame = struct.pack('!Q', len(data)) + data
+            if self.acks:
+                self.seq += 1
+                seq = self.seq
+                frame = struct.pack('!Q', seq) + frame
+                self.unacked[seq] = frame
+            try:
+                self._write(frame)
+                self.last_digest = digest
+                self.last_sent = now
+                if not self.acks:
+                    return True
+                deadline = time.monotonic() + TEXT_ACK_TIMEOUT
+                reconnected = False
+                while seq in self.unacked:
+                    if self.sock is None:
+                        if reconnected:
+                            return False
+                        reconnected = True
+                        self._connect()
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        print(f"Text to {self.ip} was not acknowledged")
+                        return False
+                    self.acked.wait(remaining)
+                return True
+            finally:
+                if self.acks:
+                    self.unacked.pop(seq, None)  # Sent, or reported as failed: not to be resent later
+
+    def _drop(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+            self.acked.notify_all()
+
+    def close(self):
+        with self.lock:
+            self._drop()
+
+
+class BatchSender:
+    """Sends the files of one batch from a bounded pool of sessions.
+
+    Keeps up to `width` items (files or archive frames) in flight, each worker
+    on its own TransferSession, and merges their progress into one batch
+    total. Cancellation and the stop-on-failure policy apply to all workers.
+    Peers without the "session" feature get one item at a time.
+    """
+
+    def __init__(self, manager, ip, group_id=None, group_size=0, width=None, stop_on_failure=True, on_progress=None, shared=None, resume_key=None):
+        self.manager = manager
+        self.ip = ip
+        self.group_id = group_id
+        self.group_size = group_size
+        # Peers without sessions (the Android app, older clients) prompt once per connection and keep only the
+        # latest prompt, so their batches go one file at a time: the first is accepted before the rest follow
+        self.width = max(1, width or manager.batch_width) if manager.peer_supports(ip, "session") else 1
+        self.stop_on_failure = stop_on_failure
+        self.on_progress = on_progress
+        # shared(abs_path, size) -> fanout.SharedSource or None, when a FanOut sends this batch to several peers
+        self.shared = shared
+        self.lock = threading.Lock()
+        self.failures = []
+        self.stopped = False
+        self.planned = set()  # Remote names the receiver's manifest reply listed as missing
+        # With the manager's journals enabled, resume_key (e.g. the folder path) names this batch across restarts
+        self.resume_key = resume_key
+        self.journal = None
+        self.refused = False  # The receiver turned the batch down
+        self.manifests = 0  # Manifests exchanged; the first starts the batch over on the receiver
+        # Workers count into parts of one batch total; the sampler reports it to on_progress
+        self.stats = None
+
+    def send(self, entries, archive_label=None):
+        """Send (abs_path, remote_filename, size) entries. Returns True if all of them arrived.
+
+        entries may also be a stream such as scanner.FolderScan. Sending then starts
+        while the scan is still running, in waves of one manifest each, and group_size
+        and the progress total grow as entries arrive. Peers without manifests get
+        the whole list at once.
+        """
+        self.stats = track(archive_label or "batch", self.group_size, "sending batch", self.on_progress)
+        items = None
+        try:
+            self._open_journal()
+            manifest = self.manager.peer_supports(self.ip, "session") and self.manager.peer_supports(self.ip, "manifest")
+            if not isinstance(entries, (list, tuple)):
+                if manifest:
+                    entries = self._stream_plan(entries)
+                else:
+                    entries = list(entries)
+                    self.group_size = self.stats.total = sum(entry[2] for entry in entries)
+            if isinstance(entries, (list, tuple)):
+                remaining = self._skip_journaled(entries)
+                if self.group_size:
+                    # The receiver's total covers what is still to come
+                    self.group_size -= sum(entry[2] for entry in entries) - sum(entry[2] for entry in remaining)
+                entries = remaining
+                if manifest:
+                    entries = self._negotiate_manifest(entries)
+                    if entries is None:
+                        return False
+                items = self._plan(entries)
+            else:
+                items = entries
+            workers = [
+                threading.Thread(target=self._worker, args=(items, archive_label), daemon=True)
+                for _ in range(self.width)
+            ]
+            for t in workers:
+                t.start()
+            for t in workers:
+                t.join()
+        finally:
+            if hasattr(items, 'close'):
+                items.close()  # A streamed batch the workers left unfinished stops its scan
+            finish(self.stats)
+            if self.journal is not None:
+                if self.refused or not (self.failures or self.manager.cancel_requested or self.stopped):
+                    self.journal.discard()  # Done, or nothing to resume
+                else:
+                    self.journal.close()
+        return not self.failures and not self.manager.cancel_requested
+
+    def _open_journal(self):
+        # Only verified transfers are journaled: their success is confirmed by the receiver
+        if (self.resume_key is None or self.manager.journals is None
+                or not self.manager.peer_supports(self.ip, "verify")):
+            return
+        self.journal = self.manager.journals.open("send", self.ip, self.resume_key, group_id=self.group_id)
+        if self.journal.resumed:
+            print(f"Resuming batch {self.journal.group_id}: {len(self.journal.done)} files already sent")
+        self.group_id = self.journal.group_id
+
+    def _skip_journaled(self, entries):
+        """Entries not yet sent according to the journal; the ones sent count as done."""
+        if self.journal is None or not self.journal.done:
+            return entries
+        remaining = []
+        skipped = 0
+        for entry in entries:
+            abs_path, remote_filename, size = entry
+            try:
+                mtime = int(os.stat(abs_path).st_mtime)
+            except OSError:
+                mtime = None
+            if self.journal.is_done(remote_filename, size, mtime):
+                skipped += size
+            else:
+                remaining.append(entry)
+        self.stats.add(skipped)
+        return remaining
+
+    def _record_sent(self, batch):
+        for abs_path, remote_filename, size in batch:
+            try:
+                mtime = int(os.stat(abs_path).st_mtime)
+            except OSError:
+                continue
+            self.journal.record_done(remote_filename, size, mtime)
+
+    def _stream_plan(self, stream):
+        """Items of a streamed batch: negotiate each wave as it arrives, then plan it."""
+        if hasattr(stream, 'waves'):
+            waves = stream.waves(MANIFEST_WAVE, WAVE_WAIT)
+        else:
+            stream = iter(stream)
+            waves = iter(lambda: list(itertools.islice(stream, MANIFEST_WAVE)), [])
+        try:
+            for wave in waves:
+                if self.stopped or self.manager.cancel_requested:
+                    break
+                self.stats.total += sum(entry[2] for entry in wave)
+                wave = self._skip_journaled(wave)
+                self.group_size += sum(entry[2] for entry in wave)
+                wave = self._negotiate_manifest(wave, growing=True)
+                if wave is None:
+                    break
+                yield from self._plan(wave)
+            else:
+                # Final total: the receiver may close the batch once it has all of it. An empty folder sent no
+                # wave, and a lone final manifest would ask the user about "0 files".
+                if self.manifests:
+                    self._negotiate_manifest([], growing=False)
+        finally:
+            # Also when the workers gave up on us (failure, cancel): scan threads would block on a full queue
+            if hasattr(stream, 'stop'):
+                stream.stop()
+
+    def _negotiate_manifest(self, entries, growing=None):
+        """One manifest exchange for the whole batch (or one wave of a streamed batch).
+
+        Returns the entries still to send, or None.
+        """
+        stamped = []
+        for abs_path, remote_filename, size in entries:
+            try:
+                mtime = int(os.stat(abs_path).st_mtime)
+            except OSError:
+                mtime = 0
+            stamped.append((abs_path, remote_filename, size, mtime))
+
+        try:
+            with self.manager.open_session(self.ip, group_id=self.group_id, group_size=self.group_size) as session:
+                reply = session.send_manifest(stamped, growing, first=not self.manifests)
+                self.manifests += 1
+        except Exception as e:
+            print(f"Manifest error: {e}")
+            return entries  # Fall back to negotiating file by file
+        if reply is None:
+            self.refused = True
+            self.failures.extend(entries)
+            return None
+
+        skip = set(reply.get('skip', []))
+        partial = {index for index, _ in reply.get('partial', [])}
+        changed = set(reply.get('changed', []))
+        probe = set(reply.get('probe', []))  # The receiver may have these under another name
+        remaining = []
+        for index, entry in enumerate(entries):
+            if index in skip:
+                self.stats.add(entry[2])
+                continue
+            if index not in partial and index not in changed and index not in probe:
+                self.planned.add(entry[1])
+            remaining.append(entry)
+        if skip:
+            print(f"Receiver already has {len(skip)} of {len(entries)} files")
+        return remaining
+
+    def _plan(self, entries):
+        large = entries
+        if self.manager.peer_supports(self.ip, "session") and self.manager.peer_supports(self.ip, "archive"):
+            small = [entry for entry in entries if entry[2] < SMALL_FILE_THRESHOLD]
+            large = [entry for entry in entries if entry[2] >= SMALL_FILE_THRESHOLD]
+            for batch in iter_archive_batches(small):
+                yield "archive", batch
+        for entry in large:
+            yield "file", [entry]
+
+    def _worker(self, items, archive_label):
+        with self.manager.open_session(self.ip, group_id=self.group_id, group_size=self.group_size,
+                                       progress=self.stats) as session:
+            while not (self.stopped or self.manager.cancel_requested):
+                with self.lock:  # Generators are not thread-safe
+                    item = next(items, None)
+                if item is None:
+                    break
+
+                kind, batch = item
+                self.stats.name = batch[0][1] if kind == "file" else (archive_label or batch[0][1])
+                if kind == "archive":
+                    success = session.send_archive(batch, label=archive_label)
+                else:
+                    abs_path, remote_filename, size = batch[0]
+                    source = self.shared(abs_path, size) if self.shared else None
+                    success = session.send_file(abs_path, remote_filename=remote_filename,
+                                                planned=remote_filename in self.planned, source=source)
+
+                if success and self.journal is not None:
+                    self._record_sent(batch)
+                with self.lock:
+                    if not success and not self.manager.cancel_requested:
+                        print(f"Failed to send {batch[0][1]}" + (f" (+{len(batch) - 1} more)" if len(batch) > 1 else ""))
+                        self.failures.extend(batch)
+                        if self.stop_on_failure:
+                            self.stopped = True
+
 
 class NetworkManager:
-    def __init__(self, device_name, on_device_found=None, on_transfer_progress=None, on_confirmation=None, on_text_received=None):
+    def __init__(self, device_name, on_device_found=None, on_transfer_progress=None, on_confirmation=None, on_text_received=None, on_text_file=None, stripe_streams=1, batch_width=BATCH_WIDTH, delta_sync=False, compression=False, engine="asyncio", max_sessions=MAX_SESSIONS, accept_backlog=ACCEPT_BACKLOG, download_dir=None, accept_policy=None, on_transfer_metrics=None, telemetry=None, rate_limit=None, peer_rate_limit=None, journal_dir=None, write_behind=WRITE_BEHIND_DEPTH, fsync_bytes=0, secret=None, cipher=DEFAULT_CIPHER, content_index=None, checksums=False, listen=True):
         self.device_name = device_name
         self.on_device_found = on_device_found
         self.on_transfer_progress = on_transfer_progress
         self.on_confirmation = on_confirmation
+        # Unattended mode: accept_policy(sender_ip, filename, size) decides instead of on_confirmation
+        self.accept_policy = accept_policy
+        self.download_dir = download_dir or os.path.expanduser("~/Downloads")
+        # Per-transfer metrics: on_transfer_metrics(event) hears about every finished transfer
+        self.telemetry = telemetry or Telemetry()
+        if on_transfer_metrics:
+            self.telemetry.subscribe(on_transfer_metrics)
         self.on_text_received = on_text_received
+        self.on_text_file = on_text_file  # Gets the saved path of pastes too large to keep in memory
         self.running = True
         self.transfer_running = False
         self.cancel_requested = False # Flag for reliable cancellation
         self.on_discovery = None
-        self.found_devices = {}
+        self.found_devices = DeviceRegistry()
+        self.found_devices.subscribe(self._on_device_event)
+
+        # Encrypted transport (opt-in): with a pairing secret every transfer connection is authenticated and
+        # encrypted, and cleartext is refused both ways. "secure" in the beacon tells peers to expect it.
+        self.secure = SecureTransport(secret, cipher) if secret else None
+
+        # Client-only mode (listen=False, for one-shot sends): no transfer port and no presence beacons, only
+        # discovery queries from an ephemeral port. It runs next to a serving instance and is not listed by peers.
+        self.listen = listen
+        self.discovery = Discovery(BROADCAST_PORT, device_name, FEATURES + ["secure"] if self.secure else FEATURES,
+                                   client=not listen)
         
-        # Batch Transfer Tracking
-        self.accepted_group_id = None # Store the currently accepted Group ID
+        # Incoming transfers: acceptance, batch progress and cancellation per sender and batch
+        self.inbound = InboundRegistry()
+        self.confirm_lock = threading.Lock()  # One confirmation dialog at a time
+        self.batch_width = batch_width
+
+        # Striped transfers (opt-in): number of parallel connections per large file
+        self.stripe_streams = stripe_streams
+        self.stripe_transfers = {}
+        self.stripe_lock = threading.Lock()
+
+        # Delta sync (opt-in): update the receiver's older copy instead of sending a renamed duplicate
+        self.delta_sync = delta_sync
+
+        # End-to-end checksums (opt-in): the whole file is hashed on both sides and the root digests compared.
+        # Resumed chunks are always verified; this also catches corruption of the bytes sent this time, at the
+        # cost of a read and a hash pass per file and of splice on the receiver.
+        self.checksums = checksums
+
+        # Compressed frames (opt-in): zlib on a shared worker pool, created on first use
+        self.compression = compression
+        self.compress_pool = None
+        self.compress_pool_lock = threading.Lock()
+
+        # "asyncio" multiplexes accept/discovery on one loop with bounded sessions; "threads" is the classic engine
+        self.engine = engine
+        self.max_sessions = max_sessions
+        self.async_engine = None
+
+        self.text_channels = {}
+        self.text_channels_lock = threading.Lock()
+        self.served_text_channels = set()  # Incoming channels on their own threads, outside the session slots
+        self.text_delivered = {}  # Sender's channel id -> last sequence number delivered from it
+
+        # Outgoing bandwidth in bytes/s, overall and per peer (None: unlimited); text and small files go first
+        self.scheduler = Scheduler(rate_limit, peer_rate_limit)
+
+        # Receives that are not spliced write on a separate thread, up to write_behind buffers behind the socket
+        # (0: write inline); fsync_bytes > 0 syncs that often and at the end of each file
+        self.write_behind = write_behind
+        self.fsync_bytes = fsync_bytes
+
+        # Batch journals (opt-in): interrupted batches resume file by file after a restart of either side
+        self.journals = JournalStore(journal_dir) if journal_dir else None
+
+        # Content index (opt-in): a file already received under another name is copied locally, not sent again
+        self.content_index = ContentIndex(content_index) if content_index else None
         
         # Setup UDP Socket for Discovery
         self.udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        self.udp_sock.bind(("", BROADCAST_PORT))
+        self.udp_sock.bind(("", BROADCAST_PORT if listen else 0))
         
         # Setup TCP Socket for File Transfer
-        self.tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.tcp_sock.bind(("", TRANSFER_PORT))
-        self.tcp_sock.listen(5)
+        self.tcp_sock = None
+        if listen:
+            self.tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            if os.name != 'nt':
+                # Restarting right after a run must not fail on TIME_WAIT (on Windows this flag would allow port stealing)
+                self.tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.tcp_sock.bind(("", TRANSFER_PORT))
+            self.tcp_sock.listen(accept_backlog)
 
 
     def start(self):
+        if not self.listen:
+            threading.Thread(target=self._query_peers, daemon=True).start()
+            threading.Thread(target=self._listen_for_discovery, daemon=True).start()
+            threading.Thread(target=self._prune_devices, daemon=True).start()
+            return
+        if self.engine == "asyncio":
+            self.async_engine = AsyncEngine(self, max_sessions=self.max_sessions)
+            self.async_engine.start()
+            return
         threading.Thread(target=self._broadcast_presence, daemon=True).start()
         threading.Thread(target=self._listen_for_discovery, daemon=True).start()
         threading.Thread(target=self._prune_devices, daemon=True).start()
         threading.Thread(target=self._accept_transfers, daemon=True).start()
 
     def _broadcast_presence(self):
-        message = json.dumps({
-            "host": self.device_name,
-            "os": "windows"
-        }).encode('utf-8')
+        wake = threading.Event()
+        self.discovery.on_change = wake.set
+
+        # Startup burst: ask everyone to answer now instead of at their next beacon
+        started = time.time()
+        for offset in QUERY_BURST:
+            time.sleep(max(0, started + offset - time.time()))
+            self._send_beacon(self.discovery.beacon(query=True), self.udp_sock.sendto)
         
         while self.running:
-            try:
-                # 1. Send to global broadcast (keeping it for good measure)
-                self.udp_sock.sendto(message, ('<broadcast>', BROADCAST_PORT))
+            self._send_beacon(self.discovery.beacon(), self.udp_sock.sendto)
+            wake.wait(self.discovery.next_interval())
+            wake.clear()
 
-                # 2. Send to all interface broadcasts
-                if netifaces:
-                    for iface in netifaces.interfaces():
-                        try:
-                            addrs = netifaces.ifaddresses(iface)
-                            if netifaces.AF_INET in addrs:
-                                for addr in addrs[netifaces.AF_INET]:
-                                    broadcast = addr.get('broadcast')
-                                    if broadcast:
-                                        self.udp_sock.sendto(message, (broadcast, BROADCAST_PORT))
-                        except Exception:
-                            pass
-
-                time.sleep(1)
-            except Exception as e:
-                # print(f"Broadcast error: {e}")
-                time.sleep(2)
+    def _query_peers(self):
+        """Discovery of a client-only instance: it only hears the answers to its own queries."""
+        started = time.time()
+        for offset in QUERY_BURST:
+            time.sleep(max(0, started + offset - time.time()))
+            self._send_beacon(self.discovery.beacon(query=True), self.udp_sock.sendto)
+        while self.running:
+            time.sleep(CLIENT_QUERY_INTERVAL)
+            self._send_beacon(self.discovery.beacon(query=True), self.udp_sock.sendto)
+
+    def _send_beacon(self, message, sendto):
+        try:
+            for target in self.discovery.broadcast_targets():
+                sendto(message, target)
+        except Exception as e:
+            # print(f"Broadcast error: {e}")
+            self.discovery.send_failed()
+
+    def _handle_beacon(self, data, addr):
+        """Track the peer behind a beacon. Returns a unicast reply to send back, or None."""
+        ip, info, reply = self.discovery.handle(data, addr)
+        if ip is None:
+            return reply
+
+        device = self.found_devices.get(ip)
+        if device is None and info is not None:
+            device = Device(ip, info['host'], info['os'], time.time(), tuple(info.get('features', ())),
+                            info.get('interval'))
+            self.found_devices.add(device, Discovery.timeout_for(device.interval))
+            self.discovery.peer_added(info)
+        elif device is not None:
+            if info is not None and not info.get('query'):
+                interval = info.get('interval')
+                self.found_devices.touch(ip, Discovery.timeout_for(interval), interval=interval)
+            else:
+                self.found_devices.touch(ip)
+        return reply
+
+    def _on_device_event(self, event, device):
+        if event == ADDED:
+            if self.on_device_found:
+                self.on_device_found(device)
+        elif event == REMOVED:
+            self.discovery.peer_removed(device.ip, device.interval is None)
+            with self.text_channels_lock:
+                channel = self.text_channels.pop(device.ip, None)
+            if channel:
+                channel.close()
 
     def _listen_for_discovery(self):
         while self.running:
             try:
                 data, addr = self.udp_sock.recvfrom(1024)
-                ip = addr[0]
-                # Ignore own broadcasts
-                if ip == socket.gethostbyname(socket.gethostname()) or ip == '127.0.0.1':
-                    continue
-                    
-                info = json.loads(data.decode('utf-8'))
-                device = Device(ip, info['host'], info['os'], time.time())
-                
-                if ip not in self.found_devices:
-                    self.found_devices[ip] = device
-                    if self.on_device_found:
-                        self.on_device_found(device)
-                else:
-                    self.found_devices[ip].last_seen = time.time()
+                reply = self._handle_beacon(data, addr)
+                if reply:
+                    self.udp_sock.sendto(reply, addr)
             except Exception as e:
                 # print(f"Discovery listener error: {e}")
                 pass
 
+    def _prune_once(self):
+        self.found_devices.expire()
+
+    def _prune_delay(self):
+        """Sleep until the earliest device deadline, but wake at least once a second."""
+        deadline = self.found_devices.next_deadline()
+        if deadline is None:
+            return 1
+        return min(1, max(0.05, deadline - time.time()))
+
     def _prune_devices(self):
         while self.running:
-            time.sleep(1)
-            now = time.time()
-            # Create a list to avoid runtime error during iteration
-            to_remove = [ip for ip, dev in self.found_devices.items() if now - dev.last_seen > 3]
-            
-            for ip in to_remove:
-                # print(f"Device {ip} timed out")
-                del self.found_devices[ip]
-            
-            if to_remove and self.on_device_found:
-                 pass
+            time.sleep(self._prune_delay())
+            self._prune_once()
 
     def _accept_transfers(self):
         while self.running:
             try:
                 conn, addr = self.tcp_sock.accept()
                 sender_ip = addr[0]
+                self._prepare_accepted(conn)
                 threading.Thread(target=self._receive_file, args=(conn, sender_ip), daemon=True).start()
             except Exception as e:
                 print(f"Accept error: {e}")
 
 
-    def _receive_file(self, conn, sender_ip):
+    def peer_supports(self, ip, feature):
+        device = self.found_devices.get(ip)
+        return device is not None and feature in device.features
+
+    def _secure_client(self, s, ip):
+        """Wrap a connected outgoing socket: encrypted when we have a pairing secret, refused when only one side has."""
         try:
-            # Read header length
-            header_len_data = conn.recv(4)
-            if not header_len_data: return
-            header_len = struct.unpack('!I', header_len_data)[0]
-            
-            # Read header
-            header_data = conn.recv(header_len)
-            header = json.loads(header_data.decode('utf-8'))
-            filename = header['filename']
-            filesize = header['size']
+            if self.secure is None:
+                if self.peer_supports(ip, "secure"):
+                    raise ConnectionError(f"{ip} only accepts encrypted transfers; set the same pairing secret here")
+                return s
+            device = self.found_devices.get(ip)
+            if device is not None and "secure" not in device.features:
+                raise ConnectionError(f"{ip} has no pairing secret; not sending in cleartext")
+            return self.secure.client(s, ip)
+        except Exception:
+            s.close()
+            raise
+
+    def open_session(self, ip, group_id=None, group_size=None, progress=None):
+        return TransferSession(self, ip, group_id=group_id, group_size=group_size, progress=progress)
+
+    @staticmethod
+    def _prepare_accepted(conn):
+        """Bound every wait on an accepted socket, so a silent or vanished peer cannot hold a session for good."""
+        conn.settimeout(HEADER_TIMEOUT)
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+    def _receive_file(self, conn, sender_ip, release=None):
+        """Serve one accepted connection. release(), if given, frees its session slot early (see engine.py)."""
+        try:
+            if self.secure is not None:
+                conn = self.secure.server(conn, sender_ip)
+            header = _recv_header(conn)
+            if header is None: return
+            conn.settimeout(RECEIVE_TIMEOUT)
             msg_type = header.get('type', 'file')
-            group_id = header.get('group_id') # Get Group ID
-            group_size = header.get('group_size')
 
-            # --- TEXT HANDLING ---
             if msg_type == 'text':
-                # Send Offset 0
-                conn.send(struct.pack('!Q', 0))
-                
-                # Read Content
-                data = b""
-                received = 0
-                while received < filesize:
-                    chunk = conn.recv(min(BUFFER_SIZE, filesize - received))
-                    if not chunk: break
-                    data += chunk
-                    received += len(chunk)
-                
-                text_content = data.decode('utf-8')
-                if self.on_text_received:
-                    self.on_text_received(text_content)
-                return
-            # --- END TEXT HANDLING ---
-            
-            # Check auto-accept for batch transfers based on Group ID
-            auto_accepted = False
-            
-            if group_id is not None and group_id == self.accepted_group_id:
-                auto_accepted = True
-                print(f"[AutoAccept] Matched Group ID {group_id} for file {filename}")
+                self._receive_text(conn, header)
+            elif msg_type == 'text_channel':
+                # A mostly idle channel must not keep a session slot from transfers: it gets its own thread
+                with self.text_channels_lock:
+                    detach = len(self.served_text_channels) < MAX_TEXT_CHANNELS
+                    if detach:
+                        self.served_text_channels.add(conn)
+                if detach:
+                    threading.Thread(target=self._serve_text_channel, args=(conn, header), daemon=True).start()
+                    conn = None
+                else:
+                    self._receive_text_channel(conn, header)
+            elif msg_type == 'session':
+                self._receive_session(conn, header, sender_ip)
+            elif msg_type == 'stripe_open':
+                self._receive_stripe_open(conn, header, sender_ip, release)
+            elif msg_type == 'stripe':
+                self._receive_stripe(conn, header, release)
+            else:
+                self._receive_payload(conn, header, sender_ip)
+        except Exception as e:
+            print(f"Receive error: {e}")
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def _receive_text(self, conn, header):
+        filesize = header['size']
+        # Send Offset 0
+        conn.send(struct.pack('!Q', 0))
+        self._deliver_text(conn, filesize)
+
+    def _serve_text_channel(self, conn, header):
+        try:
+            self._receive_text_channel(conn, header)
+        except Exception as e:
+            print(f"Receive error: {e}")
+        finally:
+            conn.close()
+            with self.text_channels_lock:
+                self.served_text_channels.discard(conn)
+
+    def _receive_text_channel(self, conn, header):
+        """Deliver the pipelined messages of a peer's persistent text channel until it closes or goes idle.
+
+        With acks each message starts with its sequence number, which is echoed once it is delivered (see
+        TextChannel); one this channel delivered before is a resend and is acked again but not delivered.
+        """
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn.settimeout(TEXT_CHANNEL_TIMEOUT)
+        channel = header.get('channel') if header.get('acks') else None
+        while self.running:
+            try:
+                first = conn.recv(8)
+            except socket.timeout:
+                break  # The sender reconnects after TEXT_CHANNEL_IDLE, so nothing more comes on this one
+            if not first:
+                break
+            if len(first) < 8:
+                first += _recv_exact(conn, 8 - len(first))
+            if channel is None:
+                self._deliver_text(conn, struct.unpack('!Q', first)[0])
+                continue
+            seq = struct.unpack('!Q', first)[0]
+            size = struct.unpack('!Q', _recv_exact(conn, 8))[0]
+            with self.text_channels_lock:
+                fresh = seq > self.text_delivered.get(channel, 0)
+            if fresh:
+                self._deliver_text(conn, size)
+                with self.text_channels_lock:
+                    delivered = self.text_delivered
+                    delivered.pop(channel, None)
+                    if len(delivered) >= TEXT_ACK_SENDERS:
+                        del delivered[next(iter(delivered))]  # The longest quiet sender goes first
+                    delivered[channel] = seq
+            else:
+                while size:
+                    size -= len(_recv_exact(conn, min(BUFFER_SIZE, size)))
+            conn.sendall(struct.pack('!Q', seq))
+
+    def _deliver_text(self, conn, size):
+        """Read one text payload; large pastes go straight to a file instead of memory."""
+        if size <= TEXT_MEMORY_LIMIT:
+            text_content = _recv_exact(conn, size).decode('utf-8')
+            if self.on_text_received:
+                self.on_text_received(text_content)
+            return
+
+        save_path = self._unique_path(self._save_path_for(f"Pasted text {time.strftime('%Y%m%d-%H%M%S')}.txt"))
+        received = 0
+        with open(save_path, 'wb') as f:
+            while received < size:
+                chunk = conn.recv(min(BUFFER_SIZE, size - received))
+                if not chunk:
+                    raise ConnectionError("Connection closed inside text message")
+                f.write(chunk)
+                received += len(chunk)
+        print(f"Saved {size} bytes of text to {save_path}")
+        if self.on_text_file:
+            self.on_text_file(save_path)
+        elif self.on_text_received:
+            self.on_text_received(f"Large text saved to {save_path}")
+
+    def _receive_session(self, conn, session_header, sender_ip):
+        """Demultiplex the framed files of one session connection."""
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn.sendall(struct.pack('!Q', 0))  # Session ack
+
+        while self.running:
+            header = _recv_header(conn)
+            if header is None:
+                break
+            # Frames inherit the batch identity of their session
+            header.setdefault('group_id', session_header.get('group_id'))
+            header.setdefault('group_size', session_header.get('group_size'))
+            if header.get('type') == 'archive':
+                ok = self._receive_archive(conn, header, sender_ip)
+            elif header.get('type') == 'manifest':
+                ok = self._receive_manifest(conn, header, sender_ip)
             else:
-                 # Reset accepted group ID if it's a new group or no group
-                 if group_id != self.accepted_group_id:
-                      self.accepted_group_id = None
+                ok = self._receive_payload(conn, header, sender_ip)
+            if not ok:
+                break
+
+    def _inbound_session(self, sender_ip, header):
+        return self.inbound.session(sender_ip, header.get('group_id'), header.get('group_size'),
+                                    self.on_transfer_progress, header.get('growing'))
+
+    def _confirm_incoming(self, session, filename, filesize):
+        """Ask once per batch (or ungrouped file); later frames of the batch reuse the answer."""
+        with session.decision_lock:
+            if session.cancelled:
+                return False
+            if session.accepted is not None:
+                if session.accepted and self.accept_policy and (session.group_size or 0) > session.judged_size:
+                    # A streamed batch grew since the policy approved it: judge the new total
+                    session.judged_size = session.group_size
+                    if not self.accept_policy(session.sender_ip, filename, session.group_size):
+                        print(f"Batch {session.group_id} from {session.sender_ip} refused by policy at {session.group_size} bytes")
+                        session.accepted = False
+                if session.accepted:
+                    print(f"[AutoAccept] Matched Group ID {session.group_id} for file {filename}")
+                return session.accepted
 
-            # Request Confirmation (only if not auto-accepted)
-            if not auto_accepted and self.on_confirmation:
+            group_id = session.group_id
+            accepted = True
+            # A batch restarted after an interruption was accepted before
+            resumed = bool(group_id) and self.journals is not None and not session.restarted and \
+                self.journals.exists("receive", session.sender_ip, group_id)
+            if self.accept_policy:
+                # A batch is judged by its total size (again whenever a streamed batch grows)
+                session.judged_size = session.group_size or 0
+                if not self.accept_policy(session.sender_ip, filename, session.group_size or filesize):
+                    print(f"Transfer of {filename} from {session.sender_ip} refused by policy")
+                    accepted = False
+            elif resumed:
+                print(f"[Resume] Continuing batch {group_id} from {session.sender_ip}")
+            elif self.on_confirmation:
                 print(f"[Confirmation] Requesting for {filename} (Group: {group_id})")
-                
-                # If it's a batch, maybe display batch info? 
-                # For now standard prompt works, user accepts "Folder transfer" implicitly by accepting first file of group.
+
+                # User accepts "Folder transfer" implicitly by accepting first file of group.
                 display_name = f"{filename}"
-                if group_id and group_size:
+                if group_id and session.group_size:
                      display_name += " (Part of a batch)"
 
-                if not self.on_confirmation(display_name, filesize):
+                with self.confirm_lock:
+                    accepted = bool(self.on_confirmation(display_name, filesize))
+                if not accepted:
                     print("Transfer rejected by user")
-                    conn.close()
-                    return
-                
-                # User accepted
-                if group_id:
-                     self.accepted_group_id = group_id
+                elif group_id:
                      print(f"[AutoAccept] Set Accepted Group ID to {group_id}")
+            if accepted and group_id and self.journals is not None:
+                session.journal = self.journals.open("receive", session.sender_ip, group_id, group_id=group_id)
+            session.accepted = accepted
+            return accepted
 
+    def _save_path_for(self, filename, create_dirs=True):
+        """Map a remote relative name into the download directory. Returns None for unsafe names."""
+        # Sanitize filename
+        safe_filename = filename.replace('\\', '/')
+        safe_filename = safe_filename.lstrip('/')
+        if not safe_filename or '..' in safe_filename.split('/'):
+            print(f"Malicious filename detected: {filename}")
+            return None
 
-            # Sanitize filename
-            safe_filename = filename.replace('\\', '/')
-            safe_filename = safe_filename.lstrip('/')
-            if '..' in safe_filename.split('/'):
-                print(f"Malicious filename detected: {filename}")
-                return
+        # Construct save path
+        save_path = os.path.join(self.download_dir, safe_filename)
+        
+        parent_dir = os.path.dirname(save_path)
+        if create_dirs and not os.path.exists(parent_dir):
+            os.makedirs(parent_dir, exist_ok=True)
+        return save_path
 
-            # Construct save path
-            downloads_dir = os.path.expanduser("~/Downloads")
-            save_path = os.path.join(downloads_dir, safe_filename)
-            
-            parent_dir = os.path.dirname(save_path)
-            if not os.path.exists(parent_dir):
-                os.makedirs(parent_dir, exist_ok=True)
-            
+    @staticmethod
+    def _unique_path(save_path):
+        # Rename strategy
+        counter = 1
+        while os.path.exists(save_path):
+            name, ext = os.path.splitext(save_path)
+            save_path = f"{name}_{counter}{ext}"
+            counter += 1
+        return save_path
+
+    @staticmethod
+    def _adopt_partial(save_path, session, filename):
+        """Move a partial file left under its final name (by an older version) to save_path + PART_SUFFIX.
+
+        Only a file known to be partial moves: one with a preallocation sidecar, or one the batch journal
+        lists as partial. A shorter file is usually an older complete copy, which delta sync updates in place.
+        """
+        part_path = save_path + PART_SUFFIX
+        if os.path.exists(part_path) or not os.path.exists(save_path):
+            return
+        if os.path.exists(save_path + RANGES_SUFFIX):
+            os.replace(save_path + RANGES_SUFFIX, part_path + RANGES_SUFFIX)
+            os.replace(save_path, part_path)
+        elif session.journal is not None and filename in session.journal.partial:
+            os.replace(save_path, part_path)
+
+    def _receive_payload(self, conn, header, sender_ip):
+        """Receive one file frame. Returns True when the file arrived completely."""
+        metrics = self.telemetry.start("receive", "file", header['filename'], sender_ip, header['size'])
+        ok = False
+        try:
+            with self._inbound_session(sender_ip, header) as session:
+                ok = self._receive_file_frame(conn, header, session, metrics)
+            return ok
+        finally:
+            self.telemetry.finish(metrics, ok)
+
+    def _receive_file_frame(self, conn, header, session, metrics):
+        filename = header['filename']
+        filesize = header['size']
+
+        started = time.perf_counter()
+        confirmed = self._confirm_incoming(session, filename, filesize)
+        metrics.times['confirm'] += time.perf_counter() - started
+        if not confirmed:
+            return False
+
+        save_path = self._save_path_for(filename)
+        if save_path is None:
+            return False
+        self._adopt_partial(save_path, session, filename)
+        # Data goes to target (save_path + PART_SUFFIX) and is renamed into place once complete
+        target = save_path + PART_SUFFIX
+        
+        verify = header.get('verify', False)
+        # Hash what arrives for the sender's end-to-end checksum, or to index the file by content (dedup.py)
+        hashing = verify and (header.get('checksum', True) or self.content_index is not None)
+        resend = []
+        hasher = None
+
+        if header.get('planned'):
+            # Listed as missing in this batch's manifest reply: no resume negotiation
+            offset = 0
+            mode = 'wb'
+            known_leaves = {}
+            if hashing:
+                hasher = ChunkHasher()
+        elif verify:
+            plan = self._verified_resume(conn, filename, save_path, filesize, header.get('delta', False),
+                                         header.get('dedup', False))
+            if plan is None:
+                return False
+            save_path, target, offset, mode, resend, known_leaves, block_size = plan
+            if mode == 'delta':
+                metrics.kind = "delta"
+                return self._receive_delta(conn, filename, save_path, filesize, block_size, session,
+                                           header.get('mtime'), metrics)
+            if hashing:
+                hasher = ChunkHasher(first_index=offset // HASH_CHUNK_SIZE)
+        else:
             offset = 0
             mode = 'wb'
             
-            if os.path.exists(save_path):
-                current_size = os.path.getsize(save_path)
-                if current_size < filesize:
+            if os.path.exists(target):
+                current_size = self._recover_preallocation(target)
+                if current_size <= filesize:
                     print(f"Resuming {filename} from {current_size}")
                     offset = current_size
-                    mode = 'ab'
-                elif current_size == filesize:
-                    print(f"File {filename} already exists. Skipping.")
-                    # Rename strategy
-                    counter = 1
-                    while os.path.exists(save_path):
-                        name, ext = os.path.splitext(save_path)
-                        save_path = f"{name}_{counter}{ext}"
-                        counter += 1
+                    mode = 'r+b'
+            elif os.path.exists(save_path) and os.path.getsize(save_path) == filesize:
+                print(f"File {filename} already exists. Skipping.")
+                save_path = self._unique_path(save_path)
+                target = save_path + PART_SUFFIX
             
             # Send Offset to Sender
             conn.send(struct.pack('!Q', offset))
 
-            # Batch State Management
-            is_batch = False
-            if group_id and group_size:
-                 is_batch = True
-                 # Initialize or Reset Batch State if needed
-                 if not hasattr(self, 'batch_state') or self.batch_state['group_id'] != group_id:
-                      self.batch_state = {
-                          'group_id': group_id,
-                          'total_size': group_size,
-                          'received_base': 0
-                      }
-            
-            received = offset
-            start_time = time.time()
-            last_update_time = start_time
-            self.transfer_running = True
-            
-            with open(save_path, mode) as f:
-                while received < filesize:
-                    if not self.transfer_running:
-                         print("Transfer cancelled during loop")
-                         break
-
-                    chunk = conn.recv(min(BUFFER_SIZE, filesize - received))
-                    if not chunk: break
+        received = offset
+        metrics.resumed = offset
+        metrics.retries = len(resend)
+        counter = session.counter(filename, filesize, done=offset)
+        times = metrics.times
+        clock = time.perf_counter
+        chunks = 0
+        start_time = time.time()
+        source = _CompressedReader(conn) if header.get('compress') else conn
+        # Data nobody needs to see in user space (not hashed, decompressed or decrypted) is spliced in the kernel
+        splicer = Splicer() if SPLICE_AVAILABLE and hasher is None and isinstance(source, socket.socket) else None
+        buffers = BufferPool(BUFFER_SIZE, max(self.write_behind, RECV_BUFFERS)) if splicer is None else None
+        preallocated = filesize >= PREALLOCATE_MIN and filesize > offset
+        checkpoint = offset
+        
+        try:
+            with open(target, mode) as f:
+                # Chunks that failed verification are rewritten in place first
+                for index in resend:
+                    chunk_start = index * HASH_CHUNK_SIZE
+                    chunk = _recv_exact(conn, min(HASH_CHUNK_SIZE, filesize - chunk_start))
+                    f.seek(chunk_start)
                     f.write(chunk)
-                    received += len(chunk)
-                    
-                    current_time = time.time()
-                    if self.on_transfer_progress and (current_time - last_update_time > 0.1 or received == filesize):
-                        elapsed = current_time - start_time
-                        
-                        # Calculate Speed (Current File)
-                        speed = ((received - offset) / elapsed) if elapsed > 0 else 0
-                        
-                        # Calculate Stats (Batch or Single)
-                        if is_batch:
-                             total_to_show = self.batch_state['total_size']
-                             current_to_show = self.batch_state['received_base'] + received
-                             # ETA based on remaining BATCH size
-                             eta = (total_to_show - current_to_show) / speed if speed > 0 else 0
-                             mode_str = "Receiving Batch"
+                    known_leaves[index] = leaf_digest(chunk)
+                if mode == 'r+b':
+                    f.seek(offset)
+                    f.truncate()
+                if preallocated:
+                    # The sidecar records how much of the preallocated length is real data
+                    f.truncate(filesize)
+                    self._save_preallocation(target, filesize, received)
+                f.flush()
+
+                writer = None
+                if buffers is not None and self.write_behind:
+                    writer = WriteBehind(f, received, self.write_behind, self.fsync_bytes)
+                try:
+                    while received < filesize:
+                        if session.cancelled:
+                             print("Transfer cancelled during loop")
+                             break
+
+                        want = min(BUFFER_SIZE, filesize - received)
+                        if splicer:
+                            started = clock()
+                            count = splicer.splice(conn, f, received, want)
+                            times['splice'] += clock() - started
                         else:
-                             total_to_show = filesize
-                             current_to_show = received
-                             eta = (filesize - received) / speed if speed > 0 else 0
-                             mode_str = "Receiving"
+                            buf = buffers.acquire()
+                            view = memoryview(buf)[:want]
+                            started = clock()
+                            count = source.recv_into(view)
+                            if writer:
+                                # Hand the writer whole buffers: the ring's depth is then depth * BUFFER_SIZE bytes
+                                while 0 < count < want:
+                                    more = source.recv_into(view[count:])
+                                    if not more:
+                                        break
+                                    count += more
+                            written = clock()
+                            times['recv'] += written - started
+                            if count and writer:
+                                # Written, then hashed, then back to the pool; the loop returns to the socket now
+                                if hasher:
+                                    done = lambda data=view[:count], buf=buf: hasher.feed(
+                                        data, on_done=lambda: buffers.release(buf))
+                                else:
+                                    done = lambda buf=buf: buffers.release(buf)
+                                writer.write(view[:count], done)
+                            else:
+                                if count:
+                                    f.write(view[:count])
+                                    times['write'] += clock() - written
+                                if hasher and count:
+                                    hasher.feed(view[:count], on_done=lambda buf=buf: buffers.release(buf))
+                                else:
+                                    buffers.release(buf)
+                        if not count: break
+                        received += count
+                        chunks += 1
+                        counter.add(count)
 
-                        self.on_transfer_progress(filename, current_to_show, total_to_show, mode_str, speed, eta)
-                        last_update_time = current_time
+                        if preallocated and received - checkpoint >= STRIPE_CHECKPOINT:
+                            if writer is None:
+                                f.flush()
+                                position = received
+                            else:
+                                position = writer.position  # Only what the disk writer has flushed counts
+                            self._save_preallocation(target, filesize, position)
+                            checkpoint = received
+                finally:
+                    if writer is not None:
+                        try:
+                            writer.close()
+                        finally:
+                            received = writer.position  # Short of the bytes received if the disk failed
+                            times['write'] += writer.seconds
+        finally:
+            metrics.bytes += received - offset
+            metrics.chunks += chunks
+            session.end_counter(counter, keep=received == filesize and not session.cancelled)
+            if splicer:
+                splicer.close()
+            if preallocated:
+                if received < filesize:
+                    # Interrupted: leave a plain partial file the classic resume understands
+                    os.truncate(target, received)
+                os.remove(target + RANGES_SUFFIX)
+            if received < filesize:
+                session.record_partial(filename, received)
 
-            if not self.transfer_running:
+        if received < filesize or session.cancelled:
+            if hasher:
+                hasher.finish()
+            if session.cancelled:
                 print(f"Transfer of {filename} cancelled/paused.")
             else:
-                print(f"Received {filename} in {time.time() - start_time:.2f}s")
-                # Update Batch Base
-                if is_batch:
-                     self.batch_state['received_base'] += filesize
-            
-        except Exception as e:
-            print(f"Receive error: {e}")
+                print(f"Connection lost while receiving {filename}")
+            return False
+
+        digest = None
+        if verify:
+            # End-to-end check: our leaves must roll up to the sender's root digest, when it sent one
+            trailer = _recv_header(conn)
+            if hasher:
+                known_leaves.update(hasher.finish())
+                leaves = [known_leaves.get(i, b"") for i in range(chunk_count(filesize))]
+                digest = root_digest(leaves, filesize)
+            intact = trailer is not None and trailer.get('digest', digest) == digest
+            if not intact:
+                conn.sendall(struct.pack('!Q', 0))
+                print(f"Integrity check failed for {filename}")
+                return False
+
+        if target != save_path:
+            os.replace(target, save_path)
+        if 'mtime' in header:
+            os.utime(save_path, (header['mtime'], header['mtime']))
+        if verify:
+            # The sender journals the file as done on this ack, so it only comes once the file is in place
+            conn.sendall(struct.pack('!Q', 1))
+        session.record_done(filename, filesize, header.get('mtime'))
+        if digest is not None and self.content_index is not None:
+            self.content_index.add(digest, save_path)
+        print(f"Received {filename} in {time.time() - start_time:.2f}s")
+        return True
+
+    @staticmethod
+    def _save_preallocation(save_path, filesize, received):
+        with open(save_path + RANGES_SUFFIX, 'w') as f:
+            json.dump({'size': filesize, 'done': {0: received}}, f)
+
+    @staticmethod
+    def _trusted_size(save_path, current_size):
+        """Bytes of save_path that hold real data: a preallocation or stripe sidecar only vouches for its prefix."""
+        try:
+            with open(save_path + RANGES_SUFFIX, 'r') as f:
+                saved = json.load(f)
+            done = {int(a): b for a, b in saved['done'].items()}
+        except (OSError, ValueError, KeyError):
+            return current_size
+        return min(current_size, _resume_position(done, 0, saved.get('size', current_size)))
+
+    def _recover_preallocation(self, save_path):
+        """Cut a file left preallocated by a crash back to its real data. Returns the resulting size."""
+        current_size = os.path.getsize(save_path)
+        trusted = self._trusted_size(save_path, current_size)
+        if os.path.exists(save_path + RANGES_SUFFIX):
+            if trusted < current_size:
+                os.truncate(save_path, trusted)
+            os.remove(save_path + RANGES_SUFFIX)
+        return trusted
+
+    def _verified_resume(self, conn, filename, save_path, filesize, offer_delta=False, dedup=False):
+        """Offer chunk hashes of any existing copy; the sender answers with the chunks to re-send.
+
+        The existing copy is the partial file (save_path + PART_SUFFIX) if there is
+        one, else a complete file at save_path. With offer_delta the block
+        signatures of a complete copy are offered too, so the sender may answer
+        with a delta instead. Without any copy, a sender that offers dedup is
+        asked for its digest when the content index has a file of this size; a
+        match is cloned into the partial file and offered instead.
+        Returns (save_path, target, offset, mode, resend, known_leaves, block_size), where
+        target is the file to write into, or None if the sender went away.
+        """
+        part_path = save_path + PART_SUFFIX
+        existing = part_path if os.path.exists(part_path) else save_path
+        if existing == part_path:
+            offer_delta = False  # A delta rebuilds a complete old copy, not a fragment
+        current_size = self._recover_preallocation(existing) if os.path.exists(existing) else -1
+        if current_size == filesize:
+            leaves = hash_file_chunks(existing)
+            offset = filesize
+        elif 0 <= current_size < filesize:
+            # Resume from the last whole chunk; a trailing fragment cannot be verified
+            leaves = hash_file_chunks(existing, count=current_size // HASH_CHUNK_SIZE)
+            offset = len(leaves) * HASH_CHUNK_SIZE
+        else:
+            leaves = []
+            offset = 0
+
+        offer = {
+            "offset": offset,
+            "existing_size": current_size,
+            "chunk_size": HASH_CHUNK_SIZE,
+            "chunks": [leaf.hex() for leaf in leaves]
+        }
+        block_size = None
+        if offer_delta and current_size >= 0:
+            block_size = block_size_for(max(filesize, current_size))
+            weak_sums, strong_sums = file_signatures(save_path, block_size)
+            offer["delta"] = {
+                "block_size": block_size,
+                "weak": weak_sums,
+                "strong": [digest.hex() for digest in strong_sums]
+            }
+        if dedup and current_size < 0 and self.content_index is not None and self.content_index.has_size(filesize):
+            offer["want_digest"] = True
+        _send_header(conn, offer)
+        how = None  # How a matching copy was cloned, if one was
+        if offer.get("want_digest"):
+            announced = _recv_header(conn)
+            if announced is None:
+                return None
+            how = self.content_index.materialize(announced.get('digest'), filesize, part_path)
+            if how:
+                print(f"Copied {filename} from an earlier copy ({how}) instead of receiving it")
+                existing = part_path
+                current_size = offset = filesize
+                leaves = hash_file_chunks(part_path)
+                offer = {"offset": offset, "existing_size": current_size, "chunk_size": HASH_CHUNK_SIZE,
+                         "chunks": [leaf.hex() for leaf in leaves]}
+            else:
+                del offer["want_digest"]
+            _send_header(conn, offer)  # Offered again, with the clone if there was a match
+        reply = _recv_header(conn)
+        if reply is None:
+            return None
+
+        if reply.get('delta'):
+            print(f"Updating existing {filename} with a delta")
+            return save_path, save_path, 0, 'delta', [], {}, block_size
+        if reply.get('fresh'):
+            if existing == part_path:
+                print(f"Partial {filename} has different content; starting over.")
+                return save_path, part_path, 0, 'wb', [], {}, None
+            print(f"File {filename} already exists with different content.")
+            save_path = self._unique_path(save_path)
+            return save_path, save_path + PART_SUFFIX, 0, 'wb', [], {}, None
+
+        resend = reply.get('resend', [])
+        skipped = set(resend)
+        known_leaves = {i: leaf for i, leaf in enumerate(leaves) if i not in skipped}
+        if current_size == filesize and not resend and not how:
+            print(f"File {filename} already exists and is identical. Skipping.")
+        elif offset:
+            print(f"Resuming {filename} from {offset}, re-sending {len(resend)} damaged chunk(s)")
+        if existing == save_path and offset == filesize and not resend:
+            return save_path, save_path, offset, 'r+b', [], known_leaves, None  # Nothing to write
+        if existing == save_path and offset:
+            os.replace(save_path, part_path)  # Repaired under the partial name
+        return save_path, part_path, offset, 'r+b' if offset else 'wb', resend, known_leaves, None
+
+    def _receive_delta(self, conn, filename, save_path, filesize, block_size, session, mtime=None, metrics=None):
+        """Rebuild save_path from its old copy plus the sender's copy/literal operations."""
+        tmp_path = save_path + DELTA_SUFFIX
+        counter = session.counter(filename, filesize)
+        hasher = ChunkHasher()
+        written = 0
+        times = metrics.times if metrics else {'recv': 0.0, 'write': 0.0}
+        clock = time.perf_counter
+        literal = ops = 0
+        start_time = time.time()
+        cancelled = False
+
+        try:
+            with open(save_path, 'rb') as old, open(tmp_path, 'wb') as out:
+                while True:
+                    if session.cancelled:
+                        print("Transfer cancelled during loop")
+                        cancelled = True
+                        break
+
+                    op = _recv_exact(conn, 1)
+                    if op == b'E':
+                        break
+                    ops += 1
+                    if op == b'C':
+                        first, count = struct.unpack('!QI', _recv_exact(conn, 12))
+                        old.seek(first * block_size)
+                        remaining = count * block_size
+                        while remaining > 0:
+                            data = old.read(min(BUFFER_SIZE, remaining))
+                            if not data: break
+                            started = clock()
+                            out.write(data)
+                            times['write'] += clock() - started
+                            hasher.feed(data)
+                            written += len(data)
+                            counter.add(len(data))
+                            remaining -= len(data)
+                    elif op == b'L':
+                        started = clock()
+                        length = struct.unpack('!I', _recv_exact(conn, 4))[0]
+                        data = _recv_exact(conn, length)
+                        written_at = clock()
+                        out.write(data)
+                        times['recv'] += written_at - started
+                        times['write'] += clock() - written_at
+                        hasher.feed(data)
+                        literal += length
+                        written += length
+                        counter.add(length)
+                    else:
+                        raise ValueError(f"Unknown delta operation {op!r}")
         finally:
-            conn.close()
+            leaves = hasher.finish()
+            if metrics:
+                metrics.bytes += literal
+                metrics.chunks += ops
+            session.end_counter(counter, keep=written == filesize and not cancelled)
+
+        if cancelled:
+            os.remove(tmp_path)
+            return False
+
+        trailer = _recv_header(conn)
+        digest = root_digest([leaves.get(i, b"") for i in range(chunk_count(filesize))], filesize)
+        intact = written == filesize and trailer is not None and trailer.get('digest') == digest
+        if intact:
+            os.replace(tmp_path, save_path)
+            if mtime is not None:
+                os.utime(save_path, (mtime, mtime))
+            session.record_done(filename, filesize, mtime)
+            if self.content_index is not None:
+                self.content_index.add(digest, save_path)
+        else:
+            os.remove(tmp_path)
+        conn.sendall(struct.pack('!Q', 1 if intact else 0))
+        if not intact:
+            print(f"Integrity check failed for delta of {filename}")
+            return False
+
+        print(f"Updated {filename} in {time.time() - start_time:.2f}s")
+        return True
+
+    def _receive_manifest(self, conn, header, sender_ip=None):
+        """Answer a batch manifest with the entries that are already here, partial or changed."""
+        with self._inbound_session(sender_ip, header) as session:
+            return self._answer_manifest(conn, header, session)
+
+    def _answer_manifest(self, conn, header, session):
+        entries = header.get('entries', [])
+
+        if header.get('first'):
+            session.restart()
+        if not self._confirm_incoming(session, header['filename'], header['size']):
+            _send_header(conn, {"accepted": False})
+            return False
+
+        skip = []
+        partial = []
+        changed = []
+        probe = []  # Missing here, but the content index has a file of that size
+        skipped_bytes = 0
+        journal = session.journal
+        for index, (filename, size, mtime) in enumerate(entries):
+            if journal is not None:
+                # A resumed batch: the journal knows without touching the disk
+                if journal.is_done(filename, size, mtime):
+                    skip.append(index)
+                    skipped_bytes += size
+                    continue
+                if filename in journal.partial:
+                    partial.append([index, journal.partial[filename]])
+                    continue
+            save_path = self._save_path_for(filename, create_dirs=False)
+            if save_path is None:
+                continue
+            try:
+                st = os.stat(save_path)
+            except OSError:
+                st = None
+            current_size = self._trusted_size(save_path, st.st_size) if st is not None else -1
+            if current_size == size and int(st.st_mtime) == mtime:
+                skip.append(index)
+                skipped_bytes += size
+                continue
+            part_path = save_path + PART_SUFFIX
+            if os.path.exists(part_path):
+                partial.append([index, self._trusted_size(part_path, os.path.getsize(part_path))])
+            elif st is None:
+                if self.content_index is not None and size >= SMALL_FILE_THRESHOLD and self.content_index.has_size(size):
+                    probe.append(index)  # Sent with resume negotiation, so a copy here can be found by digest
+                continue  # Missing
+            elif current_size < size:
+                partial.append([index, current_size])
+            else:
+                changed.append(index)
+
+        session.add_skipped(skipped_bytes)
+        print(f"Manifest of {len(entries)} files: {len(skip)} identical, {len(partial)} partial, {len(changed)} changed"
+              + (f", {len(probe)} to look up by content" if probe else ""))
+        _send_header(conn, {"accepted": True, "skip": skip, "partial": partial, "changed": changed, "probe": probe})
+        return True
+
+    def _receive_archive(self, conn, header, sender_ip=None):
+        """Unpack a streamed tar frame of small files straight into the download directory."""
+        with self._inbound_session(sender_ip, header) as session:
+            return self._unpack_archive(conn, header, session)
+
+    def _unpack_archive(self, conn, header, session):
+        label = header['filename']
+        total = header['size']
+        metrics = self.telemetry.start("receive", "archive", label, session.sender_ip, total)
+
+        started = time.perf_counter()
+        confirmed = self._confirm_incoming(session, f"{label} ({header.get('count', 0)} files)", total)
+        metrics.times['confirm'] += time.perf_counter() - started
+        if not confirmed:
+            self.telemetry.finish(metrics, False)
+            return False
+        conn.sendall(struct.pack('!Q', 0))
+
+        counter = session.counter(label, total)
+        reader = _FramedReader(conn)
+        count = 0
+        start_time = time.time()
+        ok = False
+        started = time.perf_counter()
+
+        try:
+            with tarfile.open(fileobj=reader, mode='r|') as tar:
+                for member in tar:
+                    if session.cancelled:
+                        print("Transfer cancelled during archive")
+                        return False
+                    if not member.isfile():
+                        continue
+                    # Same sanitization rules as single-file frames
+                    save_path = self._save_path_for(member.name)
+                    if save_path is None:
+                        continue
+                    if os.path.exists(save_path) and os.path.getsize(save_path) == member.size:
+                        save_path = self._unique_path(save_path)
+
+                    src = tar.extractfile(member)
+                    part_path = save_path + PART_SUFFIX
+                    with open(part_path, 'wb') as f:
+                        shutil.copyfileobj(src, f, BUFFER_SIZE)
+                    os.replace(part_path, save_path)
+                    os.utime(save_path, (member.mtime, member.mtime))
+                    session.record_done(member.name, member.size, int(member.mtime))
+                    counter.add(member.size)
+                    metrics.bytes += member.size
+                    count += 1
+
+            reader.drain()
+            conn.sendall(struct.pack('!Q', count))
+            ok = True
+        finally:
+            metrics.times['recv'] += time.perf_counter() - started  # Unpacking and writing included
+            metrics.chunks = count
+            self.telemetry.finish(metrics, ok)
+            session.end_counter(counter, keep=ok)
+        print(f"Unpacked {count} files from {label} in {time.time() - start_time:.2f}s")
+        return True
+
+    def _receive_stripe_open(self, conn, header, sender_ip=None, release=None):
+        """Control connection of a striped transfer: confirm, preallocate, then wait for completion."""
+        with self._inbound_session(sender_ip, header) as session:
+            self._receive_striped_file(conn, header, session, release)
+
+    def _receive_striped_file(self, conn, header, session, release=None):
+        filename = header['filename']
+        filesize = header['size']
+        stripe_id = header['stripe_id']
+        metrics = self.telemetry.start("receive", "striped", filename, session.sender_ip, filesize)
+
+        started = time.perf_counter()
+        confirmed = self._confirm_incoming(session, filename, filesize)
+        metrics.times['confirm'] += time.perf_counter() - started
+        save_path = self._save_path_for(filename) if confirmed else None
+        if save_path is None:
+            self.telemetry.finish(metrics, False)
+            return
+
+        # done maps range start -> absolute position reached, persisted beside the partial file
+        done = {}
+        self._adopt_partial(save_path, session, filename)
+        part_path = save_path + PART_SUFFIX
+        ranges_path = part_path + RANGES_SUFFIX
+        if os.path.exists(ranges_path) and os.path.exists(part_path):
+            try:
+                with open(ranges_path, 'r') as f:
+                    saved = json.load(f)
+                if saved.get('size') == filesize:
+                    done = {int(a): b for a, b in saved['done'].items()}
+                    print(f"Resuming striped {filename}")
+            except (OSError, ValueError, KeyError):
+                done = {}
+        elif os.path.exists(part_path):
+            current_size = os.path.getsize(part_path)
+            if current_size <= filesize:
+                # A classic partial file is just a completed prefix range
+                print(f"Resuming {filename} from {current_size}")
+                done = {0: current_size}
+        elif os.path.exists(save_path) and os.path.getsize(save_path) == filesize:
+            print(f"File {filename} already exists. Skipping.")
+            save_path = self._unique_path(save_path)
+            part_path = save_path + PART_SUFFIX
+            ranges_path = part_path + RANGES_SUFFIX
+
+        # Preallocate so every stream can write at its own offset
+        with open(part_path, 'r+b' if os.path.exists(part_path) else 'wb') as f:
+            f.truncate(filesize)
+
+        state = {
+            'path': part_path,
+            'ranges_path': ranges_path,
+            'filename': filename,
+            'size': filesize,
+            'done': done,
+            'session': session,
+            'counter': session.counter(filename, filesize, done=sum(b - a for a, b in done.items())),
+            'lock': threading.Lock(),
+            'start_time': time.time(),
+            'metrics': metrics,
+            'streams': 0,  # Range connections open right now
+        }
+        metrics.resumed = sum(b - a for a, b in done.items())
+        with self.stripe_lock:
+            self.stripe_transfers[stripe_id] = state
+
+        try:
+            conn.sendall(struct.pack('!Q', 0))
+            if release:
+                release()  # Waiting for the ranges must not take a slot they need
+            # The sender reports back once every range has been acknowledged. The control connection is silent
+            # meanwhile, which is fine while a range is still open (each of those times out on its own).
+            while True:
+                try:
+                    _recv_exact(conn, 8)
+                    break
+                except socket.timeout:
+                    with state['lock']:
+                        if not state['streams']:
+                            raise
+            with state['lock']:
+                complete = _covers(done, filesize)
+            conn.sendall(struct.pack('!Q', 1 if complete else 0))
+        finally:
+            with self.stripe_lock:
+                self.stripe_transfers.pop(stripe_id, None)
+            with state['lock']:
+                complete = _covers(done, filesize)
+                session.end_counter(state['counter'], keep=complete)
+                if complete:
+                    if os.path.exists(ranges_path):
+                        os.remove(ranges_path)
+                    os.replace(part_path, save_path)
+                    session.record_done(filename, filesize, None)
+                else:
+                    self._save_stripe_ranges(state)
+                    session.record_partial(filename, _resume_position(done, 0, filesize))
+            self.telemetry.finish(metrics, complete)
+            if complete:
+                print(f"Received {filename} in {time.time() - state['start_time']:.2f}s")
+
+    @staticmethod
+    def _save_stripe_ranges(state):
+        with open(state['ranges_path'], 'w') as f:
+            json.dump({'size': state['size'], 'done': state['done']}, f)
+
+    def _receive_stripe(self, conn, header, release=None):
+        """One byte range of a striped transfer, written at its offset."""
+        with self.stripe_lock:
+            state = self.stripe_transfers.get(header['stripe_id'])
+        if state is None:
+            print("Unknown stripe transfer")
+            return
+        if release:
+            release()  # Part of a transfer already accepted: its streams never wait for slots
+        with state['lock']:
+            state['streams'] += 1
+        try:
+            self._receive_stripe_range(conn, header, state)
+        finally:
+            with state['lock']:
+                state['streams'] -= 1
+
+    def _receive_stripe_range(self, conn, header, state):
+
+        start = header['start']
+        end = header['end']
+        done = state['done']
+        with state['lock']:
+            pos = _resume_position(done, start, end)
+            done[start] = max(done.get(start, start), pos)
+        conn.sendall(struct.pack('!Q', pos))
+
+        checkpoint = pos
+        first = pos
+        part = state['counter'].part()
+        splicer = Splicer() if SPLICE_AVAILABLE and isinstance(conn, socket.socket) else None
+        buf = memoryview(bytearray(BUFFER_SIZE)) if splicer is None else None
+        # Timed locally and merged once: the ranges arrive concurrently
+        times = {'recv': 0.0, 'write': 0.0, 'splice': 0.0}
+        clock = time.perf_counter
+        chunks = 0
+        try:
+            with open(state['path'], 'r+b') as f:
+                f.seek(pos)
+                while pos < end:
+                    if state['session'].cancelled:
+                        print("Transfer cancelled during loop")
+                        break
+
+                    want = min(BUFFER_SIZE, end - pos)
+                    started = clock()
+                    if splicer:
+                        count = splicer.splice(conn, f, pos, want)
+                        times['splice'] += clock() - started
+                    else:
+                        count = conn.recv_into(buf, want)
+                        written = clock()
+                        f.write(buf[:count])
+                        times['recv'] += written - started
+                        times['write'] += clock() - written
+                    if not count: break
+                    pos += count
+                    chunks += 1
+                    part.add(count)
+
+                    with state['lock']:
+                        done[start] = pos
+                        if pos - checkpoint >= STRIPE_CHECKPOINT:
+                            f.flush()
+                            self._save_stripe_ranges(state)
+                            checkpoint = pos
+        finally:
+            # Written bytes are on disk and recorded in `done`, so they count even if the range broke off
+            part.close()
+            state['metrics'].merge(times, bytes=pos - first, chunks=chunks)
+            if splicer:
+                splicer.close()
+
+        if pos == end:
+            conn.sendall(struct.pack('!Q', pos))  # Range ack
 
-    def send_text(self, ip, text):
+    def _text_channel(self, ip):
+        with self.text_channels_lock:
+            channel = self.text_channels.get(ip)
+            if channel is None:
+                channel = self.text_channels[ip] = TextChannel(self, ip)
+            return channel
+
+    def _lane(self, ip, priority):
+        return self.scheduler.lane(ip, priority, cancelled=lambda: self.cancel_requested)
+
+    def send_text(self, ip, text, echo=False):
+        """Send a text message. echo=True marks clipboard sync: an identical repeat within TEXT_DEDUP_WINDOW
+        is then taken for our own text coming back and dropped. Explicit sends always go out."""
+        # Bulk sends pause between chunks while the message goes out
+        with self._lane(ip, TEXT):
+            return self._send_text(ip, text, echo)
+
+    def _send_text(self, ip, text, echo=False):
+        if self.peer_supports(ip, "textchan"):
+            try:
+                return self._text_channel(ip).send(text, echo)
+            except Exception as e:
+                print(f"Send text error: {e}")
+                return False
         try:
             data = text.encode('utf-8')
             size = len(data)
@@ -313,6 +2026,7 @@ class NetworkManager:
             
             s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             s.connect((ip, TRANSFER_PORT))
+            s = self._secure_client(s, ip)
             
             # Send Header
             s.send(struct.pack('!I', len(header)))
@@ -331,86 +2045,519 @@ class NetworkManager:
             print(f"Send text error: {e}")
             return False
 
-    def send_file(self, ip, file_path, remote_filename=None, group_id=None, group_size=None):
+    def send_file(self, ip, file_path, remote_filename=None, group_id=None, group_size=None, progress=None, source=None):
         if self.cancel_requested:
              return False
+        if source is None and self._wants_stripes(ip, file_path):
+            return self.send_file_striped(ip, file_path, remote_filename=remote_filename,
+                                          group_id=group_id, group_size=group_size, progress=progress)
 
+        metrics = self.telemetry.start("send", "file", remote_filename or os.path.basename(file_path), ip, 0)
+        ok = False
         try:
-            filesize = os.path.getsize(file_path)
-            # Use provided remote name (for relative paths) or basename
-            filename = remote_filename if remote_filename else os.path.basename(file_path)
+            # A lone small file (a screenshot, a document) goes ahead of batches and large files
+            small = group_id is None and os.path.getsize(file_path) < SMALL_PRIORITY_SIZE
+            started = time.perf_counter()
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            s.connect((ip, TRANSFER_PORT))
+            s = self._secure_client(s, ip)
+            metrics.times['connect'] += time.perf_counter() - started
+            try:
+                ok = self._send_file_frame(s, file_path, remote_filename, group_id, group_size, progress,
+                                           metrics=metrics, priority=SMALL if small else BULK, source=source)
+                return ok
+            finally:
+                s.close()
+        except Exception as e:
+            print(f"Send error: {e}")
+            return False
+        finally:
+            self.telemetry.finish(metrics, ok)
+
+    def _send_file_frame(self, s, file_path, remote_filename=None, group_id=None, group_size=None, progress=None, planned=False, metrics=None, priority=BULK, source=None):
+        """Send one header + offset exchange + data on an already-connected socket.
+
+        A planned frame skips the offset exchange: the receiver's manifest reply already said it has nothing.
+        metrics (the caller's TransferMetrics) collects this frame's counters and timings.
+        priority is the scheduler class the data is sent in. source, a fanout.SharedSource of this file,
+        replaces the file reads (and the digest) with chunks shared between several peers.
+        """
+        progress = progress or self.on_transfer_progress
+        st = os.stat(file_path)
+        filesize = st.st_size
+        # Use provided remote name (for relative paths) or basename
+        filename = remote_filename if remote_filename else os.path.basename(file_path)
+        metrics = metrics or self.telemetry.start("send", "file", filename, None, filesize)
+        metrics.size = filesize
+        
+        header_dict = {
+            "filename": filename,
+            "size": filesize,
+            "type": "file"
+        }
+        if group_id:
+            header_dict["group_id"] = group_id
+        if group_size:
+            header_dict["group_size"] = group_size
+
+        peer_ip = s.getpeername()[0]
+        verify = self.peer_supports(peer_ip, "verify")
+        if verify:
+            header_dict["verify"] = True
+            header_dict["checksum"] = self.checksums  # Whether a root digest follows the data (see below)
+            header_dict["dedup"] = True  # We announce our digest if the receiver asks (see dedup.py)
+            if self.delta_sync and self.peer_supports(peer_ip, "delta") and source is None:
+                header_dict["delta"] = True
+        if self.peer_supports(peer_ip, "manifest"):
+            # The receiver keeps our mtime so a later manifest can recognize the file
+            header_dict["mtime"] = int(st.st_mtime)
+            if planned:
+                header_dict["planned"] = True
+        compress = (self.compression and self.peer_supports(peer_ip, "compress") and source is None
+                    and not is_precompressed(file_path))
+        if compress:
+            header_dict["compress"] = True
+
+        # Send Header
+        _send_header(s, header_dict)
+        
+        delta_plan = None
+        if header_dict.get("planned"):
+            offset = 0
+            resend = []
+            digest = (source or FileDigest(file_path, filesize)) if verify and self.checksums else None
+        elif verify:
+            offset, resend, digest, delta_plan = self._plan_verified_resume(s, file_path, filesize, metrics, source,
+                                                                            self.checksums)
+        else:
+            # Receive Offset
+            started = time.perf_counter()
+            offset_data = _recv_exact(s, 8)
+            metrics.times['confirm'] += time.perf_counter() - started
+            offset = struct.unpack('!Q', offset_data)[0]
+            resend = []
+        if not delta_plan:
+            metrics.resumed = offset
+            metrics.retries = len(resend)
+
+        counter = start_counter(progress, filename, filesize, "sending", done=0 if delta_plan else offset)
+        ok = False
+        try:
+            with self._lane(peer_ip, priority) as lane:
+                if delta_plan:
+                    started = time.perf_counter()
+                    waited = metrics.times['wait']
+                    sent = self._send_delta(s, file_path, filesize, delta_plan, counter, lane, metrics)
+                    waited = metrics.times['wait'] - waited
+                    metrics.times['send'] += time.perf_counter() - started - waited  # Delta encoding included
+                else:
+                    if offset > 0:
+                        print(f"Resuming sending from {offset}")
+                    if source is not None:
+                        sent = self._send_shared_data(s, source, offset, resend, counter, lane, metrics)
+                    else:
+                        sent = self._send_file_data(s, file_path, filesize, offset, resend, counter, lane, compress,
+                                                    metrics)
+
+            if verify and sent == filesize:
+                # The receiver acknowledges every verified transfer; the digest is only there with checksums on
+                _send_header(s, {"digest": digest.result()} if digest is not None else {})
+                if struct.unpack('!Q', _recv_exact(s, 8))[0] != 1:
+                    print(f"Integrity check failed for {filename}")
+                    return False
+
+            ok = sent == filesize and self.transfer_running and not self.cancel_requested
+        finally:
+            end_counter(counter, keep=ok)
+        return ok
+
+    def _send_file_data(self, s, file_path, filesize, offset, resend, counter, lane, compress=False, metrics=None):
+        """Send re-requested chunks, then the file from offset. Returns the position reached.
+
+        With compress the part from offset goes out as compressed_records; incompressible chunks still use sendfile.
+        lane (a shaping.Lane) paces every chunk.
+        """
+        times = metrics.times if metrics else {'send': 0.0, 'compress': 0.0, 'wait': 0.0}
+        wire = chunks = 0
+        clock = time.perf_counter
+        # Zero-copy send
+        with open(file_path, 'rb') as f:
+            for index in resend:
+                chunk_start = index * HASH_CHUNK_SIZE
+                count = min(HASH_CHUNK_SIZE, filesize - chunk_start)
+                times['wait'] += lane.throttle(count)
+                started = clock()
+                wire += s.sendfile(f, offset=chunk_start, count=count)
+                times['send'] += clock() - started
+            f.seek(offset)
+            sent = offset
+            self.transfer_running = True
+            records = compressed_records(f, offset, filesize, self._compress_pool()) if compress else None
             
+            while sent < filesize:
+                if self.cancel_requested or not self.transfer_running:
+                     break
+
+                if records is not None:
+                    started = clock()
+                    record, payload, count = next(records)
+                    times['compress'] += clock() - started
+                    times['wait'] += lane.throttle(count if payload is None else len(payload))
+                    started = clock()
+                    if payload is None:
+                        s.sendall(record)
+                        if s.sendfile(f, offset=sent, count=count) != count: break
+                        wire += len(record) + count
+                    else:
+                        s.sendall(record + payload)
+                        wire += len(record) + len(payload)
+                    times['send'] += clock() - started
+                else:
+                    # socket.sendfile is available in Python 3.5+
+                    count = lane.chunk(min(BUFFER_SIZE, filesize - sent))
+                    times['wait'] += lane.throttle(count)
+                    started = clock()
+                    count = s.sendfile(f, offset=sent, count=count)
+                    times['send'] += clock() - started
+                    wire += count
+                if count == 0: break
+                sent += count
+                chunks += 1
+                counter.add(count)
+        if metrics:
+            metrics.bytes += wire
+            metrics.chunks += chunks
+        return sent
+
+    def _send_shared_data(self, s, source, offset, resend, counter, lane, metrics):
+        """_send_file_data for a fan-out: the same steps, with chunks from the shared source instead of sendfile."""
+        times = metrics.times
+        filesize = source.filesize
+        wire = chunks = 0
+        clock = time.perf_counter
+        for index in resend:
+            data = source.chunk(index)
+            times['wait'] += lane.throttle(len(data))
+            started = clock()
+            s.sendall(data)
+            times['send'] += clock() - started
+            wire += len(data)
+        sent = offset
+        self.transfer_running = True
+        while sent < filesize:
+            if self.cancel_requested or not self.transfer_running:
+                break
+            index, skip = divmod(sent, source.chunk_size)
+            started = clock()
+            data = memoryview(source.chunk(index))[skip:]  # Reading included when this peer is in the lead
+            times['send'] += clock() - started
+            if not data:
+                break  # The file shrank
+            step = lane.chunk(len(data))
+            for start in range(0, len(data), step):
+                piece = data[start:start + step]
+                times['wait'] += lane.throttle(len(piece))
+                started = clock()
+                s.sendall(piece)
+                times['send'] += clock() - started
+            sent += len(data)
+            wire += len(data)
+            chunks += 1
+            counter.add(len(data))
+        metrics.bytes += wire
+        metrics.chunks += chunks
+        return sent
+
+    def _plan_verified_resume(self, s, file_path, filesize, metrics=None, source=None, checksum=True):
+        """Compare the receiver's chunk hashes with ours and tell it which chunks to re-send.
+
+        With a shared source (see fanout.py) the source doubles as the digest, reusing the leaves hashed here.
+        Without checksum no digest is returned (None), except for delta transfers, which are always checked.
+        """
+        started = time.perf_counter()
+        offer = _recv_header(s)
+        if offer is None:
+            raise ConnectionError("Receiver closed during resume negotiation")
+        if offer.get('chunk_size', HASH_CHUNK_SIZE) != HASH_CHUNK_SIZE:
+            raise ValueError("Receiver uses a different hash chunk size")
+        hashed = time.perf_counter()
+
+        known = None  # All our leaves, when the receiver asked for the digest
+        digesting = 0.0
+        if offer.get('want_digest'):
+            # The receiver holds a file of this size: announce our digest so it can copy a match locally
+            known = hash_file_chunks(file_path)
+            digesting = time.perf_counter() - hashed
+            _send_header(s, {"digest": root_digest(known, filesize)})
+            offer = _recv_header(s)
+            if offer is None:
+                raise ConnectionError("Receiver closed during resume negotiation")
+            hashed = time.perf_counter()
+
+        remote = [bytes.fromhex(leaf) for leaf in offer['chunks']]
+        local = known[:len(remote)] if known is not None else hash_file_chunks(file_path, count=len(remote))
+        if metrics:
+            metrics.times['confirm'] += hashed - started - digesting
+            metrics.times['hash'] += time.perf_counter() - hashed + digesting
+        resend = [i for i, (mine, theirs) in enumerate(zip(local, remote)) if mine != theirs]
+        offset = offer['offset']
+        if source is not None:
+            for index, leaf in enumerate(known or local):
+                source.leaves.setdefault(index, leaf)
+
+        # An older, edited copy on the receiver: send only what changed
+        delta_plan = offer.get('delta')
+        if delta_plan and (resend or offer.get('existing_size', 0) > filesize):
+            _send_header(s, {"delta": True})
+            return filesize, [], FileDigest(file_path, filesize, known_leaves=local), delta_plan
+
+        # A complete copy with different content is a different file: send ours alongside it
+        fresh = offset >= filesize and len(resend) > 0
+        if fresh:
+            offset = 0
+            resend = []
+            local = []
+        _send_header(s, {"resend": resend, "fresh": fresh})
+        if not checksum:
+            return offset, resend, None, None
+        digest = source if source is not None else FileDigest(file_path, filesize, known_leaves=known or local)
+        return offset, resend, digest, None
+
+    def _send_delta(self, s, file_path, filesize, plan, counter, lane, metrics=None):
+        """Stream copy/literal operations that rebuild file_path from the receiver's copy."""
+        block_size = plan['block_size']
+        strong_sums = [bytes.fromhex(digest) for digest in plan['strong']]
+        out = bytearray()
+        described = 0
+        self.transfer_running = True
+
+        def emit(record, data=b""):
+            nonlocal out
+            out += record
+            out += data
+            if len(out) >= BUFFER_SIZE:
+                flush()
+
+        def flush():
+            nonlocal out
+            waited = lane.throttle(len(out))
+            s.sendall(out)
+            if metrics:
+                metrics.times['wait'] += waited
+                metrics.bytes += len(out)
+                metrics.chunks += 1
+            out = bytearray()
+
+        def advance(count):
+            nonlocal described
+            if self.cancel_requested or not self.transfer_running:
+                raise ConnectionAbortedError("Transfer cancelled")
+            # The last copied block may be short, so never count past the file
+            count = min(count, filesize - described)
+            described += count
+            counter.add(count)
+
+        def on_copy(first, count):
+            emit(b'C' + struct.pack('!QI', first, count))
+            advance(count * block_size)
+
+        def on_literal(data):
+            for i in range(0, len(data), BUFFER_SIZE):
+                piece = data[i:i + BUFFER_SIZE]
+                emit(b'L' + struct.pack('!I', len(piece)), piece)
+            advance(len(data))
+
+        try:
+            encode_delta(file_path, block_size, plan['weak'], strong_sums, on_copy, on_literal)
+        except ConnectionAbortedError:
+            return 0
+        emit(b'E')
+        flush()
+        counter.add(filesize - described)
+        return filesize
+
+    def _compress_pool(self):
+        with self.compress_pool_lock:
+            if self.compress_pool is None:
+                self.compress_pool = make_pool()
+            return self.compress_pool
+
+    def _wants_stripes(self, ip, file_path):
+        if self.stripe_streams <= 1 or not self.peer_supports(ip, "stripe"):
+            return False
+        try:
+            return os.path.getsize(file_path) >= STRIPE_MIN_SIZE
+        except OSError:
+            return False
+
+    def send_file_striped(self, ip, file_path, remote_filename=None, streams=None, group_id=None, group_size=None, progress=None):
+        """Send one large file as byte ranges over several parallel connections.
+
+        Stripes are not verified: there is no resume negotiation and no end-to-end checksum, even with checksums on.
+        """
+        if self.cancel_requested:
+             return False
+        progress = progress or self.on_transfer_progress
+        counter = None
+        metrics = self.telemetry.start("send", "striped", remote_filename or os.path.basename(file_path), ip, 0)
+        ok = False
+
+        try:
+            filesize = metrics.size = os.path.getsize(file_path)
+            filename = remote_filename if remote_filename else os.path.basename(file_path)
+            ranges = _split_ranges(filesize, streams or self.stripe_streams)
+            stripe_id = uuid.uuid4().hex
+
             header_dict = {
                 "filename": filename,
                 "size": filesize,
-                "type": "file"
+                "type": "stripe_open",
+                "stripe_id": stripe_id,
+                "streams": len(ranges)
             }
             if group_id:
                 header_dict["group_id"] = group_id
             if group_size:
                 header_dict["group_size"] = group_size
 
-            header = json.dumps(header_dict).encode('utf-8')
-            
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect((ip, TRANSFER_PORT))
-            
-            # Send Header
-            s.send(struct.pack('!I', len(header)))
-            s.send(header)
-            
-            # Receive Offset
-            offset_data = s.recv(8)
-            offset = struct.unpack('!Q', offset_data)[0]
-            
-            if offset > 0:
-                print(f"Resuming sending from {offset}")
-
-            # Zero-copy send
-            with open(file_path, 'rb') as f:
-                f.seek(offset)
-                sent = offset
-                start_time = time.time()
-                last_update_time = start_time
+            started = time.perf_counter()
+            control = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            control.connect((ip, TRANSFER_PORT))
+            control = self._secure_client(control, ip)
+            metrics.times['connect'] += time.perf_counter() - started
+            try:
+                started = time.perf_counter()
+                _send_header(control, header_dict)
+                _recv_exact(control, 8)  # Accepted and preallocated
+                metrics.times['confirm'] += time.perf_counter() - started
+
+                # Each range counts into its own part of the file's counter
+                counter = start_counter(progress, filename, filesize, "sending")
+                results = [False] * len(ranges)
                 self.transfer_running = True
-                
-                while sent < filesize:
-                    if self.cancel_requested or not self.transfer_running:
-                         break
+                lane = self._lane(ip, BULK)  # Shared by the streams: the limits apply to the file as a whole
+                threads = [
+                    threading.Thread(target=self._send_stripe, daemon=True,
+                                     args=(ip, file_path, stripe_id, i, start, end, counter.part(), lane, results,
+                                           metrics))
+                    for i, (start, end) in enumerate(ranges)
+                ]
+                with lane:
+                    for t in threads:
+                        t.start()
+                    for t in threads:
+                        t.join()
 
-                    # socket.sendfile is available in Python 3.5+
-                    count = s.sendfile(f, offset=sent, count=min(BUFFER_SIZE, filesize-sent))
-                    if count == 0: break
-                    sent += count
-                    
-                    current_time = time.time()
-                    if self.on_transfer_progress and (current_time - last_update_time > 0.1 or sent == filesize):
-                        elapsed = current_time - start_time
-                        if elapsed > 0:
-                            speed = ((sent - offset) / elapsed)
-                            eta = (filesize - sent) / speed if speed > 0 else 0
-                        else:
-                            speed = 0
-                            eta = 0
-                        self.on_transfer_progress(filename, sent, filesize, "sending", speed, eta)
-                        last_update_time = current_time
-                        
-            s.close()
-            return self.transfer_running and not self.cancel_requested
+                if not all(results) or self.cancel_requested:
+                    return False
+
+                control.sendall(struct.pack('!Q', filesize))
+                status = struct.unpack('!Q', _recv_exact(control, 8))[0]
+                ok = status == 1 and self.transfer_running and not self.cancel_requested
+                return ok
+            finally:
+                control.close()
+                if counter is not None:
+                    end_counter(counter, keep=all(results))
         except Exception as e:
-            print(f"Send error: {e}")
+            print(f"Striped send error: {e}")
             return False
+        finally:
+            self.telemetry.finish(metrics, ok)
+
+    def _send_stripe(self, ip, file_path, stripe_id, index, start, end, part, lane, results, metrics):
+        # Timed locally and merged once: the streams run concurrently
+        times = {'connect': 0.0, 'confirm': 0.0, 'send': 0.0, 'wait': 0.0}
+        sent = chunks = 0
+        clock = time.perf_counter
+        try:
+            started = clock()
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.connect((ip, TRANSFER_PORT))
+            s = self._secure_client(s, ip)
+            times['connect'] += clock() - started
+            try:
+                _send_header(s, {
+                    "filename": os.path.basename(file_path),
+                    "size": end - start,
+                    "type": "stripe",
+                    "stripe_id": stripe_id,
+                    "start": start,
+                    "end": end
+                })
+                started = clock()
+                pos = struct.unpack('!Q', _recv_exact(s, 8))[0]
+                times['confirm'] += clock() - started
+                part.add(pos - start)
+                with metrics.lock:
+                    metrics.resumed += pos - start
+
+                with open(file_path, 'rb') as f:
+                    while pos < end:
+                        if self.cancel_requested or not self.transfer_running:
+                            return
+                        count = lane.chunk(min(BUFFER_SIZE, end - pos))
+                        times['wait'] += lane.throttle(count)
+                        started = clock()
+                        count = s.sendfile(f, offset=pos, count=count)
+                        times['send'] += clock() - started
+                        if count == 0: return
+                        pos += count
+                        sent += count
+                        chunks += 1
+                        part.add(count)
+
+                _recv_exact(s, 8)  # Receiver wrote the whole range
+                results[index] = True
+            finally:
+                s.close()
+                part.close(keep=results[index])
+                metrics.merge(times, bytes=sent, chunks=chunks)
+        except Exception as e:
+            print(f"Stripe {index} error: {e}")
 
     def cancel_transfer(self):
+        """Stop everything: our own sends and every incoming transfer."""
+        self.cancel_sending()
+        self.inbound.cancel()
+
+    def cancel_sending(self):
+        """Stop our own sends; incoming transfers keep going."""
         self.transfer_running = False
         self.cancel_requested = True
         print("Cancellation requested.")
 
+    def cancel_incoming(self, sender_ip=None, group_id=None):
+        """Stop the incoming transfers of one sender (and/or one batch); the others keep going."""
+        count = self.inbound.cancel(sender_ip, group_id)
+        if count:
+            print(f"Cancelled {count} incoming transfer(s).")
+        return count
+
     def reset_cancel_flag(self):
         self.cancel_requested = False
 
     def stop(self):
         self.running = False
+        with self.text_channels_lock:
+            channels = list(self.text_channels.values())
+            self.text_channels.clear()
+            served = list(self.served_text_channels)
+        for channel in channels:
+            channel.close()
+        for conn in served:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)  # Wakes the thread serving it; senders reconnect elsewhere
+            except OSError:
+                pass
+        if self.async_engine is not None:
+            self.async_engine.stop()
+        if self.compress_pool is not None:
+            self.compress_pool.shutdown(wait=False)
+        if self.content_index is not None:
+            self.content_index.close()
         self.udp_sock.close()
-        self.tcp_sock.close()
+        if self.tcp_sock is not None:
+            self.tcp_sock.close()
 
@@ -0,0 +1,171 @@
+"""Progress accounting kept off the I/O loops.
+
+A transfer loop only bumps TransferStats.done. One sampler thread wakes
+every SAMPLE_INTERVAL, turns each tracked transfer's counter into an EWMA
+throughput and ETA, and calls its progress callback. Callbacks therefore
+run at a fixed rate on the sampler thread, and a slow UI can never stall a
+socket.
+"""
+import threading
+import time
+
+SAMPLE_INTERVAL = 0.1
+EWMA_ALPHA = 0.3  # Weight of the newest sample; ~1 s effective window at 10 Hz
+
+
+class _Part:
+    """Counter of one concurrent writer (a file of a batch, a stripe) feeding a TransferStats."""
+
+    __slots__ = ('parent', 'done')
+
+    def __init__(self, parent, done=0):
+        self.parent = parent
+        self.done = done
+
+    def add(self, count):
+        self.done += count
+
+    def part(self, done=0):
+        return self.parent.part(done)
+
+    def close(self, keep=True):
+        """Detach; with keep the bytes stay counted in the parent (e.g. the file arrived)."""
+        with self.parent.lock:
+            self.parent.parts.discard(self)
+            if keep:
+                self.parent.done += self.done
+
+
+class TransferStats:
+    """Counters for one transfer (or one batch). Only `done` changes on the hot path.
+
+    add() may be called from any thread; writers on a hot path each take a
+    part(), which counts without locking.
+    """
+
+    __slots__ = ('name', 'total', 'mode', 'callback', 'done', 'rate', 'parts', 'lock',
+                 '_last_done', '_last_time', '_seeded', '_reported')
+
+    def __init__(self, name, total, mode, callback, done=0):
+        self.name = name
+        self.total = total
+        self.mode = mode
+        self.callback = callback
+        self.done = done
+        self.rate = 0.0
+        self.parts = set()
+        self.lock = threading.Lock()
+        self._last_done = done
+        self._last_time = time.time()
+        self._seeded = False
+        self._reported = None
+
+    def add(self, count):
+        # Parts fold into done under the lock when they close (see _Part.close)
+        with self.lock:
+            self.done += count
+
+    def part(self, done=0):
+        part = _Part(self, done)
+        with self.lock:
+            self.parts.add(part)
+        return part
+
+    def current(self):
+        with self.lock:
+            return self.done + sum(part.done for part in self.parts)
+
+    def eta(self):
+        return (self.total - self._last_done) / self.rate if self.rate > 0 else 0
+
+    def _sample(self, now):
+        elapsed = now - self._last_time
+        if elapsed <= 0:
+            return
+        current = self.current()
+        instant = (current - self._last_done) / elapsed
+        self.rate = EWMA_ALPHA * instant + (1 - EWMA_ALPHA) * self.rate if self._seeded else instant
+        self._seeded = True
+        self._last_done = current
+        self._last_time = now
+
+    def _report(self, force=False):
+        done = min(self._last_done, self.total)
+        if self.callback and (force or done != self._reported):
+            self._reported = done
+            self.callback(self.name, done, self.total, self.mode, self.rate, self.eta())
+
+
+class _Sampler:
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.report_lock = threading.Lock()  # Keeps a late periodic report from following the final one
+        self.tracked = set()
+        self.thread = None
+
+    def track(self, stats):
+        with self.lock:
+            self.tracked.add(stats)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="progress", daemon=True)
+                self.thread.start()
+
+    def close(self, stats):
+        """Stop sampling and deliver the final numbers (so 100% is always reported)."""
+        with self.lock:
+            if stats not in self.tracked:
+                return
+            self.tracked.discard(stats)
+        with self.report_lock:
+            stats._sample(time.time())
+            try:
+                stats._report(force=stats._last_done >= stats.total)
+            except Exception as e:
+                print(f"Progress callback error: {e}")
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            now = time.time()
+            with self.lock:
+                items = list(self.tracked)
+            with self.report_lock:
+                for stats in items:
+                    if stats not in self.tracked:
+                        continue  # Finished meanwhile
+                    stats._sample(now)
+                    try:
+                        stats._report()  # Only when the counter moved
+                    except Exception as e:
+                        print(f"Progress callback error: {e}")
+
+
+SAMPLER = _Sampler()
+
+
+def track(name, total, mode, callback, done=0):
+    """Start a sampled TransferStats. Pass it to finish() when the transfer ends."""
+    stats = TransferStats(name, total, mode, callback, done)
+    if callback:
+        SAMPLER.track(stats)
+    return stats
+
+
+def finish(stats):
+    SAMPLER.close(stats)
+
+
+def start_counter(progress, name, total, mode, done=0):
+    """Counter for one transfer: a part of `progress` when that is a batch's stats, else its own tracked stats."""
+    if hasattr(progress, 'part'):
+        return progress.part(done)
+    return track(name, total, mode, progress, done)
+
+
+def end_counter(counter, keep=True):
+    """Counterpart of start_counter()."""
+    if isinstance(counter, _Part):
+        counter.close(keep)
+    else:
+        finish(counter)
@@ -0,0 +1,121 @@
+"""Thread-safe registry of discovered devices.
+
+Devices expire through a min-heap of deadlines instead of a full scan. A
+beacon only moves a device's deadline. Its heap entry is refreshed lazily,
+when the stale entry reaches the top. Each expiry pass therefore costs
+O(expired log n) however many peers are on the LAN.
+
+Subscribers get ("added" | "updated" | "removed", device) events, called
+outside the lock on the thread that caused the change.
+"""
+import heapq
+import threading
+import time
+
+ADDED = "added"
+UPDATED = "updated"
+REMOVED = "removed"
+
+
+class DeviceRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.devices = {}
+        self.deadlines = {}  # ip -> current expiry time
+        self.timeouts = {}  # ip -> seconds of silence allowed
+        self.heap = []  # (deadline, ip), possibly older than self.deadlines
+        self.listeners = []
+
+    def subscribe(self, listener):
+        """listener(event, device) for every added/updated/removed device."""
+        self.listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        self.listeners.remove(listener)
+
+    def _emit(self, event, device):
+        for listener in list(self.listeners):
+            try:
+                listener(event, device)
+            except Exception as e:
+                print(f"Device listener error: {e}")
+
+    def add(self, device, timeout):
+        """Insert or replace a device; it expires `timeout` seconds after device.last_seen."""
+        deadline = device.last_seen + timeout
+        with self.lock:
+            existed = device.ip in self.devices
+            self.devices[device.ip] = device
+            self.deadlines[device.ip] = deadline
+            self.timeouts[device.ip] = timeout
+            heapq.heappush(self.heap, (deadline, device.ip))
+        self._emit(UPDATED if existed else ADDED, device)
+
+    def touch(self, ip, timeout=None, **changes):
+        """Mark a known device as alive (and apply attribute changes). Returns the device or None.
+
+        timeout replaces the device's allowed silence; by default the last one is kept.
+        """
+        now = time.time()
+        with self.lock:
+            device = self.devices.get(ip)
+            if device is None:
+                return None
+            if timeout is not None:
+                self.timeouts[ip] = timeout
+            device.last_seen = now
+            self.deadlines[ip] = now + self.timeouts[ip]
+            changed = {k: v for k, v in changes.items() if getattr(device, k) != v}
+            for k, v in changed.items():
+                setattr(device, k, v)
+        if changed:
+            self._emit(UPDATED, device)
+        return device
+
+    def expire(self, now=None):
+        """Remove devices whose deadline passed. Returns the removed devices."""
+        now = time.time() if now is None else now
+        removed = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                _, ip = heapq.heappop(self.heap)
+                deadline = self.deadlines.get(ip)
+                if deadline is None:
+                    continue  # Already removed
+                if deadline > now:
+                    heapq.heappush(self.heap, (deadline, ip))  # Refreshed since this entry was pushed
+                    continue
+                del self.deadlines[ip]
+                del self.timeouts[ip]
+                removed.append(self.devices.pop(ip))
+        for device in removed:
+            self._emit(REMOVED, device)
+        return removed
+
+    def next_deadline(self):
+        with self.lock:
+            return self.heap[0][0] if self.heap else None
+
+    def get(self, ip, default=None):
+        with self.lock:
+            return self.devices.get(ip, default)
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.devices.values())
+
+    def __contains__(self, ip):
+        with self.lock:
+            return ip in self.devices
+
+    def __getitem__(self, ip):
+        with self.lock:
+            return self.devices[ip]
+
+    def __len__(self):
+        with self.lock:
+            return len(self.devices)
+
+    def keys(self):
+        with self.lock:
+            return list(self.devices)
@@ -0,0 +1,207 @@
+"""Streaming folder scans that feed a batch while it is still being scanned.
+
+FolderScan walks a tree with os.scandir on background threads. Top-level
+subtrees are spread over `workers` threads, which helps on SSDs and
+network shares and costs nothing on a single spinning disk with workers=1.
+Found files go into a bounded queue as (abs_path, remote_filename, size)
+tuples. BatchSender takes them in waves and starts sending the first files
+within a fraction of a second. The queue bound keeps memory flat whatever
+the size of the tree.
+
+ScanCache remembers each directory's listing, keyed by the directory's
+mtime. Adding, removing or renaming an entry changes it. A repeat scan
+of an unchanged folder then costs one stat per directory instead of one per
+file. A file edited in place keeps its directory's mtime, so cached sizes
+are only a snapshot. The sender stats every file again when it sends it,
+and the manifest compares fresh mtimes.
+"""
+import json
+import os
+import queue
+import threading
+import time
+
+SCAN_QUEUE_DEPTH = 10000  # Entries found but not yet taken by the sender
+SCAN_CACHE_VERSION = 1
+
+
+class ScanCache:
+    def __init__(self, path=None):
+        self.path = path
+        self.dirs = {}  # Directory path -> (mtime_ns, [(name, size), ...], [subdir name, ...])
+        self.lock = threading.Lock()
+        if path:
+            self.load()
+
+    def get(self, directory, mtime_ns):
+        with self.lock:
+            cached = self.dirs.get(directory)
+        if cached is not None and cached[0] == mtime_ns:
+            return cached[1], cached[2]
+        return None
+
+    def put(self, directory, mtime_ns, files, subdirs):
+        with self.lock:
+            self.dirs[directory] = (mtime_ns, files, subdirs)
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+            if saved.get('version') == SCAN_CACHE_VERSION:
+                self.dirs = {d: (m, [tuple(x) for x in files], subdirs) for d, (m, files, subdirs) in saved['dirs'].items()}
+        except (OSError, ValueError, KeyError, TypeError):
+            self.dirs = {}
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            data = {'version': SCAN_CACHE_VERSION, 'dirs': self.dirs}
+            tmp = self.path + ".tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(data, f, separators=(',', ':'))
+        os.replace(tmp, self.path)
+
+
+class FolderScan:
+    """Iterable of a folder's files as (abs_path, remote_filename, size), produced while scanning.
+
+    remote_filename is "<folder name>/<relative path>" with forward slashes,
+    as the GUI always sent it. Unreadable directories and files that vanish
+    mid-scan are skipped, as os.walk did. count and total_size grow as the
+    scan runs; done is set when it has finished.
+    """
+
+    def __init__(self, root, cache=None, workers=1, depth=SCAN_QUEUE_DEPTH):
+        self.root = os.path.abspath(root)
+        self.label = os.path.basename(self.root.rstrip("\\/"))
+        self.cache = cache
+        self.workers = max(1, workers)
+        self.queue = queue.Queue(maxsize=depth)
+        self.count = 0
+        self.total_size = 0
+        self.cached_dirs = 0  # Listings taken from the cache
+        self.done = threading.Event()
+        self.stopped = False
+        self.lock = threading.Lock()
+        self.pending = queue.Queue()  # Directories waiting for a worker
+        self.outstanding = 0  # Directories queued or being listed
+        self.started = False
+
+    def start(self):
+        if not self.started:
+            self.started = True
+            self._add_dir(self.root, self.label)
+            for i in range(self.workers):
+                threading.Thread(target=self._work, name=f"scan-{i}", daemon=True).start()
+        return self
+
+    def stop(self):
+        """Abandon the scan (e.g. the batch was cancelled)."""
+        self.stopped = True
+        try:
+            while True:
+                self.queue.get_nowait()
+        except queue.Empty:
+            pass
+
+    def __iter__(self):
+        self.start()
+        while True:
+            entry = self.queue.get()
+            if entry is None:
+                return
+            yield entry
+
+    def waves(self, max_count, max_wait):
+        """Lists of up to max_count entries; a wave goes out early once max_wait seconds passed with some entries."""
+        self.start()
+        wave = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                entry = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                entry = False
+            if entry is None:
+                if wave:
+                    yield wave
+                return
+            if entry:
+                wave.append(entry)
+                if deadline is None:
+                    deadline = time.monotonic() + max_wait
+            if len(wave) >= max_count or (wave and entry is False):
+                yield wave
+                wave = []
+                deadline = None
+
+    def _add_dir(self, path, remote):
+        with self.lock:
+            self.outstanding += 1
+        self.pending.put((path, remote))
+
+    def _work(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                self.pending.put(None)  # Wake the next worker too
+                return
+            path, remote = item
+            try:
+                if not self.stopped:
+                    self._list(path, remote)
+            except Exception as e:
+                print(f"Scan error in {path}: {e}")
+            with self.lock:
+                self.outstanding -= 1
+                finished = self.outstanding == 0
+            if finished:
+                self.pending.put(None)
+                self.done.set()
+                if self.stopped:
+                    return  # Nobody reads the queue any more
+                self.queue.put(None)
+                return
+
+    def _list(self, path, remote):
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError:
+            return
+        cached = self.cache.get(path, mtime_ns) if self.cache is not None else None
+        if cached is not None:
+            files, subdirs = cached
+            with self.lock:
+                self.cached_dirs += 1
+        else:
+            files = []
+            subdirs = []
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        try:
+                            if entry.is_dir():
+                                # Like os.walk, symlinked directories are listed but not followed
+                                if not entry.is_symlink():
+                                    subdirs.append(entry.name)
+                            else:
+                                files.append((entry.name, entry.stat().st_size))
+                        except OSError:
+                            continue  # Vanished or a dangling link
+            except OSError:
+                return
+            if self.cache is not None:
+                self.cache.put(path, mtime_ns, files, subdirs)
+
+        for name in subdirs:
+            self._add_dir(os.path.join(path, name), f"{remote}/{name}")
+        for name, size in files:
+            if self.stopped:
+                return
+            with self.lock:
+                self.count += 1
+                self.total_size += size
+            self.queue.put((os.path.join(path, name), f"{remote}/{name}", size))
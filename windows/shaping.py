@@ -0,0 +1,139 @@
+"""Bandwidth shaping and priority between concurrent outgoing transfers.
+
+Every outgoing transfer runs in a Lane of one of three priority classes:
+TEXT (clipboard messages), SMALL (a single file under SMALL_PRIORITY_SIZE)
+and BULK (batches, folders, large and striped files). Before each chunk, a
+bulk lane yields while a more urgent lane is active, for at most
+PREEMPT_MAX per chunk so it can never starve. Bulk sends therefore pause
+between chunks and a paste or a screenshot goes out on an idle link.
+
+Rate limits are token buckets, one global and one per peer. Bulk lanes wait
+for their tokens. Urgent lanes take tokens without waiting (the bucket goes
+into debt) and bulk traffic pays the debt back, so the configured average
+rate holds while interactive latency stays low. With no limits set and
+nothing urgent running, a chunk costs one list lookup.
+"""
+import threading
+import time
+
+TEXT, SMALL, BULK = 0, 1, 2
+SMALL_PRIORITY_SIZE = 8 * 1024 * 1024
+PREEMPT_MAX = 2.0  # Longest a bulk chunk waits for urgent transfers
+BURST_SECONDS = 0.25  # Bucket depth, in seconds of the configured rate
+MIN_CHUNK = 64 * 1024
+SLEEP_SLICE = 0.1  # Long waits are sliced so cancellation stays responsive
+
+
+class TokenBucket:
+    def __init__(self, rate):
+        self.rate = rate
+        self.burst = max(rate * BURST_SECONDS, MIN_CHUNK)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, count, wait=True):
+        """Take count tokens. Returns the seconds to wait before sending (0 when not waiting)."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= count
+            deficit = -self.tokens
+        return deficit / self.rate if wait and deficit > 0 else 0
+
+
+class Lane:
+    """One transfer's view of the scheduler; use as a context manager around the transfer."""
+
+    def __init__(self, scheduler, buckets, priority, cancelled=None):
+        self.scheduler = scheduler
+        self.buckets = buckets
+        self.priority = priority
+        self.cancelled = cancelled or (lambda: False)
+        self.chunk_size = None
+        rates = [bucket.rate for bucket in buckets]
+        if rates:
+            # About ten chunks a second, so a low limit is not sent as one big burst
+            self.chunk_size = max(MIN_CHUNK, int(min(rates) / 10))
+
+    def __enter__(self):
+        self.scheduler._enter(self.priority)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.scheduler._leave(self.priority)
+
+    def chunk(self, limit):
+        """Largest piece to send in one go."""
+        return limit if self.chunk_size is None else min(limit, self.chunk_size)
+
+    def throttle(self, count):
+        """Call before sending count bytes. Returns the seconds spent waiting."""
+        waited = 0.0
+        if self.priority == BULK and self.scheduler.urgent:
+            waited = self.scheduler._yield(self.priority)
+        if self.buckets:
+            delay = max(bucket.consume(count, wait=self.priority == BULK) for bucket in self.buckets)
+            if delay > 0:
+                started = time.monotonic()
+                deadline = started + delay
+                while delay > 0 and not self.cancelled():
+                    time.sleep(min(delay, SLEEP_SLICE))
+                    delay = deadline - time.monotonic()
+                waited += time.monotonic() - started
+        return waited
+
+
+class Scheduler:
+    def __init__(self, rate=None, peer_rate=None):
+        self.cond = threading.Condition()
+        self.active = [0, 0, 0]  # Lanes per priority class
+        self.urgent = 0  # Active TEXT + SMALL lanes
+        self.peer_buckets = {}
+        self.set_limits(rate, peer_rate)
+
+    def set_limits(self, rate=None, peer_rate=None):
+        """Bytes per second overall and per peer (None: unlimited). Applies to lanes opened afterwards."""
+        with self.cond:
+            self.rate = rate
+            self.peer_rate = peer_rate
+            self.bucket = TokenBucket(rate) if rate else None
+            self.peer_buckets = {}
+
+    def lane(self, peer, priority, cancelled=None):
+        buckets = []
+        with self.cond:
+            if self.bucket is not None:
+                buckets.append(self.bucket)
+            if self.peer_rate:
+                bucket = self.peer_buckets.get(peer)
+                if bucket is None:
+                    bucket = self.peer_buckets[peer] = TokenBucket(self.peer_rate)
+                buckets.append(bucket)
+        return Lane(self, buckets, priority, cancelled)
+
+    def _enter(self, priority):
+        with self.cond:
+            self.active[priority] += 1
+            if priority != BULK:
+                self.urgent += 1
+
+    def _leave(self, priority):
+        with self.cond:
+            self.active[priority] -= 1
+            if priority != BULK:
+                self.urgent -= 1
+            self.cond.notify_all()
+
+    def _yield(self, priority):
+        """Wait while a more urgent lane is active (at most PREEMPT_MAX). Returns the seconds waited."""
+        started = time.monotonic()
+        deadline = started + PREEMPT_MAX
+        with self.cond:
+            while any(self.active[:priority]):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+        return time.monotonic() - started
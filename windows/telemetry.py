@@ -0,0 +1,255 @@
+"""Per-transfer metrics, where they go, and an opt-in sampling profiler.
+
+Every file, archive or striped transfer fills one TransferMetrics: bytes,
+chunks, resumed bytes, retries (chunks re-sent after a failed check, stripe
+ranges retried) and time per phase. The phases are:
+  connect  TCP connect plus session/stripe setup (sender)
+  confirm  waiting for the other side's answer to a header (dialog included)
+  hash     hashing the local copy to plan a verified resume (sender)
+  wait     paused by the scheduler: rate limit, or yielding to text and
+           small files (sender; see shaping.py)
+  send     sendfile/sendall
+  compress compressing records (sender, compressed frames)
+  recv     reading the socket
+  write    writing the file (on the write-behind thread, overlapping recv;
+           see zerocopy.py)
+  splice   kernel socket-to-file copy (recv and write in one)
+Striped transfers add up the time of each stream, so their phases can
+exceed the wall time.
+
+Telemetry passes each finished transfer as a dict to its listeners (the
+NetworkManager hook, JsonLinesLog) and keeps running totals for
+MetricsServer's Prometheus text endpoint. Timing costs two perf_counter()
+calls per 1 MB chunk.
+"""
+import collections
+import json
+import logging
+import logging.handlers
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PHASES = ("connect", "confirm", "hash", "wait", "send", "compress", "recv", "write", "splice")
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUPS = 3
+PROFILE_INTERVAL = 0.005
+
+
+class TransferMetrics:
+    """Counters and phase timings of one transfer."""
+
+    __slots__ = ('direction', 'kind', 'name', 'peer', 'size', 'started', 'seconds', 'bytes', 'chunks',
+                 'resumed', 'retries', 'times', 'ok', 'lock')
+
+    def __init__(self, direction, kind, name, peer, size):
+        self.direction = direction
+        self.kind = kind
+        self.name = name
+        self.peer = peer
+        self.size = size
+        self.started = time.time()
+        self.seconds = 0.0
+        self.bytes = 0
+        self.chunks = 0
+        self.resumed = 0
+        self.retries = 0
+        self.times = dict.fromkeys(PHASES, 0.0)
+        self.ok = False
+        self.lock = threading.Lock()
+
+    def merge(self, times=None, bytes=0, chunks=0, retries=0):
+        """Fold in the totals of one concurrent stream."""
+        with self.lock:
+            for phase, seconds in (times or {}).items():
+                self.times[phase] += seconds
+            self.bytes += bytes
+            self.chunks += chunks
+            self.retries += retries
+
+    def as_dict(self):
+        return {
+            "direction": self.direction,
+            "kind": self.kind,
+            "name": self.name,
+            "peer": self.peer,
+            "size": self.size,
+            "ok": self.ok,
+            "started": round(self.started, 3),
+            "seconds": round(self.seconds, 4),
+            "bytes": self.bytes,
+            "chunks": self.chunks,
+            "resumed": self.resumed,
+            "retries": self.retries,
+            "times": {phase: round(seconds, 4) for phase, seconds in self.times.items() if seconds},
+        }
+
+
+class Telemetry:
+    def __init__(self):
+        self.listeners = []
+        self.lock = threading.Lock()
+        self.totals = collections.Counter()  # (metric, labels) -> value, for MetricsServer
+        self.profiler = None
+
+    def subscribe(self, listener):
+        """listener(event_dict) for every finished transfer."""
+        self.listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        self.listeners.remove(listener)
+
+    def start(self, direction, kind, name, peer, size):
+        return TransferMetrics(direction, kind, name, peer, size)
+
+    def finish(self, metrics, ok):
+        metrics.ok = bool(ok)
+        metrics.seconds = time.time() - metrics.started
+        event = metrics.as_dict()
+        result = "ok" if metrics.ok else "failed"
+        with self.lock:
+            totals = self.totals
+            totals[("transfers_total", (("direction", metrics.direction), ("result", result)))] += 1
+            totals[("bytes_total", (("direction", metrics.direction),))] += metrics.bytes
+            totals[("resumed_bytes_total", (("direction", metrics.direction),))] += metrics.resumed
+            totals[("retries_total", (("direction", metrics.direction),))] += metrics.retries
+            for phase, seconds in metrics.times.items():
+                if seconds:
+                    totals[("phase_seconds_total", (("direction", metrics.direction), ("phase", phase)))] += seconds
+        for listener in list(self.listeners):
+            try:
+                listener(event)
+            except Exception as e:
+                print(f"Metrics listener error: {e}")
+
+    def render_prometheus(self):
+        with self.lock:
+            items = sorted(self.totals.items())
+        lines = []
+        seen = set()
+        for (metric, labels), value in items:
+            name = f"localdrop_{metric}"
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# TYPE {name} counter")
+            label_text = ",".join(f'{key}="{val}"' for key, val in labels)
+            lines.append(f"{name}{{{label_text}}} {round(value, 6)}")
+        return "\n".join(lines) + "\n"
+
+    # Profiling
+
+    def start_profiler(self, interval=PROFILE_INTERVAL):
+        if self.profiler is None:
+            self.profiler = SamplingProfiler(interval)
+            self.profiler.start()
+        return self.profiler
+
+    def stop_profiler(self, path=None):
+        """Stop sampling; with path, write the collapsed stacks there. Returns the profiler."""
+        profiler, self.profiler = self.profiler, None
+        if profiler is not None:
+            profiler.stop()
+            if path:
+                profiler.write(path)
+        return profiler
+
+
+class JsonLinesLog:
+    """Telemetry listener appending one JSON object per transfer to a size-rotated file."""
+
+    def __init__(self, path, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS):
+        self.handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups,
+                                                            encoding='utf-8')
+        self.handler.setFormatter(logging.Formatter("%(message)s"))
+
+    def __call__(self, event):
+        record = logging.LogRecord("localdrop.metrics", logging.INFO, "", 0, json.dumps(event), None, None)
+        self.handler.handle(record)
+
+    def close(self):
+        self.handler.close()
+
+
+class MetricsServer:
+    """Prometheus text exposition of Telemetry totals on http://host:port/metrics (localhost by default)."""
+
+    def __init__(self, telemetry, port, host="127.0.0.1"):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = telemetry.render_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True)
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class SamplingProfiler:
+    """Samples every other thread's stack at a fixed interval.
+
+    The result is in collapsed-stack format ("thread;outer;...;inner count"
+    per line), which flamegraph.pl and speedscope read directly. Sampling
+    never touches the profiled threads, so it is safe to leave on for a
+    whole transfer.
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.running = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def start(self):
+        self.running.set()
+        self.thread.start()
+
+    def stop(self):
+        self.running.clear()
+        self.thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while self.running.is_set():
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def write(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
@@ -0,0 +1,372 @@
+"""Loopback tests of the transfer protocol: real sockets, real files, no mocks.
+
+    python -m unittest discover -s tests   (from the windows directory)
+
+Like benchmark.py, a NetworkManager sends to itself over 127.0.0.1 and is
+registered as its own peer with the features under test, so the sending side
+takes the same code paths as against a remote device. Every manager gets
+fresh ports and its own download directory.
+"""
+import contextlib
+import io
+import json
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import localdrop
+import network
+from network import FEATURES, PART_SUFFIX, BatchSender, Device, NetworkManager
+from scanner import FolderScan
+import secure
+from secure import SECURE_AVAILABLE
+
+if SECURE_AVAILABLE:
+    from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+    from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+
+MB = 1024 * 1024
+ANDROID_FEATURES = ()  # The Android app advertises nothing: one connection and one prompt per file
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_for(path, timeout=5.0):
+    """A sender may return before the receiver renamed the file into place."""
+    deadline = time.time() + timeout
+    while not os.path.exists(path) and time.time() < deadline:
+        time.sleep(0.01)
+    return os.path.exists(path)
+
+
+class LoopbackTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="localdrop-test-")
+        self.rnd = random.Random(self.id())
+        self.managers = []
+
+    def tearDown(self):
+        for manager in self.managers:
+            manager.stop()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def manager(self, features=FEATURES, name="receiver", port=None, **kwargs):
+        """A started manager listening on fresh ports (or transfer port `port`), with itself as a peer advertising `features`."""
+        network.TRANSFER_PORT = port or _free_port()
+        network.BROADCAST_PORT = _free_port()
+        download_dir = os.path.join(self.workdir, name)
+        os.makedirs(download_dir, exist_ok=True)
+        manager = NetworkManager(name, download_dir=download_dir, **kwargs)
+        manager.port = network.TRANSFER_PORT
+        manager.prompts = []
+        manager.events = []
+        manager.telemetry.subscribe(manager.events.append)
+        if manager.accept_policy is None:
+            manager.accept_policy = lambda sender_ip, filename, size: manager.prompts.append(filename) or True
+        manager.start()
+        self.managers.append(manager)
+        manager.found_devices.add(Device("127.0.0.1", name, "windows", time.time(), tuple(features)), 1e9)
+        return manager
+
+    def write(self, relative, data):
+        path = os.path.join(self.workdir, "src", relative)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def received(self, manager, relative):
+        path = os.path.join(manager.download_dir, relative)
+        self.assertTrue(_wait_for(path), f"{relative} did not arrive")
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def sends(self, manager):
+        return [event for event in manager.events if event['direction'] == "send"]
+
+
+class ResumeTest(LoopbackTest):
+    def test_resumes_partial_and_resends_damaged_chunk(self):
+        manager = self.manager()
+        data = self.rnd.randbytes(6 * MB)
+        path = self.write("resume.bin", data)
+        # An interrupted earlier attempt: the first 4 MB arrived, one chunk of them got damaged since
+        partial = bytearray(data[:4 * MB])
+        partial[MB + 10:MB + 20] = b"x" * 10
+        with open(os.path.join(manager.download_dir, "resume.bin" + PART_SUFFIX), 'wb') as f:
+            f.write(partial)
+
+        self.assertTrue(manager.send_file("127.0.0.1", path))
+        self.assertEqual(self.received(manager, "resume.bin"), data)
+        self.assertFalse(os.path.exists(os.path.join(manager.download_dir, "resume.bin" + PART_SUFFIX)))
+        [send] = self.sends(manager)
+        self.assertEqual(send['resumed'], 4 * MB)
+        self.assertEqual(send['retries'], 1)
+        self.assertEqual(send['bytes'], 3 * MB)  # The damaged chunk plus the missing 2 MB
+
+    def test_partial_with_other_content_starts_over(self):
+        manager = self.manager()
+        data = self.rnd.randbytes(3 * MB)
+        path = self.write("other.bin", data)
+        with open(os.path.join(manager.download_dir, "other.bin" + PART_SUFFIX), 'wb') as f:
+            f.write(self.rnd.randbytes(3 * MB))
+
+        self.assertTrue(manager.send_file("127.0.0.1", path))
+        self.assertEqual(self.received(manager, "other.bin"), data)
+
+
+class DeltaTest(LoopbackTest):
+    def test_grown_file_sends_only_the_insertion(self):
+        manager = self.manager(delta_sync=True)
+        data = self.rnd.randbytes(8 * MB)
+        path = self.write("grown.bin", data)
+        self.assertTrue(manager.send_file("127.0.0.1", path))
+        self.assertEqual(self.received(manager, "grown.bin"), data)
+
+        inserted = self.rnd.randbytes(100 * 1024)
+        grown = data[:4 * MB] + inserted + data[4 * MB:]
+        self.write("grown.bin", grown)
+        manager.events.clear()
+        self.assertTrue(manager.send_file("127.0.0.1", path))
+        self.assertEqual(self.received(manager, "grown.bin"), grown)
+        # Updated in place: no renamed duplicate, and little more than the insertion crossed the wire
+        self.assertEqual(sorted(os.listdir(manager.download_dir)), ["grown.bin"])
+        [send] = self.sends(manager)
+        self.assertLess(send['bytes'], 2 * len(inserted))
+
+
+class ManifestTest(LoopbackTest):
+    def send_folder(self, manager, entries):
+        sender = BatchSender(manager, "127.0.0.1", group_id=str(uuid.uuid4()),
+                             group_size=sum(size for _, _, size in entries))
+        return sender.send(entries)
+
+    def test_second_send_skips_identical_files(self):
+        manager = self.manager()
+        entries = []
+        for i in range(5):
+            name = f"folder/f{i}.bin"
+            data = self.rnd.randbytes(self.rnd.choice([300, 70 * 1024, 2 * MB]))
+            entries.append((self.write(name, data), name, len(data)))
+        self.assertTrue(self.send_folder(manager, entries))
+        for abs_path, name, _ in entries:
+            with open(abs_path, 'rb') as f:
+                self.assertEqual(self.received(manager, name), f.read())
+
+        # Again, with one file changed: only that one is sent
+        changed = self.rnd.randbytes(2 * MB)
+        entries[0] = (self.write(entries[0][1], changed), entries[0][1], len(changed))
+        manager.events.clear()
+        self.assertTrue(self.send_folder(manager, entries))
+        self.assertEqual(self.received(manager, entries[0][1]), changed)
+        self.assertEqual([event['name'] for event in self.sends(manager)], [entries[0][1]])
+
+    def test_empty_folder_does_not_prompt(self):
+        manager = self.manager()
+        folder = os.path.join(self.workdir, "src", "empty")
+        os.makedirs(os.path.join(folder, "sub"))
+        sender = BatchSender(manager, "127.0.0.1", group_id=str(uuid.uuid4()))
+        self.assertTrue(sender.send(FolderScan(folder)))
+        self.assertEqual(manager.prompts, [])
+
+    def test_cancelled_stream_stops_its_scan(self):
+        manager = self.manager()
+        for i in range(100):
+            self.write(f"many/f{i:03}.txt", b"x")
+        saved = network.MANIFEST_WAVE
+        network.MANIFEST_WAVE = 10
+        self.addCleanup(setattr, network, "MANIFEST_WAVE", saved)
+        # Cancel as soon as the first wave is offered: the scan is still blocked on its small queue then
+        manager.accept_policy = lambda sender_ip, filename, size: manager.cancel_sending() or True
+        scan = FolderScan(os.path.join(self.workdir, "src", "many"), workers=2, depth=4)
+        # One worker, so nothing asks the plan for its next wave after the cancel
+        sender = BatchSender(manager, "127.0.0.1", group_id=str(uuid.uuid4()), width=1)
+        self.assertFalse(sender.send(scan))
+        deadline = time.time() + 5
+        while any(t.name.startswith("scan-") for t in threading.enumerate()) and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual([t.name for t in threading.enumerate() if t.name.startswith("scan-")], [])
+
+
+class LegacyPeerTest(LoopbackTest):
+    def test_batch_goes_one_file_at_a_time(self):
+        manager = self.manager(features=ANDROID_FEATURES)
+        entries = []
+        for i in range(6):
+            name = f"legacy/f{i}.bin"
+            data = self.rnd.randbytes(256 * 1024)
+            entries.append((self.write(name, data), name, len(data)))
+        sender = BatchSender(manager, "127.0.0.1", group_id=str(uuid.uuid4()),
+                             group_size=sum(size for _, _, size in entries))
+        self.assertEqual(sender.width, 1)
+        self.assertTrue(sender.send(entries))
+        for abs_path, name, _ in entries:
+            with open(abs_path, 'rb') as f:
+                self.assertEqual(self.received(manager, name), f.read())
+        # One classic connection per file, no manifest or archive frames, and the batch was asked about once
+        self.assertEqual(sorted(event['name'] for event in self.sends(manager)), sorted(name for _, name, _ in entries))
+        self.assertEqual(len(manager.prompts), 1)
+
+
+class TimeoutTest(LoopbackTest):
+    """One session slot, and timeouts short enough to wait out."""
+
+    def setUp(self):
+        super().setUp()
+        saved = network.HEADER_TIMEOUT, network.RECEIVE_TIMEOUT, network.STRIPE_MIN_SIZE
+        network.HEADER_TIMEOUT = network.RECEIVE_TIMEOUT = 0.5
+        self.addCleanup(self.restore, saved)
+
+    @staticmethod
+    def restore(saved):
+        network.HEADER_TIMEOUT, network.RECEIVE_TIMEOUT, network.STRIPE_MIN_SIZE = saved
+
+    def connect(self, manager):
+        s = socket.create_connection(("127.0.0.1", manager.port))
+        self.addCleanup(s.close)
+        return s
+
+    def test_silent_connection_gives_up_its_slot(self):
+        manager = self.manager(max_sessions=1)
+        self.connect(manager)  # Connects and never says a word, like a port scanner
+        data = self.rnd.randbytes(MB)
+        self.assertTrue(manager.send_file("127.0.0.1", self.write("after.bin", data)))
+        self.assertEqual(self.received(manager, "after.bin"), data)
+
+    def test_stalled_sender_leaves_its_partial(self):
+        manager = self.manager(max_sessions=1)
+        s = self.connect(manager)
+        network._send_header(s, {"filename": "stalled.bin", "size": 4 * MB})
+        self.assertEqual(network._recv_exact(s, 8), bytes(8))  # Accepted, from the start
+        s.sendall(b"x" * MB)  # And then nothing
+        part = os.path.join(manager.download_dir, "stalled.bin" + PART_SUFFIX)
+        deadline = time.time() + 5
+        while (not os.path.exists(part) or os.path.getsize(part) != MB) and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(os.path.getsize(part), MB)  # Truncated to what arrived, ready to resume
+        self.assertEqual(os.listdir(manager.download_dir), ["stalled.bin" + PART_SUFFIX])
+        # And the slot is free again
+        data = self.rnd.randbytes(MB)
+        self.assertTrue(manager.send_file("127.0.0.1", self.write("after.bin", data)))
+        self.assertEqual(self.received(manager, "after.bin"), data)
+
+    def test_striped_transfer_needs_no_free_slots(self):
+        network.STRIPE_MIN_SIZE = MB
+        manager = self.manager(max_sessions=1, stripe_streams=3)
+        data = self.rnd.randbytes(4 * MB)
+        self.assertTrue(manager.send_file_striped("127.0.0.1", self.write("striped.bin", data)))
+        self.assertEqual(self.received(manager, "striped.bin"), data)
+
+
+
+class TextChannelTest(LoopbackTest):
+    def receiver(self, port=None):
+        manager = self.manager(port=port)
+        manager.texts = []
+        manager.on_text_received = manager.texts.append
+        return manager
+
+    def test_receiver_restart_loses_nothing(self):
+        first = self.receiver()
+        sender = self.manager(name="sender")
+        network.TRANSFER_PORT = first.port
+        self.assertTrue(sender.send_text("127.0.0.1", "before"))
+        self.assertEqual(first.texts, ["before"])  # Delivered by the time the ack arrived
+
+        # Restarted well within TEXT_CHANNEL_IDLE: the sender's channel is still the old connection
+        first.stop()
+        second = self.receiver(port=first.port)
+        self.assertTrue(sender.send_text("127.0.0.1", "after"))
+        self.assertEqual(second.texts, ["after"])
+
+    def test_only_clipboard_echoes_are_deduplicated(self):
+        receiver = self.receiver()
+        sender = self.manager(name="sender")
+        network.TRANSFER_PORT = receiver.port
+        for echo in (False, False, True):
+            self.assertTrue(sender.send_text("127.0.0.1", "again", echo=echo))
+        self.assertEqual(receiver.texts, ["again", "again"])
+
+
+class CommandLineTest(LoopbackTest):
+    def run_cli(self, *argv):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            code = localdrop.main(["--name", "cli"] + list(argv))
+        return code, [json.loads(line) for line in out.getvalue().splitlines()]
+
+    def test_send_next_to_serve(self):
+        """send leaves the discovery and transfer ports to the instance serving on them."""
+        serving = self.manager()
+        data = self.rnd.randbytes(MB)
+        path = self.write("cli.bin", data)
+        code, events = self.run_cli("send", "127.0.0.1", path, "--wait", "0.2")
+        self.assertEqual(code, 0)
+        self.assertTrue(events[-1]["ok"])
+        self.assertEqual(self.received(serving, "cli.bin"), data)
+
+@unittest.skipUnless(SECURE_AVAILABLE, "needs pip install cryptography")
+class SecureTest(LoopbackTest):
+    def send_to(self, receiver, sender, path):
+        network.TRANSFER_PORT = receiver.port
+        return sender.send_file("127.0.0.1", path)
+
+    def test_same_secret_transfers(self):
+        receiver = self.manager(FEATURES + ["secure"], secret="correct horse")
+        sender = self.manager(FEATURES + ["secure"], name="sender", secret="correct horse")
+        data = self.rnd.randbytes(3 * MB)
+        path = self.write("secret.bin", data)
+        self.assertTrue(self.send_to(receiver, sender, path))
+        self.assertEqual(self.received(receiver, "secret.bin"), data)
+        # Later connections resume the session instead of a full key exchange
+        self.assertTrue(self.send_to(receiver, sender, path))
+
+    def test_wrong_secret_is_refused(self):
+        receiver = self.manager(FEATURES + ["secure"], secret="correct horse")
+        sender = self.manager(FEATURES + ["secure"], name="sender", secret="battery staple")
+        path = self.write("wrong.bin", self.rnd.randbytes(MB))
+        self.assertFalse(self.send_to(receiver, sender, path))
+        time.sleep(0.2)
+        self.assertEqual(os.listdir(receiver.download_dir), [])
+        self.assertEqual(receiver.prompts, [])
+
+    def test_wrong_secret_learns_nothing_keyed(self):
+        """The receiver sends nothing derived from its pairing key to a client that has not proven it holds the key."""
+        receiver = self.manager(FEATURES + ["secure"], secret="correct horse")
+        public = X25519PrivateKey.generate().public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+        with socket.create_connection(("127.0.0.1", receiver.port)) as s:
+            s.sendall(secure.HELLO.pack(secure.MAGIC, secure.AESGCM_SUITE, public, os.urandom(16), bytes(16)))
+            reply = secure._read_exact(s, secure.REPLY.size)
+            self.assertEqual(reply[:5], secure.MAGIC + b'F')  # Public key and nonce only
+            s.sendall(os.urandom(secure.FINISHED_SIZE))  # A guess at the client finished
+            s.settimeout(5)
+            self.assertEqual(s.recv(1024), b"")  # Closed, without a server finished
+
+    def test_cleartext_is_refused_both_ways(self):
+        receiver = self.manager(FEATURES + ["secure"], secret="correct horse")
+        plain = self.manager(FEATURES + ["secure"], name="plain")
+        path = self.write("plain.bin", self.rnd.randbytes(MB))
+        # We know the peer wants encryption: nothing is sent in cleartext
+        self.assertFalse(self.send_to(receiver, plain, path))
+        # A sender that does not know: the receiver refuses the connection
+        plain.found_devices.add(Device("127.0.0.1", "receiver", "windows", time.time(), tuple(FEATURES)), 1e9)
+        self.assertFalse(self.send_to(receiver, plain, path))
+        time.sleep(0.2)
+        self.assertEqual(os.listdir(receiver.download_dir), [])
+
+
+if __name__ == "__main__":
+    unittest.main()